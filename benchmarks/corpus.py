@@ -0,0 +1,148 @@
+"""Generated corpus used by benchmarks.
+
+Data is built the way ``imaplib`` returns it: a list containing bytes
+(response lines) and 2-uples (line announcing a literal, literal).
+Generation is deterministic so results can be compared between runs.
+"""
+
+import random
+
+LISTING_HEADERS = "DATE FROM TO CC SUBJECT CONTENT-TYPE"
+
+FIRST_NAMES = ["Antoine", "Zoé", "Jürgen", "Ólafur", "Łukasz", "Amélie"]
+WORDS = [
+    "meeting", "report", "invoice", "holidays", "release", "planning",
+    "budget", "review", "résumé", "über", "naïve", "café"
+]
+
+
+def _subject(rnd, long_lines=False):
+    """Return a Subject header, encoded words included."""
+    words = [rnd.choice(WORDS) for i in range(rnd.randint(3, 8))]
+    if long_lines:
+        words *= 150
+    value = " ".join(words)
+    if rnd.random() < 0.5:
+        # RFC 2047 encoded
+        value = "=?utf-8?q?{}?=".format(
+            "".join(
+                "={:02X}".format(byte) if byte > 127 or byte == 32
+                else chr(byte)
+                for byte in value.encode("utf-8")))
+    return value
+
+
+def message_headers(rnd, long_lines=False):
+    """Return the headers fetched for a listing (bytes)."""
+    name = rnd.choice(FIRST_NAMES)
+    headers = (
+        "Date: Tue, {day} Dec 2019 19:50:13 +0100\r\n"
+        "From: {name} <{login}@example.com>\r\n"
+        "To: user@example.com\r\n"
+        "Subject: {subject}\r\n"
+        "Content-Type: multipart/mixed;\r\n"
+        " boundary=\"----=_Part_{uid}\"\r\n\r\n"
+    ).format(
+        day=rnd.randint(1, 28), name=name, login=name.lower(),
+        subject=_subject(rnd, long_lines), uid=rnd.randint(1, 10**9))
+    if rnd.random() < 0.2:
+        # Raw 8-bit header (non UTF-8)
+        return headers.encode("latin-1", "replace")
+    return headers.encode("utf-8")
+
+
+def listing_response(count, long_lines=False, seed=42):
+    """Build the response to a listing FETCH command.
+
+    :param int count: number of messages
+    :param bool long_lines: use very long Subject headers
+    """
+    rnd = random.Random(seed)
+    response = []
+    for uid in range(1, count + 1):
+        headers = message_headers(rnd, long_lines)
+        flags = rnd.choice([r"\Seen", r"\Seen \Flagged", "", "$Forwarded"])
+        response.append((
+            "{} (UID {} FLAGS ({}) RFC822.SIZE {} "
+            "BODY[HEADER.FIELDS ({})] {{{}}}".format(
+                uid, uid, flags, rnd.randint(500, 10**7),
+                LISTING_HEADERS, len(headers)).encode(),
+            headers
+        ))
+        response.append(b")")
+    return response
+
+
+def _leaf(rnd, kind):
+    """Return the definition of a single part (bytes)."""
+    if kind == "text":
+        subtype = rnd.choice(["plain", "html"])
+        return (
+            '("text" "{}" ("charset" "utf-8") NIL NIL "quoted-printable" '
+            '{} {} NIL NIL NIL NIL)'.format(
+                subtype, rnd.randint(100, 10**5), rnd.randint(1, 2000))
+        ).encode()
+    filename = "{}-{}.pdf".format(rnd.choice(WORDS), rnd.randint(1, 99))
+    return (
+        '("application" "pdf" ("name" "{0}") NIL NIL "base64" {1} NIL '
+        '("attachment" ("filename" "{0}")) NIL NIL)'.format(
+            filename, rnd.randint(10**3, 10**7))
+    ).encode("utf-8")
+
+
+def _multipart(rnd, depth, width):
+    """Return the definition of a multipart part (bytes)."""
+    parts = []
+    for pos in range(width):
+        if depth > 1 and pos == 0:
+            parts.append(_multipart(rnd, depth - 1, width))
+        else:
+            parts.append(_leaf(rnd, "text" if pos % 2 else "attachment"))
+    return b"(" + b"".join(parts) + (
+        ' "{}" ("boundary" "----=_Part_{}") NIL NIL NIL)'.format(
+            rnd.choice(["mixed", "alternative", "related"]),
+            rnd.randint(1, 10**9))
+    ).encode()
+
+
+def bodystructure_response(count, depth=8, width=4, seed=42):
+    """Build a response containing deeply nested BODYSTRUCTUREs.
+
+    :param int count: number of messages
+    :param int depth: nesting level of multipart parts
+    :param int width: number of parts of each multipart part
+    """
+    rnd = random.Random(seed)
+    return [
+        b"%d (UID %d BODYSTRUCTURE %s)" % (
+            uid, uid, _multipart(rnd, depth, width))
+        for uid in range(1, count + 1)
+    ]
+
+
+def part_response(size, charset="latin-1", seed=42):
+    """Build the response to the FETCH of a large non UTF-8 part.
+
+    :param int size: size of the literal (in octets)
+    """
+    rnd = random.Random(seed)
+    text = " ".join(rnd.choice(WORDS) for i in range(size // 5 + 1))
+    literal = text.encode(charset, "replace")[:size]
+    return [
+        (b"1 (UID 1 BODY[1] {%d}" % len(literal), literal),
+        b")"
+    ]
+
+
+def header_values(count, long_lines=False, seed=42):
+    """Return (From, Subject, Date) header values."""
+    rnd = random.Random(seed)
+    result = []
+    for i in range(count):
+        name = rnd.choice(FIRST_NAMES)
+        result.append((
+            "{} <{}@example.com>".format(name, name.lower()),
+            _subject(rnd, long_lines),
+            "Tue, {} Dec 2019 19:50:13 +0100".format(rnd.randint(1, 28))
+        ))
+    return result
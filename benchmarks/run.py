@@ -0,0 +1,253 @@
+"""Benchmark runner.
+
+Usage (from the repository root)::
+
+    python -m benchmarks.run [--messages 1000] [--filter parser]
+                             [--json results.json] [--compare base.json]
+
+Each benchmark is run repeatedly during at least ``--min-time``
+seconds, the best rate of ``--repeat`` runs is reported (operations
+and items per second) along with the peak memory allocated by one
+operation. Use ``--compare`` with the output of a previous run to
+highlight regressions.
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_django():
+    """Configure Django using the test project."""
+    sys.path.insert(0, os.path.join(ROOT, "test_project"))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "test_project.settings")
+    import django
+    django.setup()
+
+
+class Benchmark(object):
+    """A benchmark.
+
+    :param str name: the benchmark's name
+    :param setup: a function returning the data used by ``func``
+    :param func: the function to measure (called with the data)
+    :param count: a function returning the number of items processed
+                  by one operation (messages, octets, etc.)
+    """
+
+    def __init__(self, name, setup, func, count, unit="msg"):
+        self.name = name
+        self.setup = setup
+        self.func = func
+        self.count = count
+        self.unit = unit
+
+    def run(self, min_time, repeat):
+        """Run the benchmark.
+
+        :return: a dictionary (ops/s, items/s, peak memory in octets)
+        """
+        data = self.setup()
+        items = self.count(data)
+        best = None
+        for i in range(repeat):
+            number = 0
+            gc.collect()
+            start = time.perf_counter()
+            while True:
+                self.func(data)
+                number += 1
+                elapsed = time.perf_counter() - start
+                if elapsed >= min_time:
+                    break
+            rate = number / elapsed
+            best = rate if best is None else max(best, rate)
+        gc.collect()
+        tracemalloc.start()
+        self.func(data)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return {
+            "ops_per_sec": best,
+            "items_per_sec": best * items,
+            "unit": self.unit,
+            "peak_memory": peak
+        }
+
+
+def get_benchmarks(messages):
+    """Return the list of benchmarks.
+
+    :param int messages: number of messages of the listings corpus
+    """
+    from django.template.loader import render_to_string
+    from modoboa.lib.signals import set_current_request
+
+    from modoboa_webmail.lib import imapheader
+    from modoboa_webmail.lib.fetch_parser import FetchResponseParser
+    from modoboa_webmail.lib.imaputils import (
+        BaseIMAPconnector, BodyStructure
+    )
+
+    from . import corpus
+
+    # imapheader.parse_date uses the language of the current user
+    set_current_request(SimpleNamespace(user=SimpleNamespace(language="en")))
+
+    structures = max(messages // 10, 1)
+    part_size = 8 * 1024 * 1024
+
+    def parse(data):
+        return FetchResponseParser().parse(data)
+
+    def parse_raw(data):
+        return FetchResponseParser(decode_literals=False).parse(data)
+
+    def iterparse(data):
+        for uid, msg in FetchResponseParser().iterparse(data):
+            pass
+
+    def load_structures(data):
+        return [BodyStructure(msg["BODYSTRUCTURE"]) for msg in data]
+
+    def parse_headers(data):
+        for sender, subject, date in data:
+            imapheader.parse_from(sender)
+            imapheader.parse_subject(subject)
+            imapheader.parse_date(date)
+
+    # Only helpers that don't talk to the server are used
+    connector = BaseIMAPconnector(
+        conf={"imap_server": "127.0.0.1", "imap_port": 143})
+
+    def render_listing(data):
+        # Same steps as IMAPconnector.fetch
+        summaries = {}
+        flags = {}
+        for uid, msg_data in data.items():
+            summaries[uid] = connector._make_summary(msg_data)
+            flags[uid] = msg_data["FLAGS"]
+        email_list = connector._build_listing(sorted(data), summaries, flags)
+        return render_to_string("modoboa_webmail/email_list.html", {
+            "email_list": email_list, "page": 1, "with_top_div": True})
+
+    return [
+        Benchmark(
+            "parser.listing",
+            lambda: corpus.listing_response(messages), parse,
+            lambda data: messages),
+        Benchmark(
+            "parser.listing_iterparse",
+            lambda: corpus.listing_response(messages), iterparse,
+            lambda data: messages),
+        Benchmark(
+            "parser.listing_long_headers",
+            lambda: corpus.listing_response(structures, long_lines=True),
+            parse, lambda data: structures),
+        Benchmark(
+            "parser.nested_bodystructure",
+            lambda: corpus.bodystructure_response(structures), parse,
+            lambda data: structures),
+        Benchmark(
+            "parser.non_utf8_literal",
+            lambda: corpus.part_response(part_size), parse,
+            lambda data: part_size, unit="B"),
+        Benchmark(
+            "parser.non_utf8_literal_raw",
+            lambda: corpus.part_response(part_size), parse_raw,
+            lambda data: part_size, unit="B"),
+        Benchmark(
+            "bodystructure.nested",
+            lambda: list(parse(
+                corpus.bodystructure_response(structures)).values()),
+            load_structures, len),
+        Benchmark(
+            "imapheader.parse",
+            lambda: corpus.header_values(messages), parse_headers, len),
+        Benchmark(
+            "imapheader.parse_long_lines",
+            lambda: corpus.header_values(structures, long_lines=True),
+            parse_headers, len),
+        Benchmark(
+            "template.email_list",
+            lambda: parse(corpus.listing_response(structures)),
+            render_listing, len),
+    ]
+
+
+def format_size(value):
+    """Return a human readable size."""
+    for unit in ["B", "KiB", "MiB"]:
+        if value < 1024:
+            return "{:.1f} {}".format(value, unit)
+        value /= 1024.0
+    return "{:.1f} GiB".format(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the webmail benchmarks.")
+    parser.add_argument(
+        "--messages", type=int, default=1000,
+        help="Number of messages of the listing corpus (default: 1000)")
+    parser.add_argument(
+        "--filter", default="",
+        help="Only run benchmarks whose name contains this value")
+    parser.add_argument(
+        "--min-time", type=float, default=0.5,
+        help="Minimum duration of a run in seconds (default: 0.5)")
+    parser.add_argument(
+        "--repeat", type=int, default=3,
+        help="Number of runs (default: 3)")
+    parser.add_argument("--json", help="Save results to this file")
+    parser.add_argument(
+        "--compare", help="Compare results with a previous JSON output")
+    parser.add_argument(
+        "--threshold", type=float, default=0.1,
+        help="Slowdown ratio reported as a regression (default: 0.1)")
+    args = parser.parse_args(argv)
+
+    setup_django()
+    reference = {}
+    if args.compare:
+        with open(args.compare) as fp:
+            reference = json.load(fp)["results"]
+    results = {}
+    regressions = []
+    print("{:<32} {:>10} {:>20} {:>12} {:>7}".format(
+        "benchmark", "ops/s", "items/s", "peak mem", "delta"))
+    for benchmark in get_benchmarks(args.messages):
+        if args.filter not in benchmark.name:
+            continue
+        result = benchmark.run(args.min_time, args.repeat)
+        results[benchmark.name] = result
+        delta = ""
+        if benchmark.name in reference:
+            ratio = (
+                result["ops_per_sec"] /
+                reference[benchmark.name]["ops_per_sec"] - 1)
+            delta = "{:+.0%}".format(ratio)
+            if ratio < -args.threshold:
+                regressions.append(benchmark.name)
+        print("{:<32} {:>10.2f} {:>16.0f} {:<3} {:>12} {:>7}".format(
+            benchmark.name, result["ops_per_sec"], result["items_per_sec"],
+            result["unit"], format_size(result["peak_memory"]), delta))
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump({"messages": args.messages, "results": results}, fp,
+                      indent=2)
+    if regressions:
+        print("Regressions: {}".format(", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
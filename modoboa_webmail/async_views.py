@@ -0,0 +1,426 @@
+"""Asynchronous variants of the most used webmail views.
+
+They are used instead of the ones defined in ``views`` when the
+``WEBMAIL_ASYNC_VIEWS`` setting is True (see ``urls``) and Modoboa is
+served by an ASGI server: IMAP round trips are made by an
+``AsyncIMAPconnector`` so a worker is not blocked while waiting for
+the server. Blocking operations (database accesses, template
+rendering, HTML cleaning, spool accesses) are run in threads.
+"""
+
+import asyncio
+import os
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+
+from django.contrib.auth.views import redirect_to_login
+from django.db import close_old_connections
+from django.http import HttpResponse, StreamingHttpResponse
+from django.shortcuts import redirect, render
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from django.utils.translation import gettext as _
+
+from modoboa.core.extensions import exts_pool
+from modoboa.lib.cryptutils import get_password
+from modoboa.lib.exceptions import (
+    BadRequest, NotFound, PermDeniedException
+)
+from modoboa.lib.paginator import Paginator
+from modoboa.lib.web_utils import render_to_json_response
+
+from . import views
+from .exceptions import ImapError
+from .lib import (
+    WebmailNavigationParameters, aioimap, push, rfc6266, spool
+)
+from .lib.compression import CompressionPolicyMiddleware
+from .lib.imapemail import AsyncImapEmail
+from .lib.utils import (
+    AsyncMessagePartStream, async_iterator, parse_range_header,
+    sync_iterator
+)
+from .templatetags import webmail_tags
+
+
+def check_access(request):
+    """Checks made by the decorators of the synchronous views.
+
+    The user and the session are loaded here (in a thread), they can
+    then be used from coroutines.
+
+    :return: a response to send instead of calling the view (or None)
+    """
+    if not request.user.is_authenticated:
+        return redirect_to_login(request.get_full_path())
+    if not hasattr(request.user, "mailbox"):
+        raise PermDeniedException(_("A mailbox is required"))
+    if get_password(request) is None:
+        return redirect("modoboa_webmail:get_plain_password")
+    return None
+
+
+def webmail_view(compress=False):
+    """Replace ``login_required``, ``needs_mailbox``, ``compress_page``
+    and ``need_password`` for asynchronous views.
+
+    The IMAP connection used by the view (if any) is given back to the
+    pool once the view has returned.
+
+    :param bool compress: compress the response (see ``compress_page``)
+    """
+    def decorator(f):
+        middleware = CompressionPolicyMiddleware(f) if compress else None
+
+        @wraps(f)
+        async def wrapped_f(request, *args, **kwargs):
+            response = await sync_to_async(check_access)(request)
+            if response is not None:
+                return response
+            try:
+                response = await f(request, *args, **kwargs)
+            finally:
+                await aioimap.release_imapconnector(request)
+            if middleware is not None:
+                response = await sync_to_async(middleware.process_response)(
+                    request, response)
+            return response
+        return wrapped_f
+    return decorator
+
+
+@webmail_view(compress=True)
+async def getattachment(request):
+    """Fetch a message attachment
+
+    See ``views.getattachment``.
+
+    :param request: a ``Request`` object
+    """
+    mbox = request.GET.get("mbox", None)
+    mailid = request.GET.get("mailid", None)
+    pnum = request.GET.get("partnumber", None)
+    fname = request.GET.get("fname", None)
+    if not mbox or not mailid or not pnum or not fname:
+        raise BadRequest(_("Invalid request"))
+
+    imapc = await aioimap.get_imapconnector(request)
+    bs = await imapc.get_bodystructure(mbox, mailid)
+    partdef = bs.find_attachment(pnum)
+    if partdef is None:
+        raise NotFound(_("Attachment not found"))
+    etag = None
+    if imapc.uidvalidity is not None:
+        etag = quote_etag(
+            "{}-{}-{}".format(imapc.uidvalidity, mailid, pnum))
+        resp = get_conditional_response(request, etag=etag)
+        if resp is not None:
+            return resp
+    spool_key = (imapc.user, mbox, imapc.uidvalidity, mailid, pnum)
+    path = await sync_to_async(spool.get)(*spool_key)
+    encoded = partdef["encoding"].lower() not in ["7bit", "8bit", "binary"]
+    if path is not None:
+        size = await sync_to_async(os.path.getsize)(path)
+    elif not encoded:
+        size = int(partdef["size"])
+    else:
+        size = None
+
+    prange = None
+    range_header = request.META.get("HTTP_RANGE")
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if etag and range_header and (not if_range or if_range == etag):
+        if size is None:
+            stream = AsyncMessagePartStream(
+                aioimap.detach_imapconnector(request), mbox, mailid,
+                partdef)
+            path = await sync_to_async(spool.store)(
+                *spool_key, chunks=sync_iterator(stream))
+            size = await sync_to_async(os.path.getsize)(path)
+        try:
+            prange = parse_range_header(range_header, size)
+        except ValueError:
+            resp = HttpResponse(status=416)
+            resp["Content-Range"] = "bytes */{}".format(size)
+            return resp
+
+    if prange is not None:
+        offset, length = prange[0], prange[1] - prange[0] + 1
+    else:
+        offset, length = 0, size
+    if path is not None:
+        content = async_iterator(spool.iter_file(path, offset, length))
+    elif prange is not None:
+        content = AsyncMessagePartStream(
+            aioimap.detach_imapconnector(request), mbox, mailid, partdef,
+            offset, length)
+    else:
+        content = AsyncMessagePartStream(
+            aioimap.detach_imapconnector(request), mbox, mailid, partdef)
+    resp = StreamingHttpResponse(content)
+    if prange is not None:
+        resp.status_code = 206
+        resp["Content-Range"] = "bytes {}-{}/{}".format(
+            prange[0], prange[1], size)
+    if length is not None:
+        resp["Content-Length"] = length
+    if etag:
+        resp["ETag"] = etag
+        resp["Accept-Ranges"] = "bytes"
+    patch_cache_control(resp, private=True)
+    resp["Content-Type"] = partdef["Content-Type"]
+    resp["Content-Transfer-Encoding"] = partdef["encoding"]
+    resp["Content-Disposition"] = rfc6266.build_header(fname)
+    return resp
+
+
+async def render_mboxes_list(request, imapc):
+    """Return the HTML representation of a mailboxes list
+
+    :param request: a ``Request`` object
+    :param imapc: an ``AsyncIMAPconnector`` object
+    :return: a string
+    """
+    curmbox = WebmailNavigationParameters(request).get("mbox", "INBOX")
+    mboxes = await imapc.getmboxes(request.user)
+    return await sync_to_async(render_to_string)(
+        "modoboa_webmail/folders.html", {
+            "selected": curmbox,
+            "mboxes": mboxes,
+            "withunseen": True
+        }, request)
+
+
+async def listmailbox(request, defmailbox="INBOX", update_session=True):
+    """Mailbox content listing.
+
+    See ``views.listmailbox``.
+
+    :param request: a ``Request`` object
+    :param defmailbox: the default mailbox (when not present inside
+                       request arguments)
+    :return: a dictionnary
+    """
+    navparams = WebmailNavigationParameters(request, defmailbox)
+    previous_page_id = int(navparams["page"]) if "page" in navparams else None
+    if update_session:
+        navparams.store()
+    mbox = navparams.get('mbox')
+    page_id = int(navparams["page"])
+    mbc = await aioimap.get_imapconnector(request)
+    mbc.parse_search_parameters(
+        navparams.get("criteria"), navparams.get("pattern"))
+    sort_order = navparams.get("order")
+    messages_per_page = request.user.parameters.get_value("messages_per_page")
+    start = (page_id - 1) * messages_per_page + 1
+    paginator = Paginator(
+        await mbc.messages_count(
+            folder=mbox, order=sort_order,
+            start=start, stop=start + messages_per_page - 1),
+        messages_per_page
+    )
+    page = paginator.getpage(page_id)
+    content = ""
+    if page is not None:
+        email_list = await mbc.fetch(page.id_start, page.id_stop, mbox)
+        content = await sync_to_async(render_to_string)(
+            "modoboa_webmail/email_list.html", {
+                "email_list": email_list,
+                "page": page_id,
+                "with_top_div": request.GET.get("scroll", "false") == "false"
+            }, request
+        )
+        length = len(content)
+    else:
+        if page_id == 1:
+            content = u"<div class='alert alert-info'>{0}</div>".format(
+                _("Empty mailbox")
+            )
+        length = 0
+        if previous_page_id is not None:
+            navparams["page"] = previous_page_id
+    result = {
+        "listing": content, "length": length, "pages": [page_id],
+        "menuargs": {"sort_order": sort_order}
+    }
+    state = mbc.get_sync_state()
+    if state is not None:
+        result.update(state)
+    return result
+
+
+def render_mailcontent(request, email):
+    """Render the body of a message (HTML cleaning is done here)."""
+    return render(request, "common/viewmail.html", {
+        "mailbody": email.body if email.body else ""
+    })
+
+
+@webmail_view(compress=True)
+async def getmailcontent(request):
+    mbox = request.GET.get("mbox", None)
+    mailid = request.GET.get("mailid", None)
+    if mbox is None or mailid is None:
+        raise BadRequest(_("Invalid request"))
+    email = AsyncImapEmail(
+        request, await aioimap.get_imapconnector(request),
+        "%s:%s" % (mbox, mailid), dformat="DISPLAYMODE",
+        links=request.GET.get("links", "0") == "1"
+    )
+    await email.afetch_body()
+    return await sync_to_async(render_mailcontent)(request, email)
+
+
+async def viewmail(request):
+    mbox = request.GET.get("mbox", None)
+    mailid = request.GET.get("mailid", None)
+    if mbox is None or mailid is None:
+        raise BadRequest(_("Invalid request"))
+    links = request.GET.get("links", None)
+    if links is None:
+        links = int(request.user.parameters.get_value("enable_links"))
+    else:
+        links = int(links)
+    email = AsyncImapEmail(
+        request, await aioimap.get_imapconnector(request),
+        "%s:%s" % (mbox, mailid), dformat="DISPLAYMODE", links=links
+    )
+    await email.afetch_headers()
+    context = {
+        "mbox": mbox,
+        "mailid": mailid,
+        "links": links,
+        "headers": email.headers,
+        "attachments": email.attachments
+    }
+    content = await sync_to_async(render_to_string)(
+        "modoboa_webmail/headers.html", context, request)
+    return {"listing": content, "menuargs": {"mail_id": mailid}}
+
+
+@webmail_view()
+async def check_unseen_messages(request):
+    mboxes = request.GET.get("mboxes", None)
+    if not mboxes:
+        raise BadRequest(_("Invalid request"))
+    mboxes = mboxes.split(",")
+    imapc = await aioimap.get_imapconnector(request)
+    counters = await imapc.unseen_counters(mboxes)
+    return render_to_json_response(counters)
+
+
+@webmail_view()
+async def events(request):
+    """Stream the changes made to a mailbox (server-sent events).
+
+    See ``views.events``: the stream is generated by a coroutine, so
+    events are sent as soon as they happen and no thread is blocked.
+    """
+    mbox, since, mailboxes = views.get_events_parameters(request)
+    conf = await sync_to_async(aioimap.get_parameters)()
+    if not conf["push_enabled"]:
+        return HttpResponse(status=204)
+    password = await sync_to_async(get_password)(request)
+    pool = aioimap.get_connections_pool()
+    try:
+        imapc = await pool.checkout(
+            request.user.username, password, conf, timeout=0, keep_free=1)
+    except ImapError:
+        return HttpResponse(status=204)
+    if not push.is_supported(imapc):
+        await pool.checkin(imapc)
+        return HttpResponse(status=204)
+    response = StreamingHttpResponse(
+        push.aiter_events(
+            imapc, mbox, since, mailboxes,
+            request.user.parameters.get_value("refresh_interval"),
+            release=pool.checkin),
+        content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Disable buffering when a nginx reverse proxy is used
+    response["X-Accel-Buffering"] = "no"
+    # The stream doesn't need the database
+    await sync_to_async(close_old_connections)()
+    return response
+
+
+#: Actions of the ``index`` view having an asynchronous variant
+ACTIONS = {
+    "listmailbox": listmailbox,
+    "viewmail": viewmail,
+}
+
+
+async def index(request):
+    """Webmail actions handler
+
+    See ``views.index``. Other actions than the ones listed in
+    ``ACTIONS`` are handled by the synchronous view (in a thread).
+    """
+    action = request.GET.get("action", None)
+    if action is not None and action not in ACTIONS:
+        return await sync_to_async(views.index)(request)
+    return await _index(request, action)
+
+
+@webmail_view(compress=True)
+async def _index(request, action):
+    if action is not None:
+        response = await ACTIONS[action](request)
+    else:
+        if views.is_ajax(request):
+            raise BadRequest(_("Invalid request"))
+        response = {"selection": "webmail"}
+
+    curmbox = WebmailNavigationParameters(request).get("mbox", "INBOX")
+    if not views.is_ajax(request):
+        request.session["lastaction"] = None
+        imapc = await aioimap.get_imapconnector(request)
+        # Quota and mailboxes are retrieved at the same time
+        mboxes, _quota, conf = await asyncio.gather(
+            render_mboxes_list(request, imapc),
+            imapc.getquota(curmbox),
+            sync_to_async(aioimap.get_parameters)())
+        trash = request.user.parameters.get_value("trash_folder")
+        response.update({
+            "hdelimiter": imapc.hdelimiter,
+            "mboxes": mboxes,
+            "push_enabled": conf["push_enabled"],
+            "refreshrate": request.user.parameters.get_value(
+                "refresh_interval"),
+            "quota": imapc.quota_usage,
+            "trash": trash,
+            "ro_mboxes": [
+                "INBOX", "Junk",
+                request.user.parameters.get_value("sent_folder"),
+                trash,
+                request.user.parameters.get_value("drafts_folder")
+            ],
+            "mboxes_col_width": request.user.parameters.get_value(
+                "mboxes_col_width"),
+            "contacts_plugin_enabled": exts_pool.get_extension(
+                "modoboa_contacts")
+        })
+        return await sync_to_async(render)(
+            request, "modoboa_webmail/index.html", response)
+
+    if request.session["lastaction"] != action:
+        extra_args = {}
+        if "menuargs" in response:
+            extra_args = response["menuargs"]
+            del response["menuargs"]
+        try:
+            menu = getattr(webmail_tags, "%s_menu" % action)
+            response["menu"] = await sync_to_async(menu)(
+                "", curmbox, request.user, **extra_args)
+        except KeyError:
+            pass
+
+    response.update(callback=action)
+    http_status = 200
+    if "status" in response:
+        del response['status']
+        http_status = 400
+    return render_to_json_response(response, status=http_status)
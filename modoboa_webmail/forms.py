@@ -22,9 +22,7 @@ from ckeditor_uploader.widgets import CKEditorUploadingWidget
 from modoboa.lib import email_utils, form_utils
 from modoboa.parameters import forms as param_forms
 
-from .lib import (
-    ImapEmail, create_mail_attachment, decode_payload
-)
+from .lib import ImapEmail, create_mail_attachment
 from .validators import validate_email_list
 
 
@@ -246,11 +244,9 @@ class ForwardMailForm(ComposeMailForm):
         origmsg = ImapEmail(request, "%s:%s" % (mbox, mailid))
         if origmsg.attachments:
             for attpart, fname in origmsg.attachments.items():
-                attdef, payload = origmsg.fetch_attachment(attpart)
+                attdef, content = origmsg.get_decoded_part(attpart)
                 attdef["fname"] = fname
-                msg.attach(create_mail_attachment(
-                    attdef, decode_payload(attdef["encoding"], payload)
-                ))
+                msg.attach(create_mail_attachment(attdef, content))
         return msg
 
 
@@ -280,6 +276,60 @@ class ParametersForm(param_forms.AdminParametersForm):
             "Maximum attachment size in bytes (or KB, MB, GB if specified)")
     )
 
+    compression_enabled = form_utils.YesNoField(
+        label=_("Compress responses"),
+        initial=True,
+        help_text=_(
+            "Compress webmail responses when the browser supports it")
+    )
+
+    compression_min_size = forms.IntegerField(
+        label=_("Compression threshold"),
+        initial=1024,
+        min_value=0,
+        help_text=_(
+            "Responses smaller than this number of bytes are not compressed")
+    )
+
+    compression_types = forms.CharField(
+        label=_("Compressible content types"),
+        initial=(
+            "text/*, application/json, application/javascript, "
+            "application/xml, image/svg+xml"),
+        required=False,
+        help_text=_(
+            "Comma separated list of content types (wildcards allowed) "
+            "that are worth compressing. Other responses (images, "
+            "archives, PDF files...) are sent as is.")
+    )
+
+    inline_images_lazy = form_utils.YesNoField(
+        label=_("Load inline images on demand"),
+        initial=False,
+        help_text=_(
+            "Inline images of HTML messages are only retrieved from the "
+            "IMAP server when the browser requests them")
+    )
+
+    inline_images_max = forms.IntegerField(
+        label=_("Maximum inline images"),
+        initial=20,
+        min_value=0,
+        help_text=_(
+            "Maximum number of inline images retrieved along with the "
+            "body of a message. Remaining images are loaded on demand")
+    )
+
+    spool_max_size = forms.IntegerField(
+        label=_("Part cache size"),
+        initial=1024,
+        min_value=0,
+        help_text=_(
+            "Maximum size (in MB) of the local cache of decoded message "
+            "parts (attachments, inline images). Least recently used "
+            "parts are removed first")
+    )
+
     sep1 = form_utils.SeparatorField(label=_("IMAP settings"))
 
     imap_server = forms.CharField(
@@ -300,6 +350,43 @@ class ParametersForm(param_forms.AdminParametersForm):
         help_text=_("Listening port of your IMAP server")
     )
 
+    imap_max_connections = forms.IntegerField(
+        label=_("Maximum connections per user"),
+        initial=4,
+        min_value=1,
+        help_text=_(
+            "Maximum number of simultaneous IMAP connections a user can "
+            "open (per worker process)")
+    )
+
+    imap_idle_timeout = forms.IntegerField(
+        label=_("Idle connection timeout"),
+        initial=300,
+        min_value=0,
+        help_text=_(
+            "Close pooled IMAP connections that have not been used for "
+            "this number of seconds")
+    )
+
+    imap_check_interval = forms.IntegerField(
+        label=_("Connection check interval"),
+        initial=60,
+        min_value=0,
+        help_text=_(
+            "Pooled IMAP connections unused for more than this number of "
+            "seconds are checked before being reused")
+    )
+
+    push_enabled = form_utils.YesNoField(
+        label=_("Push notifications"),
+        initial=False,
+        help_text=_(
+            "Notify browsers of changes using IMAP IDLE instead of "
+            "polling. Each opened webmail keeps an IMAP connection and "
+            "a web server thread busy: the web server must support "
+            "long-lived requests")
+    )
+
     sep2 = form_utils.SeparatorField(label=_("SMTP settings"))
 
     smtp_server = forms.CharField(
@@ -330,6 +417,10 @@ class ParametersForm(param_forms.AdminParametersForm):
         help_text=_("Server needs authentication")
     )
 
+    visibility_rules = {
+        "inline_images_max": "inline_images_lazy=False"
+    }
+
 
 class UserSettings(param_forms.UserParametersForm):
     app = "modoboa_webmail"
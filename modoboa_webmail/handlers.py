@@ -6,8 +6,7 @@ from django.utils.translation import gettext as _
 
 from modoboa.core import signals as core_signals
 
-from . import exceptions
-from . import lib
+from .lib import aioimap, imaputils
 
 
 @receiver(core_signals.extra_user_menu_entries)
@@ -24,21 +23,11 @@ def menu(sender, location, user, **kwargs):
 
 @receiver(core_signals.user_logout)
 def userlogout(sender, request, **kwargs):
-    """Close IMAP connection."""
+    """Close IMAP connections."""
     if not hasattr(request.user, "mailbox"):
         return
-    try:
-        m = lib.IMAPconnector(user=request.user.username,
-                              password=request.session["password"])
-    except Exception:
-        # TODO silent exception are bad : we should at least log it
-        return
-
-    # The following statement may fail under Python 2.6...
-    try:
-        m.logout()
-    except exceptions.ImapError:
-        pass
+    imaputils.connections_pool.clear(request.user.username)
+    aioimap.clear_connections(request.user.username)
 
 
 @receiver(core_signals.extra_static_content)
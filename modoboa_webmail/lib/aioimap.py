@@ -0,0 +1,1157 @@
+"""Asynchronous IMAPv4 engine.
+
+``AsyncIMAPconnector`` implements the ``IMAPconnector`` API using
+asyncio streams, for asynchronous views: waiting for the server costs
+a coroutine instead of a worker thread.
+
+Responses are stored the way ``imaplib`` does (see ``AsyncIMAP4``) so
+commands are built and responses parsed by the code shared with the
+synchronous connector (``BaseIMAPconnector``, ``FetchResponseParser``):
+both return the same structures.
+
+Several coroutines can use the same connection at once: commands are
+written as soon as they are issued and their responses are read by
+whichever coroutine is waiting, so independent commands (STATUS,
+LIST, GETQUOTAROOT...) run with ``asyncio.gather`` are pipelined.
+Commands depending on the selected mailbox are serialized using
+``AsyncIMAPconnector.lock``.
+"""
+
+import asyncio
+import imaplib
+import re
+import ssl
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+
+from django.utils.encoding import smart_bytes
+from django.utils.translation import gettext as _
+
+from modoboa.lib import imap_utf7  # noqa
+from modoboa.lib.cryptutils import get_password
+from modoboa.parameters import tools as param_tools
+
+from ..exceptions import ImapError
+from . import cache
+from .fetch_parser import FetchResponseParser
+from .imaputils import (
+    MAXLINE, BaseIMAPconnector, BodyStructure, PipelinedCommand,
+    build_sequence_sets, capability, separate_mailbox
+)
+
+
+def get_parameters():
+    """Return the global parameters of the webmail.
+
+    They are stored in the database: call it using ``sync_to_async``
+    from a coroutine.
+    """
+    return dict(param_tools.get_global_parameters("modoboa_webmail"))
+
+
+class AsyncIMAP4(object):
+    """A minimal asyncio IMAP4rev1 client.
+
+    As with ``imaplib``, untagged responses are stored by name (a
+    response containing literals is split into 2-uples (line,
+    literal) followed by the rest of the line). They are attributed to
+    the first command completed after their reception, which gets the
+    ones it was sent for (see ``PipelinedCommand``); the others are
+    dropped, only their names are kept (``unsolicited``).
+
+    :param reader: an ``asyncio.StreamReader`` instance
+    :param writer: an ``asyncio.StreamWriter`` instance
+    """
+
+    tagged_pattern = re.compile(
+        br"(?P<tag>W\d+) (?P<type>[A-Z]+) ?(?P<data>.*)")
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.tagnum = 0
+        self.pending = {}
+        self.untagged_responses = {}
+        self.unsolicited = set()
+        self.continuation = None
+        self.broken = False
+        self.write_lock = asyncio.Lock()
+        self.read_lock = asyncio.Lock()
+
+    @classmethod
+    async def connect(cls, host, port, secured=False):
+        """Open a connection and read the server's greeting.
+
+        :return: an ``AsyncIMAP4`` instance
+        """
+        # Certificates are checked the same way by imaplib.IMAP4_SSL
+        context = ssl._create_stdlib_context() if secured else None
+        try:
+            reader, writer = await asyncio.open_connection(
+                host, port, ssl=context, limit=MAXLINE)
+        except OSError as error:
+            raise ImapError(_("Connection to IMAP server failed: %s" % error))
+        client = cls(reader, writer)
+        greeting = await client._read_response()
+        # Capabilities announced before authentication are not used
+        client.untagged_responses = {}
+        if not greeting.startswith((b"* OK", b"* PREAUTH")):
+            await client.close()
+            raise ImapError(_("Connection to IMAP server failed: %s" %
+                              greeting.decode(errors="replace")))
+        return client
+
+    @staticmethod
+    def quote(arg):
+        """Quote a string argument."""
+        arg = arg.replace("\\", "\\\\").replace('"', '\\"')
+        return '"' + arg + '"'
+
+    def _encode_arg(self, arg):
+        if isinstance(arg, int):
+            arg = str(arg)
+        if isinstance(arg, str):
+            return arg.encode("utf-8")
+        return bytes(arg)
+
+    def _new_command(self, name, args, responses):
+        """Create a command and register its tag."""
+        command = PipelinedCommand(name, args, responses)
+        self.tagnum += 1
+        command.tag = "W{}".format(self.tagnum)
+        self.pending[command.tag] = command
+        return command
+
+    async def _write(self, data):
+        try:
+            self.writer.write(data)
+            await self.writer.drain()
+        except OSError as e:
+            self.broken = True
+            raise ImapError(e)
+
+    async def _read_line(self):
+        """Read a line, without the trailing CRLF."""
+        try:
+            line = await self.reader.readline()
+        except (OSError, ValueError) as e:
+            # ValueError: the line is too long
+            self.broken = True
+            raise ImapError(e)
+        if not line.endswith(b"\n"):
+            self.broken = True
+            raise ImapError(_("Connection closed by the IMAP server"))
+        return line[:-2] if line.endswith(b"\r\n") else line[:-1]
+
+    async def _read_literal(self, size):
+        try:
+            return await self.reader.readexactly(size)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            self.broken = True
+            raise ImapError(e)
+
+    def _append_untagged(self, typ, dat):
+        self.untagged_responses.setdefault(typ, []).append(dat)
+
+    def _store_response_code(self, typ, dat):
+        """Store bracketed response information ([UIDVALIDITY 1]...)."""
+        if typ not in ("OK", "NO", "BAD"):
+            return
+        m = imaplib.Response_code.match(dat)
+        if m is not None:
+            self._append_untagged(m.group("type").decode(), m.group("data"))
+
+    async def _read_response(self, line=None):
+        """Read a response and store it.
+
+        Responses are handled like ``imaplib.IMAP4._get_response``
+        does.
+
+        :param line: the first line of the response, if already read
+        :return: the first line of the response
+        """
+        if line is None:
+            line = await self._read_line()
+        m = self.tagged_pattern.match(line)
+        if m is not None:
+            command = self.pending.pop(m.group("tag").decode(), None)
+            if command is None:
+                self.broken = True
+                raise ImapError("unexpected tagged response: %r" % line)
+            typ = m.group("type").decode()
+            self._store_response_code(typ, m.group("data"))
+            for name in self.untagged_responses:
+                if name in command.response_names:
+                    command.responses[name] = self.untagged_responses[name]
+                else:
+                    self.unsolicited.add(name)
+            self.untagged_responses = {}
+            command.status, command.data = typ, [m.group("data")]
+            return line
+        m = imaplib.Continuation.match(line)
+        if m is not None:
+            self.continuation = m.group("data") or b""
+            return line
+        dat2 = None
+        m = imaplib.Untagged_response.match(line)
+        if m is None:
+            m = imaplib.Untagged_status.match(line)
+            if m is not None:
+                dat2 = m.group("data2")
+        if m is None:
+            self.broken = True
+            raise ImapError("unexpected response: %r" % line)
+        typ = m.group("type").decode()
+        dat = m.group("data") or b""
+        if dat2:
+            dat = dat + b" " + dat2
+        m = imaplib.Literal.match(dat)
+        while m is not None:
+            literal = await self._read_literal(int(m.group("size")))
+            self._append_untagged(typ, (dat, literal))
+            # Read trailer, possibly containing another literal
+            dat = await self._read_line()
+            m = imaplib.Literal.match(dat)
+        self._append_untagged(typ, dat)
+        self._store_response_code(typ, dat)
+        return line
+
+    async def _wait(self, condition):
+        """Read responses until ``condition()`` is true.
+
+        Only one coroutine reads at a time, the others use the
+        responses it reads.
+        """
+        while not condition():
+            async with self.read_lock:
+                if condition():
+                    break
+                if self.broken:
+                    raise ImapError(_("Connection to IMAP server lost"))
+                try:
+                    await self._read_response()
+                except asyncio.CancelledError:
+                    # A response may have been partially read
+                    self.broken = True
+                    raise
+
+    async def send(self, name, *args, responses=(), literal=None):
+        """Send a command without waiting for its completion.
+
+        :param name: the command's name
+        :param responses: names of the untagged responses to collect
+        :param bytes literal: data sent as the last argument
+        :return: a ``PipelinedCommand`` instance
+        """
+        if self.broken:
+            raise ImapError(_("Connection to IMAP server lost"))
+        line = [name] + [arg for arg in args if arg is not None]
+        if literal is not None:
+            line.append("{%d}" % len(literal))
+        async with self.write_lock:
+            command = self._new_command(name, args, responses)
+            await self._write(b" ".join(
+                self._encode_arg(arg) for arg in [command.tag] + line
+            ) + b"\r\n")
+            if literal is not None:
+                self.continuation = None
+                await self._wait(
+                    lambda: self.continuation is not None or
+                    command.status is not None)
+                if command.status is None:
+                    await self._write(literal + b"\r\n")
+        return command
+
+    async def wait(self, command):
+        """Wait for the completion of a command.
+
+        :return: the command
+        """
+        await self._wait(lambda: command.status is not None)
+        return command
+
+    async def command(self, name, *args, **kwargs):
+        """Send a command and wait for its completion (see ``send``).
+
+        :return: a ``PipelinedCommand`` instance
+        """
+        return await self.wait(await self.send(name, *args, **kwargs))
+
+    async def idle(self, timeout, responses):
+        """Wait for untagged responses using IDLE (RFC 2177).
+
+        No other command can be sent while waiting.
+
+        :param timeout: maximum waiting time (in seconds)
+        :param responses: names of the responses ending the wait
+        :return: the IDLE command, once completed
+        """
+        loop = asyncio.get_running_loop()
+        async with self.write_lock:
+            command = self._new_command("IDLE", (), responses)
+            self.continuation = None
+            await self._write(command.tag.encode() + b" IDLE\r\n")
+            await self._wait(
+                lambda: self.continuation is not None or
+                command.status is not None)
+            if command.status is not None:
+                # Rejected
+                return command
+            deadline = loop.time() + timeout
+            while not any(name in self.untagged_responses
+                          for name in responses):
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                async with self.read_lock:
+                    try:
+                        # Cancelling readline() doesn't consume data
+                        line = await asyncio.wait_for(
+                            self._read_line(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                    await self._read_response(line)
+            await self._write(b"DONE\r\n")
+        return await self.wait(command)
+
+    async def close(self):
+        """Close the connection."""
+        self.broken = True
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+class AsyncIMAPconnector(BaseIMAPconnector):
+
+    """The asynchronous IMAPv4 connector.
+
+    Methods talking to the server are coroutines returning the same
+    structures as their ``IMAPconnector`` counterpart. Use ``connect``
+    to create a connector::
+
+      imapc = await AsyncIMAPconnector.connect(user, password)
+
+    Commands depending on the selected mailbox are serialized using
+    ``lock`` (not reentrant: methods holding it only call private
+    methods).
+    """
+
+    uid_commands = ("FETCH", "SORT", "STORE", "COPY", "SEARCH", "MOVE")
+
+    def __init__(self, user=None, conf=None):
+        super(AsyncIMAPconnector, self).__init__(user, conf)
+        self.lock = asyncio.Lock()
+        self.m = None
+        self.messages = []
+        self.messages_offset = 0
+
+    @classmethod
+    async def connect(cls, user, password, conf=None):
+        """Open a connection and log in.
+
+        :param dict conf: the webmail's global parameters (read from
+                          the database if not specified)
+        :return: an ``AsyncIMAPconnector`` instance
+        """
+        if conf is None:
+            conf = await sync_to_async(get_parameters)()
+        imapc = cls(user, conf)
+        await imapc.login(user, password)
+        try:
+            await imapc.load_namespaces()
+        except ImapError:
+            await imapc.m.close()
+            raise
+        return imapc
+
+    async def _command(self, name, *args, **kwargs):
+        """Send a command and wait for its completion.
+
+        Errors reported by the server are not checked (see
+        ``PipelinedCommand.check``).
+
+        :return: a ``PipelinedCommand`` instance
+        """
+        self.last_used = time.time()
+        try:
+            return await self.m.command(name, *args, **kwargs)
+        except ImapError:
+            self.broken = True
+            raise
+
+    async def _cmd(self, name, *args, decode_literals=True):
+        """IMAP command wrapper (see ``IMAPconnector._cmd``).
+
+        :param name: the command's name
+        :return: the untagged responses named after the command (or
+                 None), parsed for FETCH
+        """
+        if name in self.uid_commands or (name == "EXPUNGE" and args):
+            command = await self._command(
+                "UID", name, *args, responses=(name,))
+        else:
+            command = await self._command(name, *args, responses=(name,))
+        command.check()
+        data = command.responses.get(name)
+        if name == "FETCH":
+            return FetchResponseParser(decode_literals).parse(data or [])
+        return data
+
+    async def _uid_command(self, name, msgset, *args):
+        """Issue a UID command for a message set.
+
+        If the set is too long, it is split into several batches
+        whose commands are pipelined.
+        """
+        results = await asyncio.gather(*[
+            self._cmd(name, seqset, *args)
+            for seqset in build_sequence_sets(msgset)
+        ])
+        return results[-1] if results else None
+
+    async def _uid_fetch(self, msgset, query, decode_literals=True):
+        """Issue UID FETCH commands (pipelined) for a message set.
+
+        :return: a list of 2-uples (uid, data)
+        """
+        commands = await asyncio.gather(*[
+            self._command("UID", "FETCH", seqset, query, responses=("FETCH",))
+            for seqset in build_sequence_sets(msgset)
+        ])
+        result = []
+        for command in commands:
+            command.check()
+            parser = FetchResponseParser(decode_literals)
+            result += parser.iterparse(command.responses.get("FETCH", []))
+        return result
+
+    async def login(self, user, passwd):
+        """Connect to the server and issue a LOGIN command.
+
+        :param user: username
+        :param passwd: password
+        """
+        self.m = await AsyncIMAP4.connect(
+            self.address, self.port, self.conf["imap_secured"])
+        command = await self._command(
+            "LOGIN", smart_bytes(user), smart_bytes(self.m.quote(passwd)),
+            responses=("CAPABILITY",))
+        if not command.ok:
+            await self.m.close()
+            command.check()
+        if "CAPABILITY" in command.responses:
+            data = command.responses["CAPABILITY"]
+        else:
+            data = await self._cmd("CAPABILITY")
+        self.capabilities = data[0].decode().split()
+        if "QRESYNC" in self.capabilities:
+            # Required to receive VANISHED responses (RFC 7162)
+            await self._cmd("ENABLE", "QRESYNC")
+
+    async def logout(self):
+        """Logout from server."""
+        try:
+            await self._cmd("CHECK")
+        except ImapError:
+            pass
+        try:
+            await self._cmd("LOGOUT")
+        finally:
+            await self.m.close()
+            self.m = None
+
+    async def is_alive(self, max_idle=0):
+        """Check if the connection can still be used (see
+        ``IMAPconnector.is_alive``)."""
+        if self.m is None or self.broken:
+            return False
+        if time.time() - self.last_used <= max_idle:
+            return True
+        try:
+            await self._cmd("NOOP")
+        except ImapError:
+            return False
+        return True
+
+    async def load_namespaces(self):
+        """Load available namespaces."""
+        self._parse_namespaces(await self._cmd("NAMESPACE"))
+
+    async def select_mailbox(self, name, readonly=True, force=False):
+        """Issue a SELECT/EXAMINE command to the server."""
+        async with self.lock:
+            await self._select_mailbox(name, readonly, force)
+
+    async def _select_mailbox(self, name, readonly=True, force=False):
+        """Select a mailbox, ``lock`` must be held."""
+        if hasattr(self, "current_mailbox"):
+            if self.current_mailbox == name and not force:
+                return
+        command = await self._command(
+            "EXAMINE" if readonly else "SELECT", self._encode_mbox_name(name),
+            responses=self.mailbox_state_items)
+        command.check()
+        self.current_mailbox = name
+        self._set_mailbox_state(command.responses)
+        self.m.unsolicited.clear()
+
+    async def _refresh_mailbox_state(self, folder, *aws):
+        """Select a mailbox and make sure ``mailbox_state`` is up to
+        date, ``lock`` must be held.
+
+        See ``IMAPconnector._refresh_mailbox_state``.
+
+        :param aws: other awaitables run along with NOOP
+        """
+        selected = getattr(self, "current_mailbox", None) == folder
+        await self._select_mailbox(folder, readonly=False)
+        if not selected:
+            await asyncio.gather(*aws)
+            return
+        noop = (await asyncio.gather(
+            self._command("NOOP", responses=self.idle_responses), *aws))[0]
+        noop.check()
+        if noop.responses or self._pop_mailbox_changes():
+            await self._select_mailbox(folder, readonly=False, force=True)
+
+    def _pop_mailbox_changes(self):
+        """Tell if changes of the selected mailbox were announced by
+        responses no command collected."""
+        unsolicited = self.m.unsolicited
+        changed = any(
+            name in unsolicited for name in self.idle_responses + ("RECENT",))
+        unsolicited.clear()
+        return changed
+
+    async def idle(self, timeout):
+        """Wait for changes in the selected mailbox using IDLE.
+
+        :param timeout: maximum waiting time (in seconds)
+        :return: a dictionary (response name: list of values) containing
+                 the changes announced by the server, empty if nothing
+                 happened
+        """
+        async with self.lock:
+            self.last_used = time.time()
+            try:
+                command = await self.m.idle(timeout, self.idle_responses)
+            except ImapError:
+                self.broken = True
+                raise
+        command.check()
+        return command.responses
+
+    async def messages_count(self, **kwargs):
+        """Sort messages and return their number.
+
+        See ``IMAPconnector.messages_count``: changes of the mailbox
+        and the quota are retrieved at the same time.
+        """
+        criterion = self._get_sort_criterion(kwargs.get("order"))
+        folder = kwargs.get("folder")
+        start, stop = kwargs.get("start"), kwargs.get("stop")
+        async with self.lock:
+            await self._refresh_mailbox_state(folder, self.getquota(folder))
+            state = self._get_mailbox_state_key()
+            key = (criterion, [bytes(c) for c in self.criterions])
+            cached = None
+            if state is not None:
+                cached = await sync_to_async(cache.sorted_uids.get)(
+                    self.user, folder, state, *key)
+                if cached is None and start and stop:
+                    cached = await sync_to_async(cache.sorted_uids.get)(
+                        self.user, folder, state, *(key + (start, stop)))
+            if cached is not None:
+                count, self.messages, self.messages_offset = cached
+                return count
+            count = await self._sort_messages(criterion, start, stop)
+            if self.messages_offset or len(self.messages) != count:
+                key += (start, stop)
+            if state is not None:
+                await sync_to_async(cache.sorted_uids.set)(
+                    self.user, folder, state,
+                    (count, self.messages, self.messages_offset), *key)
+        return count
+
+    async def _sort_all(self, criterion, start=None, stop=None):
+        """Sort messages and retrieve the complete list of UIDs."""
+        data = await self._cmd(
+            "SORT", bytearray("(%s)" % criterion, "utf-8"),
+            b"UTF-8", b"(NOT DELETED)", *self.criterions)
+        self.messages = data[0].decode().split() if data else []
+        self.messages_offset = 0
+        return len(self.messages)
+
+    @capability('CONTEXT=SORT', '_sort_all')
+    async def _sort_messages(self, criterion, start=None, stop=None):
+        """Sort messages and retrieve a window of UIDs (RFC 5267)."""
+        if not start or not stop or start < 1:
+            return await self._sort_all(criterion)
+        command = await self._command(
+            "UID", "SORT", b"RETURN",
+            bytearray("(COUNT PARTIAL {}:{})".format(start, stop), "utf-8"),
+            bytearray("(%s)" % criterion, "utf-8"),
+            b"UTF-8", b"(NOT DELETED)", *self.criterions,
+            responses=("ESEARCH",))
+        command.check()
+        return self._load_sort_window(
+            command.responses.get("ESEARCH", [b""])[-1], start)
+
+    async def sync_mailbox(self, mbox, since=None, uids=None):
+        """Return the changes made to a mailbox since a given MODSEQ.
+
+        See ``IMAPconnector.sync_mailbox``.
+        """
+        if "CONDSTORE" not in self.capabilities:
+            return None
+        async with self.lock:
+            await self._refresh_mailbox_state(mbox)
+            result = self._new_sync_result(since, uids)
+            if result is None or result["modseq"] == since:
+                return result
+            commands = [
+                self._command("SEARCH", "UNSEEN", responses=("SEARCH",))]
+            if not result["full"] and uids:
+                msgset = build_sequence_sets(uids)[0]
+                commands.append(self._command(
+                    "UID", "FETCH", msgset, "(FLAGS)",
+                    self._get_changes_modifiers(since),
+                    responses=("FETCH", "VANISHED")))
+                if "QRESYNC" not in self.capabilities:
+                    commands.append(self._command(
+                        "UID", "SEARCH", "UID", msgset,
+                        responses=("SEARCH",)))
+            commands = await asyncio.gather(*commands)
+        self._load_sync_changes(result, uids, *commands)
+        return result
+
+    async def unseen_messages(self, mailbox):
+        """Return the number of unseen messages."""
+        return self._parse_unseen(await self._cmd(
+            "STATUS", self._encode_mbox_name(mailbox), "(UNSEEN)"))
+
+    async def unseen_counters(self, mailboxes):
+        """Return the number of unseen messages of several mailboxes
+
+        STATUS commands are pipelined.
+
+        :return: a dictionary (name: integer)
+        """
+        commands = await asyncio.gather(*[
+            self._command(
+                "STATUS", self._encode_mbox_name(name), "(UNSEEN)",
+                responses=("STATUS",))
+            for name in mailboxes
+        ])
+        result = {}
+        for name, command in zip(mailboxes, commands):
+            command.check()
+            result[name] = self._parse_unseen(command.responses.get("STATUS"))
+        return result
+
+    async def getquota(self, mailbox):
+        """Retrieve quota information from the server."""
+        if "QUOTA" not in self.capabilities:
+            self.quota_limit = self.quota_current = None
+            return
+        self._parse_quota(await self._command(
+            "GETQUOTAROOT", self._encode_mbox_name(mailbox),
+            responses=("QUOTAROOT", "QUOTA")))
+
+    async def _listmboxes_simple(self, topmailbox='INBOX', mailboxes=None,
+                                 until_mailbox=None, statuses=None):
+        if not mailboxes:
+            mailboxes = []
+        command = await self._command(
+            "LIST", '""', "*", responses=("LIST",))
+        command.check()
+        self._parse_simple_list_responses(
+            command.responses.get("LIST", []), mailboxes)
+
+    @capability('LIST-EXTENDED', '_listmboxes_simple')
+    async def _listmboxes(self, topmailbox, mailboxes, until_mailbox=None,
+                          statuses=None):
+        """Retrieve mailboxes list (see ``IMAPconnector._listmboxes``).
+
+        Sub-levels are retrieved concurrently.
+        """
+        with_status = (
+            statuses is not None and "LIST-STATUS" in self.capabilities)
+        command = await self._command(
+            "LIST", '""', self._get_list_pattern(topmailbox), "RETURN",
+            self._get_list_options(with_status),
+            responses=("LIST", "STATUS"))
+        command.check()
+        if with_status:
+            statuses.update(self._parse_status_responses(
+                command.responses.get("STATUS", [])))
+        parents = self._parse_list_responses(
+            command.responses.get("LIST", []), mailboxes)
+        await asyncio.gather(*[
+            self._listmboxes(
+                descr["name"], descr["sub"], until_mailbox, statuses)
+            for descr in parents
+            if until_mailbox and until_mailbox.startswith(descr["name"])
+        ])
+
+    async def getmboxes(
+            self, user, topmailbox='', until_mailbox=None,
+            unseen_messages=True):
+        """Returns a list of mailboxes for a particular user
+
+        See ``IMAPconnector.getmboxes``.
+        """
+        md_mailboxes = [] if topmailbox else self._get_special_mailboxes(user)
+        if until_mailbox:
+            name, parent = separate_mailbox(until_mailbox, self.hdelimiter)
+            if parent:
+                until_mailbox = parent
+        # Counters are returned by LIST when LIST-STATUS is supported
+        statuses = (
+            {} if unseen_messages and "LIST-STATUS" in self.capabilities
+            else None
+        )
+        await self._listmboxes(
+            topmailbox, md_mailboxes, until_mailbox, statuses=statuses)
+
+        if unseen_messages:
+            names = self._get_counted_mailboxes(md_mailboxes)
+            if statuses is not None:
+                # Non selectable mailboxes have no status
+                counters = dict(
+                    (name, statuses.get(name, {}).get("UNSEEN", 0))
+                    for mb, name in names)
+            else:
+                counters = await self.unseen_counters(
+                    [name for mb, name in names])
+            for mb, name in names:
+                if counters[name]:
+                    mb["unseen"] = counters[name]
+        return md_mailboxes
+
+    async def _add_flag(self, mbox, msgset, flag):
+        """Add flag to a messages set."""
+        async with self.lock:
+            await self._select_mailbox(mbox, False)
+            await self._uid_command("STORE", msgset, "+FLAGS", flag)
+
+    async def _remove_flag(self, mbox, msgset, flag):
+        """Remove flag from a message set."""
+        async with self.lock:
+            await self._select_mailbox(mbox, False)
+            await self._uid_command("STORE", msgset, "-FLAGS", flag)
+
+    async def mark_messages_unread(self, mbox, msgset):
+        await self._remove_flag(mbox, msgset, r'(\Seen)')
+
+    async def mark_messages_read(self, mbox, msgset):
+        await self._add_flag(mbox, msgset, r'(\Seen)')
+
+    async def mark_messages_flagged(self, mbox, msgset):
+        await self._add_flag(mbox, msgset, r'(\Flagged)')
+
+    async def mark_messages_unflagged(self, mbox, msgset):
+        await self._remove_flag(mbox, msgset, r'(\Flagged)')
+
+    async def msg_forwarded(self, mailbox, mailid):
+        await self._add_flag(mailbox, mailid, '($Forwarded)')
+
+    async def msg_answered(self, mailbox, mailid):
+        await self._add_flag(mailbox, mailid, r'(\Answered)')
+
+    async def push_mail(self, folder, msg):
+        """Append a message to a mailbox.
+
+        :return: a 2-uple (type, data), like ``imaplib.IMAP4.append``
+        """
+        now = imaplib.Time2Internaldate(time.time())
+        await sync_to_async(self._invalidate_mailboxes)(folder)
+        command = await self._command(
+            "APPEND", self._encode_mbox_name(folder), r'(\Seen)', now,
+            literal=bytes(msg))
+        return command.status, command.data
+
+    async def fetch(self, start, stop=None, mbox=None):
+        """Retrieve the messages displayed in a listing.
+
+        See ``IMAPconnector.fetch``: flags of cached messages and
+        summaries of the others are retrieved concurrently.
+        """
+        async with self.lock:
+            await self._select_mailbox(mbox, False)
+            uids = self._get_listing_uids(start, stop)
+            summaries = await sync_to_async(cache.headers.get_many)(
+                self.user, self.current_mailbox, self.uidvalidity, uids)
+            missing = [uid for uid in uids if uid not in summaries]
+            known = [uid for uid in uids if uid in summaries]
+            fetched, flags = await asyncio.gather(
+                self._uid_fetch(known, "(FLAGS)"),
+                self._fetch_summaries(missing, summaries))
+        # Headers, size and structure never change: only flags are
+        # retrieved for cached messages
+        for uid, msg_data in fetched:
+            flags[uid] = msg_data["FLAGS"]
+        return self._build_listing(uids, summaries, flags)
+
+    async def _fetch_summaries(self, uids, summaries):
+        """Retrieve the data displayed in listings for a list of messages.
+
+        See ``IMAPconnector._fetch_summaries``.
+
+        :return: the flags of each message (dict)
+        """
+        flags = {}
+        if not uids:
+            return flags
+        new_summaries = {}
+        unknown = []
+        for uid, msg_data in await self._uid_fetch(uids, self.summary_query):
+            flags[uid] = msg_data["FLAGS"]
+            new_summaries[uid] = self._make_summary(msg_data)
+            if new_summaries[uid]["attachments"] is None:
+                unknown.append(uid)
+        if unknown:
+            bstructs = await sync_to_async(cache.bodystructures.get_many)(
+                self.user, self.current_mailbox, self.uidvalidity, unknown)
+            missing = [uid for uid in unknown if uid not in bstructs]
+            if missing:
+                fetched = dict(
+                    (uid, BodyStructure(msg_data["BODYSTRUCTURE"]))
+                    for uid, msg_data in await self._uid_fetch(
+                        missing, "(BODYSTRUCTURE)"))
+                await sync_to_async(cache.bodystructures.set_many)(
+                    self.user, self.current_mailbox, self.uidvalidity,
+                    fetched)
+                bstructs.update(fetched)
+            for uid in unknown:
+                new_summaries[uid]["attachments"] = bool(
+                    bstructs[uid].has_attachments())
+        await sync_to_async(cache.headers.set_many)(
+            self.user, self.current_mailbox, self.uidvalidity, new_summaries)
+        summaries.update(new_summaries)
+        return flags
+
+    async def fetchmail(self, mbox, mailid, readonly=True,
+                        what="bodystructure"):
+        """Retrieve information about a specific message
+
+        See ``IMAPconnector.fetchmail``.
+        """
+        async with self.lock:
+            await self._select_mailbox(mbox, readonly)
+            cached = False
+            if what not in ("bodystructure", "source"):
+                cached = await sync_to_async(
+                    self._get_cached_bodystructure)(mailid) is not None
+            data = await self._cmd(
+                "FETCH", mailid,
+                self._get_fetchmail_query(what, readonly, cached))
+            msg = data[int(mailid)]
+            if "BODYSTRUCTURE" in msg:
+                await sync_to_async(self._cache_bodystructure)(
+                    mailid, msg["BODYSTRUCTURE"])
+        return msg
+
+    async def get_bodystructure(self, mbox, uid, fetch=True):
+        """Return the structure of a message.
+
+        The server is only asked if the structure is not cached.
+
+        :return: a ``BodyStructure`` instance (or None)
+        """
+        async with self.lock:
+            await self._select_mailbox(mbox, False)
+            bs = await sync_to_async(self._get_cached_bodystructure)(uid)
+            if bs is None and fetch:
+                data = await self._cmd("FETCH", uid, "(BODYSTRUCTURE)")
+                bs = await sync_to_async(self._cache_bodystructure)(
+                    uid, data[int(uid)]["BODYSTRUCTURE"])
+        return bs
+
+    async def fetchpart(self, uid, mbox, partnum):
+        """Retrieve a specific message part
+
+        :return: a 2uple (part definition, payload)
+        """
+        async with self.lock:
+            await self._select_mailbox(mbox, False)
+            bs = await sync_to_async(self._get_cached_bodystructure)(uid)
+            if bs is None:
+                data = await self._cmd(
+                    "FETCH", uid, "(BODYSTRUCTURE BODY[%s])" % partnum)
+                bs = await sync_to_async(self._cache_bodystructure)(
+                    uid, data[int(uid)]["BODYSTRUCTURE"])
+            else:
+                data = await self._cmd("FETCH", uid, "(BODY[%s])" % partnum)
+        attdef = bs.find_attachment(partnum)
+        return attdef, data[int(uid)]["BODY[%s]" % partnum]
+
+    async def fetchpart_range(self, uid, mbox, partnum, offset, length):
+        """Retrieve a slice of a message part (partial FETCH).
+
+        :return: bytes (empty once the end of the part is reached)
+        """
+        async with self.lock:
+            await self._select_mailbox(mbox, False)
+            data = await self._cmd(
+                "FETCH", uid,
+                "(BODY.PEEK[{}]<{}.{}>)".format(partnum, offset, length),
+                decode_literals=False)
+        msg = data.get(int(uid), {})
+        return msg.get("BODY[{}]<{}>".format(partnum, offset)) or b""
+
+    async def fetchparts(self, mbox, uid, pnums, headers=None,
+                         readonly=True):
+        """Retrieve several parts of a message using one FETCH command.
+
+        See ``IMAPconnector.fetchparts``.
+        """
+        query = self._get_parts_query(pnums, headers, readonly)
+        if query is None:
+            return None, {}
+        async with self.lock:
+            await self._select_mailbox(mbox, False)
+            data = await self._cmd(
+                "FETCH", uid, query, decode_literals=False)
+        return self._extract_parts(data.get(int(uid), {}), pnums, headers)
+
+
+class AsyncIMAPConnectionPool(object):
+
+    """Pool of asynchronous IMAP connections.
+
+    The policy is the one of ``imaputils.IMAPConnectionPool``
+    (connections grouped by user and handed to a single request at a
+    time, bounded number per user, idle connections closed after
+    ``imap_idle_timeout`` seconds) but waiting for a free connection
+    doesn't block a thread. Methods must be called from the event
+    loop the pool belongs to (see ``get_connections_pool``), no lock is
+    needed.
+    """
+
+    #: Maximum time (in seconds) a request waits for a free connection
+    checkout_timeout = 30
+
+    def __init__(self):
+        self._idle = {}
+        self._sizes = {}
+        self._generations = {}
+        self._waiters = []
+        self._tasks = set()
+
+    async def _close(self, imapc):
+        """Logout from server, ignoring errors."""
+        if imapc.m is None:
+            return
+        try:
+            await imapc.logout()
+        except (ImapError, OSError):
+            pass
+
+    def _close_later(self, connections):
+        """Close connections in background tasks."""
+        for imapc in connections:
+            task = asyncio.ensure_future(self._close(imapc))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _notify(self):
+        """Wake up the requests waiting for a connection."""
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters = []
+
+    def _release_slot(self, user):
+        """Forget about a connection."""
+        self._sizes[user] -= 1
+        if not self._sizes[user]:
+            del self._sizes[user]
+        self._notify()
+
+    def _pop_expired(self, ttl):
+        """Remove idle connections unused for more than ``ttl`` seconds.
+
+        :return: the list of removed connections
+        """
+        limit = time.time() - ttl
+        expired = []
+        for user in list(self._idle.keys()):
+            alive = []
+            for imapc in self._idle[user]:
+                if imapc.last_used < limit:
+                    expired.append(imapc)
+                    self._release_slot(user)
+                else:
+                    alive.append(imapc)
+            if alive:
+                self._idle[user] = alive
+            else:
+                del self._idle[user]
+        return expired
+
+    async def checkout(self, user, password, conf, timeout=None,
+                       keep_free=0):
+        """Get an exclusive connection for ``user``.
+
+        See ``IMAPConnectionPool.checkout``.
+
+        :param str user: the username
+        :param str password: the password (in clear)
+        :param dict conf: the webmail's global parameters
+        :param int timeout: maximum waiting time in seconds (defaults
+                            to ``checkout_timeout``)
+        :param int keep_free: number of connections that must remain
+                              available for other requests
+        :return: an ``AsyncIMAPconnector`` instance
+        """
+        loop = asyncio.get_running_loop()
+        if timeout is None:
+            timeout = self.checkout_timeout
+        deadline = loop.time() + timeout
+        self._close_later(self._pop_expired(conf["imap_idle_timeout"]))
+        while True:
+            idle = self._idle.get(user)
+            busy = self._sizes.get(user, 0) - len(idle or [])
+            if busy < conf["imap_max_connections"] - keep_free:
+                if not idle:
+                    break
+                imapc = idle.pop()
+                if await imapc.is_alive(conf["imap_check_interval"]):
+                    return imapc
+                # Other idle connections of this user are likely dead
+                # too (see ``IMAPConnectionPool.checkout``)
+                stale = [imapc] + self._idle.pop(user, [])
+                for oldimapc in stale:
+                    self._release_slot(user)
+                self._close_later(stale)
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise ImapError(_("Too many simultaneous IMAP connections"))
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                pass
+        self._sizes[user] = self._sizes.get(user, 0) + 1
+        generation = self._generations.get(user, 0)
+        try:
+            imapc = await AsyncIMAPconnector.connect(user, password, conf)
+        except BaseException:
+            self._release_slot(user)
+            raise
+        imapc.pool_generation = generation
+        return imapc
+
+    async def checkin(self, imapc):
+        """Give a connection back to the pool.
+
+        Broken connections (and the ones opened before the last call
+        to ``clear``) are closed.
+
+        :param imapc: an ``AsyncIMAPconnector`` instance
+        """
+        user = imapc.user
+        imapc.reset_state()
+        discard = (
+            imapc.m is None or imapc.broken or
+            getattr(imapc, "pool_generation", 0) !=
+            self._generations.get(user, 0)
+        )
+        if not discard:
+            self._idle.setdefault(user, []).append(imapc)
+            self._notify()
+            return
+        self._release_slot(user)
+        await self._close(imapc)
+
+    def clear(self, user=None):
+        """Close connections of a user (or of every user).
+
+        Idle connections are closed in background, connections in use
+        are closed when given back.
+
+        :param str user: a username
+        """
+        users = [user] if user is not None else list(self._sizes.keys())
+        idle = []
+        for name in users:
+            self._generations[name] = self._generations.get(name, 0) + 1
+            for imapc in self._idle.pop(name, []):
+                idle.append(imapc)
+                self._release_slot(name)
+        self._close_later(idle)
+
+
+_pools = weakref.WeakKeyDictionary()
+
+
+def get_connections_pool():
+    """Return the connections pool of the running event loop.
+
+    Connections can't be shared between event loops: one pool exists
+    per loop.
+    """
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        pool = _pools[loop] = AsyncIMAPConnectionPool()
+    return pool
+
+
+def clear_connections(user=None):
+    """Close connections of a user in every pool.
+
+    Can be called from any thread.
+
+    :param str user: a username
+    """
+    for loop, pool in list(_pools.items()):
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(pool.clear, user)
+
+
+async def get_imapconnector(request):
+    """Asynchronous version of ``imaputils.get_imapconnector``.
+
+    The connector is checked out from the pool of the running event
+    loop the first time this function is called for a request. Next
+    calls return the same object until ``release_imapconnector`` is
+    called.
+
+    :param request: a ``Request`` object
+    :return: an ``AsyncIMAPconnector`` instance
+    """
+    imapc = getattr(request, "_async_imapconnector", None)
+    if imapc is not None:
+        return imapc
+    conf = await sync_to_async(get_parameters)()
+    password = await sync_to_async(get_password)(request)
+    imapc = await get_connections_pool().checkout(
+        request.user.username, password, conf)
+    request._async_imapconnector = imapc
+    return imapc
+
+
+def detach_imapconnector(request):
+    """Take the connector of a request away from it.
+
+    See ``imaputils.detach_imapconnector``.
+
+    :return: an ``AsyncIMAPconnector`` instance (or None)
+    """
+    return request.__dict__.pop("_async_imapconnector", None)
+
+
+async def release_imapconnector(request):
+    """Give the connector used by a request back to the pool."""
+    imapc = detach_imapconnector(request)
+    if imapc is not None:
+        await get_connections_pool().checkin(imapc)
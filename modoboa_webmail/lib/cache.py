@@ -0,0 +1,160 @@
+"""Cache for data retrieved from the IMAP server.
+
+For a given mailbox, a message UID always designates the same message
+as long as the UIDVALIDITY value of the mailbox doesn't change (RFC
+3501, section 2.3.1.1). Data such as the BODYSTRUCTURE of a message can
+therefore be kept for a long time, using (user, mailbox, UIDVALIDITY,
+UID) as key (see ``MessageCache``). The headers displayed in
+listings are stored the same way, so only flags need to be retrieved
+when a page is displayed again. Other data, such as the sorted
+list of messages of a mailbox, is validated using the state of the
+mailbox (see ``MailboxCache``).
+
+Entries are stored using the Django cache framework: a dedicated
+cache can be declared under the ``webmail`` alias in the ``CACHES``
+setting, otherwise the default one is used. Size limits and eviction
+(LRU) are left to the cache backend (``MAX_ENTRIES`` for the local
+memory backend, ``maxmemory-policy`` for Redis, etc.).
+"""
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+
+#: Default lifetime of cached entries (in seconds)
+DEFAULT_TIMEOUT = 7 * 24 * 3600
+
+
+def get_cache():
+    """Return the cache backend to use."""
+    if "webmail" in settings.CACHES:
+        return caches["webmail"]
+    return caches["default"]
+
+
+class MessageCache(object):
+    """Store immutable message data.
+
+    :param str name: what is stored (used to build keys)
+    :param int timeout: lifetime of entries (in seconds)
+    """
+
+    def __init__(self, name, timeout=DEFAULT_TIMEOUT):
+        self.name = name
+        self.timeout = timeout
+
+    def make_key(self, user, mailbox, uidvalidity, uid):
+        """Build a cache key.
+
+        Mailbox names can contain any character so the key is hashed.
+        """
+        key = u"{}\x00{}\x00{}\x00{}".format(
+            user, mailbox or "INBOX", uidvalidity, uid)
+        return "webmail:{}:{}".format(
+            self.name, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def get(self, user, mailbox, uidvalidity, uid):
+        """Return a cached value (or None)."""
+        if uidvalidity is None:
+            return None
+        return get_cache().get(self.make_key(user, mailbox, uidvalidity, uid))
+
+    def set(self, user, mailbox, uidvalidity, uid, value):
+        """Store a value."""
+        if uidvalidity is None:
+            return
+        get_cache().set(
+            self.make_key(user, mailbox, uidvalidity, uid), value,
+            self.timeout)
+
+    def get_many(self, user, mailbox, uidvalidity, uids):
+        """Return cached values for a list of UIDs.
+
+        :return: a dictionary (uid: value), missing UIDs are not included
+        """
+        if uidvalidity is None:
+            return {}
+        keys = dict(
+            (self.make_key(user, mailbox, uidvalidity, uid), uid)
+            for uid in uids)
+        values = get_cache().get_many(list(keys.keys()))
+        return dict((keys[key], value) for key, value in values.items())
+
+    def set_many(self, user, mailbox, uidvalidity, values):
+        """Store several values at once.
+
+        :param dict values: uid: value
+        """
+        if uidvalidity is None or not values:
+            return
+        get_cache().set_many(dict(
+            (self.make_key(user, mailbox, uidvalidity, uid), value)
+            for uid, value in values.items()
+        ), self.timeout)
+
+
+class MailboxCache(object):
+    """Store data depending on the state of a mailbox.
+
+    Each entry is stored with the state of the mailbox (as returned by
+    the server) it was computed for and is ignored as soon as this
+    state changes. Local modifications can also invalidate all the
+    entries of a mailbox (see ``invalidate``).
+
+    :param str name: what is stored (used to build keys)
+    :param int timeout: lifetime of entries (in seconds)
+    """
+
+    def __init__(self, name, timeout=DEFAULT_TIMEOUT):
+        self.name = name
+        self.timeout = timeout
+
+    def make_key(self, user, mailbox, *args):
+        """Build a cache key."""
+        key = u"\x00".join(
+            [user, mailbox or "INBOX"] + [repr(arg) for arg in args])
+        return "webmail:{}:{}".format(
+            self.name, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def _get_generation(self, user, mailbox):
+        """Return the generation of a mailbox's entries."""
+        return get_cache().get(self.make_key(user, mailbox, "generation"), 0)
+
+    def get(self, user, mailbox, state, *args):
+        """Return a cached value if still valid (or None).
+
+        :param state: current state of the mailbox
+        """
+        entry = get_cache().get(self.make_key(user, mailbox, *args))
+        if entry is None:
+            return None
+        if entry[0] != (state, self._get_generation(user, mailbox)):
+            return None
+        return entry[1]
+
+    def set(self, user, mailbox, state, value, *args):
+        """Store a value.
+
+        :param state: state of the mailbox ``value`` was computed for
+        """
+        get_cache().set(
+            self.make_key(user, mailbox, *args),
+            ((state, self._get_generation(user, mailbox)), value),
+            self.timeout)
+
+    def invalidate(self, user, mailbox):
+        """Invalidate all the entries of a mailbox."""
+        key = self.make_key(user, mailbox, "generation")
+        backend = get_cache()
+        if backend.add(key, 1, self.timeout):
+            return
+        try:
+            backend.incr(key)
+        except ValueError:
+            backend.set(key, 1, self.timeout)
+
+
+bodystructures = MessageCache("bodystructure.v2")
+headers = MessageCache("headers")
+sorted_uids = MailboxCache("sort")
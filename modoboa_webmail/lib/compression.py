@@ -0,0 +1,52 @@
+"""Compression of HTTP responses."""
+
+from fnmatch import fnmatch
+
+from django.middleware.gzip import GZipMiddleware
+from django.utils.decorators import decorator_from_middleware
+
+from modoboa.parameters import tools as param_tools
+
+
+class CompressionPolicyMiddleware(GZipMiddleware):
+    """Compress responses according to the webmail settings.
+
+    Only complete (200) responses whose content type is considered as
+    compressible are compressed. Responses smaller than the configured
+    threshold are left untouched.
+    """
+
+    def is_compressible(self, response):
+        """Check if response must be compressed."""
+        conf = dict(param_tools.get_global_parameters("modoboa_webmail"))
+        if not conf["compression_enabled"] or response.status_code != 200:
+            return False
+        ctype = response.get("Content-Type", "").split(";")[0]
+        ctype = ctype.strip().lower()
+        patterns = [
+            pattern.strip().lower()
+            for pattern in conf["compression_types"].split(",")
+            if pattern.strip()
+        ]
+        if not any(fnmatch(ctype, pattern) for pattern in patterns):
+            return False
+        if response.streaming:
+            size = response.get("Content-Length")
+        else:
+            size = len(response.content)
+        if size is not None and int(size) < conf["compression_min_size"]:
+            return False
+        return True
+
+    def process_response(self, request, response):
+        if not self.is_compressible(response):
+            return response
+        response = super(CompressionPolicyMiddleware, self).process_response(
+            request, response)
+        if response.has_header("Content-Encoding"):
+            # Ranges would apply to the compressed representation
+            del response["Accept-Ranges"]
+        return response
+
+
+compress_page = decorator_from_middleware(CompressionPolicyMiddleware)
@@ -6,8 +6,9 @@ The ``imaplib`` module doesn't parse IMAP responses, it returns raw
 values. Since Modoboa relies on BODYSTRUCTURE attributes to display
 messages (we don't want to overload the server), a parser is required.
 
-Python 2/3 compatibility note: this parser excepts bytes objects when
-run with Python3 and str (not unicode) ones with Python2.
+The parser works on the bytes returned by ``imaplib``. Literals (such
+as message parts) are not copied: they are returned as is, or decoded
+to str if asked to (see ``decode_literal``).
 """
 
 from __future__ import print_function
@@ -15,7 +16,6 @@ from __future__ import print_function
 import re
 
 import chardet
-import six
 
 
 class ParseError(Exception):
@@ -23,53 +23,30 @@ class ParseError(Exception):
     pass
 
 
-class Lexer(object):
-    """The lexical analysis part.
+def decode_literal(value, charset=None):
+    """Decode a value received from the server.
 
-    This class provides a simple way to define tokens (with patterns)
-    to be detected. Patterns are provided using a list of 2-uple. Each
-    2-uple consists of a token name and an associated pattern.
+    The given charset (if any) is tried first, then UTF-8. If both
+    fail, the encoding is guessed.
 
-    Example: [("left_bracket", r'\['),]
+    :param bytes value: the value to decode
+    :param str charset: the charset declared for this value
+    :return: a str
     """
-
-    def __init__(self, definitions):
-        self.definitions = definitions
-        parts = []
-        for name, part in definitions:
-            parts.append(r"(?P<%s>%s)" % (name, part))
-        self.regexpString = "|".join(parts)
-        self.regexp = re.compile(self.regexpString, re.MULTILINE)
-        self.wsregexp = re.compile(r"\s+", re.M)
-
-    def curlineno(self):
-        """Return the current line number"""
-        return self.text[:self.pos].count("\n") + 1
-
-    def scan(self, text):
-        """Analyze some data.
-
-        Analyse the passed content. Each time a token is recognized, a
-        2-uple containing its name and the parsed value is raised
-        (using yield).
-
-        :param text: a string containing the data to parse
-        :raises: ParseError
-        """
-        self.pos = 0
-        self.text = text
-        while self.pos < len(text):
-            m = self.wsregexp.match(text, self.pos)
-            if m is not None:
-                self.pos = m.end()
-                continue
-
-            m = self.regexp.match(text, self.pos)
-            if m is None:
-                raise ParseError("unknown token {}".format(text[self.pos:]))
-
-            self.pos = m.end()
-            yield (m.lastgroup, m.group(m.lastgroup))
+    for encoding in (charset, "utf-8"):
+        if encoding is None:
+            continue
+        try:
+            return value.decode(encoding)
+        except (UnicodeDecodeError, LookupError):
+            pass
+    try:
+        result = chardet.detect(value)
+    except UnicodeDecodeError:
+        raise RuntimeError("Can't find string encoding")
+    if result["encoding"] is None:
+        raise RuntimeError("Can't find string encoding")
+    return value.decode(result["encoding"])
 
 
 class FetchResponseParser(object):
@@ -78,43 +55,99 @@ class FetchResponseParser(object):
     By *token*, I mean: *literal*, *quoted* or anything else until the
     next ' ' or ')' character (number, NIL and others should fall into
     this last category).
+
+    :param bool decode_literals: return literals as str (default) or
+                                 as bytes
     """
 
-    rules = [
-        ("left_parenthesis", r'\('),
-        ("right_parenthesis", r'\)'),
-        ("string", r'"([^"\\]|\\.)*"'),
-        ("nil", r'NIL'),
-        ("data_item",
-         r"(?P<name>[A-Z][A-Z\.0-9]+)"
-         r"(?P<section>\[.*\])?(?P<origin_octet>\<\d+\>)?"),
-        ("number", r'[0-9]+'),
-        ("literal_marker", r'{\d+}'),
-        ("flag", r'(\\|\$)?[a-zA-Z0-9\-_]+'),
-    ]
-
-    def __init__(self):
+    whitespaces = frozenset(b" \t\r\n")
+    string_pattern = re.compile(br'"(?:[^"\\]|\\.)*"', re.S)
+    literal_pattern = re.compile(br"\{\d+\}")
+    atom_pattern = re.compile(br'[^\s()"{\[]+(?:\[[^\]]*\])?(?:<\d+>)?')
+    data_item_pattern = re.compile(
+        r"[A-Z][A-Z\.0-9]+(?:\[[^\]]*\])?(?:<\d+>)?$")
+
+    def __init__(self, decode_literals=True):
         """Constructor."""
-        self.lexer = Lexer(self.rules)
+        self.decode_literals = decode_literals
         self.__reset_parser()
 
     def __reset_parser(self):
         """Reset parser states."""
         self.result = {}
         self.__current_message = {}
-        self.__next_literal_len = 0
+        self.__next_literal_len = None
         self.__cur_data_item = None
         self.__args_parsing_func = None
         self.__expected = None
         self.__depth = 0
         self.__bs_stack = []
+        self.__completed = []
 
     def set_expected(self, *args):
         """Indicate next expected token types."""
         self.__expected = args
 
+    def scan(self, chunk):
+        """Split a chunk into tokens.
+
+        Each time a token is recognized, a 2-uple containing its type
+        and its value is generated.
+
+        :param bytes chunk: the data to parse
+        :raises: ParseError
+        """
+        pos = 0
+        end = len(chunk)
+        whitespaces = self.whitespaces
+        while pos < end:
+            char = chunk[pos]
+            if char in whitespaces:
+                pos += 1
+                continue
+            if char == 40:  # (
+                pos += 1
+                yield ("left_parenthesis", "(")
+                continue
+            if char == 41:  # )
+                pos += 1
+                yield ("right_parenthesis", ")")
+                continue
+            if char == 34:  # "
+                m = self.string_pattern.match(chunk, pos)
+                ttype = "string"
+            elif char == 123:  # {
+                m = self.literal_pattern.match(chunk, pos)
+                ttype = "literal_marker"
+            else:
+                m = self.atom_pattern.match(chunk, pos)
+                ttype = None
+            if m is None:
+                raise ParseError(
+                    "unknown token {}".format(chunk[pos:pos + 80]))
+            pos = m.end()
+            tvalue = m.group(0)
+            try:
+                tvalue = tvalue.decode("ascii")
+            except UnicodeDecodeError:
+                tvalue = decode_literal(tvalue)
+            if ttype is None:
+                if tvalue == "NIL":
+                    ttype = "nil"
+                elif tvalue.isdigit():
+                    ttype = "number"
+                elif self.data_item_pattern.match(tvalue):
+                    ttype = "data_item"
+                else:
+                    ttype = "flag"
+            yield (ttype, tvalue)
+
     def __default_args_parser(self, ttype, tvalue):
         """Default arguments parser."""
+        if ttype == "string":
+            tvalue = tvalue[1:-1]
+        elif ttype == "nil":
+            tvalue = None
         self.__current_message[self.__cur_data_item] = tvalue
         self.__args_parsing_func = None
 
@@ -123,9 +156,25 @@ class FetchResponseParser(object):
         if ttype == "left_parenthesis":
             self.__current_message[self.__cur_data_item] = []
             self.__depth += 1
-        elif ttype == "flag":
+        elif ttype in ("flag", "data_item"):
+            # Keywords can look like data items
             self.__current_message[self.__cur_data_item].append(tvalue)
-            self.set_expected("flag", "right_parenthesis")
+            self.set_expected("flag", "data_item", "right_parenthesis")
+        elif ttype == "right_parenthesis":
+            self.__args_parsing_func = None
+            self.__depth -= 1
+        else:
+            raise ParseError(
+                "Unexpected token found: {}".format(ttype))
+
+    def __modseq_args_parser(self, ttype, tvalue):
+        """MODSEQ arguments parser (RFC 7162)."""
+        if ttype == "left_parenthesis":
+            self.__depth += 1
+            self.set_expected("number")
+        elif ttype == "number":
+            self.__current_message[self.__cur_data_item] = int(tvalue)
+            self.set_expected("right_parenthesis")
         elif ttype == "right_parenthesis":
             self.__args_parsing_func = None
             self.__depth -= 1
@@ -133,43 +182,53 @@ class FetchResponseParser(object):
             raise ParseError(
                 "Unexpected token found: {}".format(ttype))
 
-    def __set_part_numbers(self, bs, prefix=""):
-        """Set part numbers."""
-        cpt = 1
-        for mp in bs:
-            if isinstance(mp, list):
-                self.__set_part_numbers(mp, prefix)
-            elif isinstance(mp, dict):
-                if isinstance(mp["struct"][0], list):
-                    nprefix = "{}{}.".format(prefix, cpt)
-                    self.__set_part_numbers(mp["struct"][0], nprefix)
-                mp["partnum"] = "{}{}".format(prefix, cpt)
-                cpt += 1
+    def __set_part_numbers(self, bs):
+        """Set part numbers.
+
+        Nested parts are handled iteratively.
+        """
+        stack = [(bs, "")]
+        while stack:
+            items, prefix = stack.pop()
+            cpt = 1
+            for mp in items:
+                if isinstance(mp, list):
+                    stack.append((mp, prefix))
+                elif isinstance(mp, dict):
+                    if isinstance(mp["struct"][0], list):
+                        stack.append((
+                            mp["struct"][0], "{}{}.".format(prefix, cpt)))
+                    mp["partnum"] = "{}{}".format(prefix, cpt)
+                    cpt += 1
 
     def __bstruct_args_parser(self, ttype, tvalue):
-        """BODYSTRUCTURE arguments parser."""
+        """BODYSTRUCTURE arguments parser.
+
+        The top of the stack is its last element.
+        """
+        stack = self.__bs_stack
         if ttype == "left_parenthesis":
-            self.__bs_stack = [[]] + self.__bs_stack
+            stack.append([])
             return
         if ttype == "right_parenthesis":
-            if len(self.__bs_stack) > 1:
-                part = self.__bs_stack.pop(0)
+            if len(stack) > 1:
+                part = stack.pop()
                 # Check if we are parsing a list of mime part or a
                 # list or arguments.
                 condition = (
-                    len(self.__bs_stack[0]) > 0 and
-                    not isinstance(self.__bs_stack[0][0], dict))
+                    len(stack[-1]) > 0 and
+                    not isinstance(stack[-1][0], dict))
                 if condition:
-                    self.__bs_stack[0].append(part)
+                    stack[-1].append(part)
                 else:
-                    self.__bs_stack[0].append({"struct": part})
+                    stack[-1].append({"struct": part})
             else:
                 # End of BODYSTRUCTURE
-                if not isinstance(self.__bs_stack[0][0], list):
+                if not isinstance(stack[0][0], list):
                     # Special case for non multipart structures
-                    self.__bs_stack[0] = {"struct": self.__bs_stack[0]}
-                self.__set_part_numbers(self.__bs_stack)
-                self.__current_message[self.__cur_data_item] = self.__bs_stack
+                    stack[0] = {"struct": stack[0]}
+                self.__set_part_numbers(stack)
+                self.__current_message[self.__cur_data_item] = stack
                 self.__bs_stack = []
                 self.__args_parsing_func = None
             return
@@ -178,14 +237,14 @@ class FetchResponseParser(object):
             # Check if previous element was a mime part. If so, we are
             # dealing with a 'multipart' mime part...
             condition = (
-                len(self.__bs_stack[0]) and
-                isinstance(self.__bs_stack[0][-1], dict))
+                len(stack[-1]) and
+                isinstance(stack[-1][-1], dict))
             if condition:
-                self.__bs_stack[0] = [self.__bs_stack[0]] + [tvalue]
+                stack[-1] = [stack[-1], tvalue]
                 return
         elif ttype == "number":
             tvalue = int(tvalue)
-        self.__bs_stack[0].append(tvalue)
+        stack[-1].append(tvalue)
 
     def __parse_data_item(self, ttype, tvalue):
         """Find next data item."""
@@ -197,6 +256,9 @@ class FetchResponseParser(object):
             elif tvalue == "FLAGS":
                 self.set_expected("left_parenthesis")
                 self.__args_parsing_func = self.__flags_args_parser
+            elif tvalue == "MODSEQ":
+                self.set_expected("left_parenthesis")
+                self.__args_parsing_func = self.__modseq_args_parser
             else:
                 self.__args_parsing_func = self.__default_args_parser
             return
@@ -207,49 +269,42 @@ class FetchResponseParser(object):
             # scope (see sample 1 in tests). For now, we just ignore
             # them but we need a better solution!
             if "UID" in self.__current_message:
-                self.result[int(self.__current_message.pop("UID"))] = (
-                    self.__current_message)
+                self.__completed.append((
+                    int(self.__current_message.pop("UID")),
+                    self.__current_message))
             self.__current_message = {}
             return
         raise ParseError(
             "unexpected {} found while looking for data_item near {}"
             .format(ttype, tvalue))
 
-    def __convert_to_str(self, chunk):
-        """Convert chunk to str and guess encoding."""
-        condition = (
-            six.PY2 and isinstance(chunk, six.text_type) or
-            six.PY3 and isinstance(chunk, six.binary_type)
-        )
-        if not condition:
-            return chunk
-        try:
-            chunk = chunk.decode("utf-8")
-        except UnicodeDecodeError:
-            pass
-        else:
-            return chunk
-        try:
-            result = chardet.detect(chunk)
-        except UnicodeDecodeError:
-            raise RuntimeError("Can't find string encoding")
-        return chunk.decode(result["encoding"])
+    def __store_literal(self, literal):
+        """Store a literal value."""
+        if self.__cur_data_item == "BODYSTRUCTURE":
+            # Part of the structure, always decoded
+            self.__args_parsing_func("literal", decode_literal(literal))
+            return
+        if self.decode_literals:
+            literal = decode_literal(literal)
+        self.__current_message[self.__cur_data_item] = literal
+        self.__args_parsing_func = None
 
     def parse_chunk(self, chunk):
         """Parse chunk."""
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        if self.__next_literal_len is not None:
+            length = self.__next_literal_len
+            self.__next_literal_len = None
+            if len(chunk) == length:
+                # Usual case: the literal is a chunk on its own
+                self.__store_literal(chunk)
+                return
+            self.__store_literal(chunk[:length])
+            chunk = chunk[length:]
         if not chunk:
             return
-        chunk = self.__convert_to_str(chunk)
-        if self.__next_literal_len:
-            literal = chunk[:self.__next_literal_len]
-            chunk = chunk[self.__next_literal_len:]
-            self.__next_literal_len = 0
-            if self.__cur_data_item != "BODYSTRUCTURE":
-                self.__current_message[self.__cur_data_item] = literal
-                self.__args_parsing_func = None
-            else:
-                self.__args_parsing_func("literal", literal)
-        for ttype, tvalue in self.lexer.scan(chunk):
+        for ttype, tvalue in self.scan(chunk):
             if self.__expected is not None:
                 if ttype not in self.__expected:
                     raise ParseError(
@@ -271,13 +326,38 @@ class FetchResponseParser(object):
                 continue
             self.__args_parsing_func(ttype, tvalue)
 
+    def feed(self, data):
+        """Parse a part of a response.
+
+        :param data: an item of the list returned by ``imaplib`` (bytes
+                     or tuple)
+        :return: the list of messages completed by this item, as
+                 2-uples (uid, data)
+        """
+        if isinstance(data, tuple):
+            for chunk in data:
+                self.parse_chunk(chunk)
+        else:
+            self.parse_chunk(data)
+        completed, self.__completed = self.__completed, []
+        return completed
+
+    def iterparse(self, data):
+        """Parse received data, one message at a time.
+
+        Messages are generated as 2-uples (uid, data) as soon as they
+        are complete. They are not stored in ``result``.
+
+        :param data: an iterable returning items of the list returned
+                     by ``imaplib``
+        """
+        self.__reset_parser()
+        for item in data:
+            for message in self.feed(item):
+                yield message
+
     def parse(self, data):
         """Parse received data."""
-        self.__reset_parser()
-        for chunk in data:
-            if isinstance(chunk, tuple):
-                for schunk in chunk:
-                    self.parse_chunk(schunk)
-            else:
-                self.parse_chunk(chunk)
-        return self.result
+        result = dict(self.iterparse(data))
+        self.result = result
+        return result
@@ -1,31 +1,28 @@
 """
 Set of classes to manipulate/display emails inside the webmail.
 """
-import os
 import re
 import email
 
-import chardet
 import six
 
-from django.conf import settings
-from django.core.files.base import ContentFile
-from django.core.files.storage import default_storage
+from asgiref.sync import sync_to_async
+
 from django.urls import reverse
 from django.utils.encoding import smart_str
 from django.utils.html import conditional_escape
+from django.utils.http import urlencode
 from django.utils.translation import gettext as _
 
 from modoboa.core.extensions import exts_pool
 from modoboa.lib import u2u_decode
 from modoboa.lib.email_utils import Email, EmailAddress
+from modoboa.parameters import tools as param_tools
 
-from . import imapheader
-from .attachments import get_storage_path
-from .imaputils import (
-    get_imapconnector, BodyStructure
-)
-from .utils import decode_payload
+from . import imapheader, spool
+from .fetch_parser import decode_literal
+from .imaputils import get_imapconnector
+from .utils import decode_payload, parallel_map
 
 
 class ImapEmail(Email):
@@ -43,10 +40,14 @@ class ImapEmail(Email):
     ]
 
     def __init__(self, request, *args, **kwargs):
+        imapc = kwargs.pop("imapc", None)
         super(ImapEmail, self).__init__(*args, **kwargs)
         self.request = request
-        self.imapc = get_imapconnector(request)
+        self.imapc = imapc if imapc is not None else \
+            get_imapconnector(request)
         self.mbox, self.mailid = self.mailid.split(":")
+        self.bs = None
+        self._parts = {}
 
     def _insert_contact_links(self, addresses):
         """Insert 'add to address book' links."""
@@ -62,14 +63,36 @@ class ImapEmail(Email):
             result.append(address)
         return result
 
-    def fetch_headers(self, raw_addresses=False):
-        """Fetch message headers from server."""
-        msg = self.imapc.fetchmail(
-            self.mbox, self.mailid, readonly=False,
-            what=" ".join(self.headers_as_list)
-        )
-        headers = msg["BODY[HEADER.FIELDS ({})]".format(self.headers_as_text)]
-        self.fetch_body_structure(msg)
+    def fetch_headers(self, raw_addresses=False, with_body=False):
+        """Fetch message headers from server.
+
+        :param bool with_body: the body is going to be displayed too. If
+                               the message structure is already known,
+                               the parts needed to display it are
+                               retrieved using the same FETCH command.
+        """
+        bs = None
+        if with_body:
+            bs = self.imapc.get_bodystructure(
+                self.mbox, self.mailid, fetch=False)
+        if bs is None:
+            msg = self.imapc.fetchmail(
+                self.mbox, self.mailid, readonly=False,
+                what=" ".join(self.headers_as_list)
+            )
+            headers = msg[
+                "BODY[HEADER.FIELDS ({})]".format(self.headers_as_text)]
+            self.fetch_body_structure()
+        else:
+            self.fetch_body_structure(bs)
+            headers, self._parts = self.imapc.fetchparts(
+                self.mbox, self.mailid, self._get_display_parts(),
+                headers=self.headers_as_text, readonly=False
+            )
+        self._parse_headers(headers, raw_addresses)
+
+    def _parse_headers(self, headers, raw_addresses=False):
+        """Decode the headers to display."""
         msg = email.message_from_string(headers)
         contacts_plugin_installed = exts_pool.get_extension("modoboa_contacts")
         headers_with_address = ("From", "To", "Cc", "Reply-To")
@@ -110,13 +133,16 @@ class ImapEmail(Email):
             pass
         return hdrvalue
 
-    def fetch_body_structure(self, msg=None):
-        """Fetch BODYSTRUCTURE for email."""
-        if msg is None:
-            msg = self.imapc.fetchmail(
-                self.mbox, self.mailid, readonly=False
-            )
-        self.bs = BodyStructure(msg["BODYSTRUCTURE"])
+    def fetch_body_structure(self, bs=None):
+        """Fetch BODYSTRUCTURE for email.
+
+        :param bs: an already known ``BodyStructure`` instance
+        """
+        if self.bs is not None:
+            return
+        if bs is None:
+            bs = self.imapc.get_bodystructure(self.mbox, self.mailid)
+        self.bs = bs
         self._find_attachments()
         if self.dformat not in ["plain", "html"]:
             self.dformat = self.request.user.parameters.get_value(
@@ -142,28 +168,18 @@ class ImapEmail(Email):
         """
         if self._body is None:
             self.fetch_body_structure()
+            self._fetch_display_parts()
             bodyc = u""
             parts = self.bs.contents.get(self.mformat, [])
             for part in parts:
-                pnum = part["pnum"]
-                data = self.imapc._cmd(
-                    "FETCH", self.mailid, "(BODY.PEEK[%s])" % pnum
-                )
-                if not data or not int(self.mailid) in data:
+                payload = self._parts.get(part["pnum"])
+                if payload is None:
                     continue
-                content = decode_payload(
-                    part["encoding"], data[int(self.mailid)]["BODY[%s]" % pnum]
-                )
+                content = decode_payload(part["encoding"], payload)
                 if not isinstance(content, six.text_type):
-                    charset = self._find_content_charset(part)
-                    if charset is not None:
-                        try:
-                            content = content.decode(charset)
-                        except (UnicodeDecodeError, LookupError):
-                            result = chardet.detect(content)
-                            content = content.decode(result["encoding"])
+                    content = decode_literal(
+                        content, self._find_content_charset(part))
                 bodyc += content
-            self._fetch_inlines()
             if len(bodyc) != 0:
                 bodyc = getattr(self, "_post_process_%s" % self.mformat)(bodyc)
                 self._body = getattr(self, "viewmail_%s" % self.mformat)(
@@ -214,25 +230,90 @@ class ImapEmail(Email):
                     break
             self.attachments[att["pnum"]] = smart_str(attname)
 
-    def _fetch_inlines(self):
-        """Store inline images on filesystem to display them."""
-        for cid, params in list(self.bs.inlines.items()):
-            if re.search(r"\.\.", cid):
-                continue
-            fname = "{}_{}".format(self.mailid, cid)
-            path = get_storage_path(fname)
-            params["fname"] = os.path.join(
-                settings.MEDIA_URL,
-                os.path.basename(get_storage_path("")),
-                fname
-            )
-            if default_storage.exists(path):
+    def _get_uidvalidity(self):
+        """Return the UIDVALIDITY value of the message's mailbox."""
+        self.imapc.select_mailbox(self.mbox, False)
+        return self.imapc.uidvalidity
+
+    def _get_spool_key(self, pnum):
+        """Return the key of a part in the spool."""
+        return (
+            self.imapc.user, self.mbox, self._get_uidvalidity(), self.mailid,
+            pnum)
+
+    def _get_inlines_to_store(self):
+        """Return inline images not yet stored in the spool.
+
+        Inline images are only displayed with HTML contents, they are
+        served by the ``getinline`` view. At most ``inline_images_max``
+        images are retrieved along with the body (none in lazy mode),
+        the others are retrieved when the browser requests them.
+
+        :return: a list of part definitions
+        """
+        result = []
+        if self.mformat != "html":
+            return result
+        conf = dict(param_tools.get_global_parameters("modoboa_webmail"))
+        limit = conf["inline_images_max"]
+        if conf["inline_images_lazy"] or self._get_uidvalidity() is None:
+            limit = 0
+        for params in self.bs.inlines.values():
+            params["fname"] = "{}?{}".format(
+                reverse("modoboa_webmail:inline_get"),
+                urlencode({
+                    "mbox": self.mbox, "mailid": self.mailid,
+                    "partnumber": params["pnum"]
+                }))
+            if limit <= 0:
                 continue
-            pdef, content = self.imapc.fetchpart(
-                self.mailid, self.mbox, params["pnum"]
-            )
-            default_storage.save(
-                path, ContentFile(decode_payload(params["encoding"], content)))
+            limit -= 1
+            if spool.get(*self._get_spool_key(params["pnum"])) is None:
+                result.append(params)
+        return result
+
+    def _get_display_parts(self):
+        """Return the numbers of the parts needed to display the body."""
+        pnums = [
+            part["pnum"] for part in self.bs.contents.get(self.mformat, [])]
+        self._inlines_to_store = self._get_inlines_to_store()
+        pnums += [params["pnum"] for params in self._inlines_to_store]
+        return pnums
+
+    def _fetch_display_parts(self):
+        """Retrieve the parts needed to display the body.
+
+        Missing parts are all requested using a single FETCH command.
+        """
+        pnums = [
+            pnum for pnum in self._get_display_parts()
+            if pnum not in self._parts
+        ]
+        if pnums:
+            headers, parts = self.imapc.fetchparts(
+                self.mbox, self.mailid, pnums)
+            self._parts.update(parts)
+        self._fetch_inlines()
+
+    def _fetch_inlines(self):
+        """Store inline images in the spool to display them.
+
+        Images are written in parallel. The spool size is read here
+        since worker threads have no database connection of their own.
+        """
+        max_size = spool.get_max_size()
+
+        def store(item):
+            key, params = item
+            spool.store(*key, chunks=[
+                decode_payload(params["encoding"], self._parts[key[-1]])
+            ], max_size=max_size)
+
+        parallel_map(store, [
+            (self._get_spool_key(params["pnum"]), params)
+            for params in self._inlines_to_store
+            if params["pnum"] in self._parts
+        ])
 
     def _map_cid(self, url):
         m = re.match(".*cid:(.+)", url)
@@ -245,6 +326,94 @@ class ImapEmail(Email):
         """Fetch an attachment from the IMAP server."""
         return self.imapc.fetchpart(self.mailid, self.mbox, pnum)
 
+    def get_decoded_part(self, pnum):
+        """Return the decoded content of a part.
+
+        The spool is used (and filled) so a part is retrieved from the
+        server only once.
+
+        :param str pnum: the part's number
+        :return: a 2-uple (part definition, bytes)
+        """
+        self.fetch_body_structure()
+        partdef = self.bs.find_part(pnum)
+        key = self._get_spool_key(pnum)
+        content = spool.read(*key)
+        if content is None:
+            headers, parts = self.imapc.fetchparts(
+                self.mbox, self.mailid, [pnum])
+            content = decode_payload(partdef["encoding"], parts[pnum])
+            if self.imapc.uidvalidity is not None:
+                spool.store(*key, chunks=[content])
+        return partdef, content
+
+
+class AsyncImapEmail(ImapEmail):
+    """An ``ImapEmail`` retrieved using an ``AsyncIMAPconnector``.
+
+    Round trips to the server are made by the ``afetch_headers`` and
+    ``afetch_body`` coroutines. The rest (decoding, HTML cleaning,
+    spool accesses) is synchronous and doesn't talk to the server
+    anymore: ``body`` must be read in a thread once ``afetch_body``
+    has been awaited.
+    """
+
+    def __init__(self, request, imapc, *args, **kwargs):
+        kwargs["imapc"] = imapc
+        super(AsyncImapEmail, self).__init__(request, *args, **kwargs)
+
+    def _get_uidvalidity(self):
+        # The mailbox is selected by the coroutines
+        return self.imapc.uidvalidity
+
+    async def afetch_body_structure(self, bs=None):
+        """Fetch BODYSTRUCTURE for email (see ``fetch_body_structure``)."""
+        if self.bs is None and bs is None:
+            bs = await self.imapc.get_bodystructure(self.mbox, self.mailid)
+        self.fetch_body_structure(bs)
+
+    async def afetch_headers(self, raw_addresses=False, with_body=False):
+        """Fetch message headers from server (see ``fetch_headers``)."""
+        await self.imapc.select_mailbox(self.mbox, False)
+        bs = None
+        if with_body:
+            bs = await self.imapc.get_bodystructure(
+                self.mbox, self.mailid, fetch=False)
+        if bs is None:
+            msg = await self.imapc.fetchmail(
+                self.mbox, self.mailid, readonly=False,
+                what=" ".join(self.headers_as_list)
+            )
+            headers = msg[
+                "BODY[HEADER.FIELDS ({})]".format(self.headers_as_text)]
+            await self.afetch_body_structure()
+        else:
+            self.fetch_body_structure(bs)
+            pnums = await sync_to_async(self._get_display_parts)()
+            headers, self._parts = await self.imapc.fetchparts(
+                self.mbox, self.mailid, pnums,
+                headers=self.headers_as_text, readonly=False
+            )
+        self._parse_headers(headers, raw_addresses)
+
+    async def afetch_body(self):
+        """Retrieve the parts needed to display the body."""
+        await self.imapc.select_mailbox(self.mbox, False)
+        await self.afetch_body_structure()
+        pnums = [
+            pnum
+            for pnum in await sync_to_async(self._get_display_parts)()
+            if pnum not in self._parts
+        ]
+        if pnums:
+            headers, parts = await self.imapc.fetchparts(
+                self.mbox, self.mailid, pnums)
+            self._parts.update(parts)
+
+    def _fetch_display_parts(self):
+        # Parts have been retrieved by ``afetch_body``
+        self._fetch_inlines()
+
 
 class Modifier(ImapEmail):
     """Message modifier."""
@@ -253,7 +422,7 @@ class Modifier(ImapEmail):
         kwargs["dformat"] = request.user.parameters.get_value("editor")
         super(Modifier, self).__init__(request, *args, **kwargs)
         self.form = form
-        self.fetch_headers(raw_addresses=True)
+        self.fetch_headers(raw_addresses=True, with_body=True)
         getattr(self, "_modify_%s" % self.dformat)()
 
     def _modify_plain(self):
@@ -4,12 +4,16 @@
 -------------------------------------------
 """
 
+from contextlib import contextmanager
 import email
 from functools import wraps
 import imaplib
 import re
+import selectors
 import socket
 import ssl
+import sys
+import threading
 import time
 
 import six
@@ -18,12 +22,13 @@ from django.utils.encoding import smart_bytes
 from django.utils.translation import gettext as _
 
 from modoboa.lib import imap_utf7  # noqa
-from modoboa.lib.connections import ConnectionsManager
-from modoboa.lib.exceptions import InternalError
+from modoboa.lib.cryptutils import get_password
+from modoboa.lib.exceptions import BadRequest, InternalError
 from modoboa.parameters import tools as param_tools
 
 from ..exceptions import ImapError, WebmailInternalError
-from .fetch_parser import FetchResponseParser
+from . import cache
+from .fetch_parser import FetchResponseParser, decode_literal
 
 # imaplib.Debug = 4
 
@@ -33,6 +38,90 @@ MAXLINE = 1000000
 if hasattr(imaplib, "_MAXLINE") and getattr(imaplib, "_MAXLINE") < MAXLINE:
     setattr(imaplib, "_MAXLINE", MAXLINE)
 
+# IDLE (RFC 2177) is only known by imaplib since Python 3.14
+imaplib.Commands.setdefault("IDLE", ("AUTH", "SELECTED"))
+
+#: Maximum length of a sequence set sent within a single command. RFC
+#: 7162 recommends to limit command lines to 8192 octets.
+MAX_SEQUENCE_SET_LENGTH = 8000
+
+
+def parse_sequence_set(msgset):
+    """Convert a message set to a list of UID intervals.
+
+    Overlapping and contiguous intervals are merged.
+
+    >>> parse_sequence_set("5,1:3,4,10")
+    [(1, 5), (10, 10)]
+    >>> parse_sequence_set([b"7", 9, "8"])
+    [(7, 9)]
+
+    :param msgset: a sequence set (string) or an iterable of UIDs
+    :return: a sorted list of 2-uple (first, last)
+    """
+    if isinstance(msgset, bytes):
+        msgset = msgset.decode()
+    if isinstance(msgset, six.string_types):
+        items = msgset.split(",")
+    elif isinstance(msgset, six.integer_types):
+        items = [msgset]
+    else:
+        items = msgset
+    intervals = []
+    for item in items:
+        if isinstance(item, bytes):
+            item = item.decode()
+        item = str(item).strip()
+        if not item:
+            continue
+        first, sep, last = item.partition(":")
+        try:
+            first = int(first)
+            last = int(last) if sep else first
+        except ValueError:
+            raise BadRequest(_("Invalid message set"))
+        intervals.append((min(first, last), max(first, last)))
+    intervals.sort()
+    result = []
+    for first, last in intervals:
+        if result and first <= result[-1][1] + 1:
+            result[-1] = (result[-1][0], max(last, result[-1][1]))
+        else:
+            result.append((first, last))
+    return result
+
+
+def build_sequence_sets(msgset, max_length=MAX_SEQUENCE_SET_LENGTH):
+    """Build compact sequence sets.
+
+    Contiguous UIDs are collapsed into ranges and the result is split
+    into several sets so each one fits within ``max_length``.
+
+    >>> build_sequence_sets([1, 2, 3, 5, 7, 8])
+    ['1:3,5,7:8']
+    >>> build_sequence_sets("1,3,5,7", max_length=4)
+    ['1,3', '5,7']
+
+    :param msgset: a sequence set (string) or an iterable of UIDs
+    :param int max_length: maximum length of a set
+    :return: a list of strings
+    """
+    result = []
+    current = ""
+    for first, last in parse_sequence_set(msgset):
+        item = (
+            str(first) if first == last else "{}:{}".format(first, last))
+        if not current:
+            current = item
+        elif len(current) + len(item) + 1 > max_length:
+            result.append(current)
+            current = item
+        else:
+            current = "{},{}".format(current, item)
+    if current:
+        result.append(current)
+    return result
+
 
 class capability(object):
 
@@ -53,18 +142,144 @@ class capability(object):
         def wrapped_func(cls, *args, **kwargs):
             if self.name in cls.capabilities:
                 return method(cls, *args, **kwargs)
-            return getattr(cls, self.fallback_method)(cls, **kwargs)
+            return getattr(cls, self.fallback_method)(*args, **kwargs)
 
         return wrapped_func
 
 
+def synchronized(method):
+    """Run a connector method while holding the connector's lock.
+
+    The lock is reentrant so synchronized methods can call each
+    other.
+    """
+    @wraps(method)
+    def wrapped_func(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return wrapped_func
+
+
+def guess_attachments(content_type, flags=None):
+    """Tell if a message has attachments without its BODYSTRUCTURE.
+
+    The ``$HasAttachment`` and ``$HasNoAttachment`` keywords (RFC
+    8457) are used when the server sets them. Otherwise, the answer
+    is deduced from the top-level content type (using the rules of
+    ``BodyStructure``) for single part messages. ``multipart/alternative``
+    messages are assumed to only contain alternative versions of the
+    text (the rare alternatives using other types, like calendar
+    invitations, are missed).
+
+    :param str content_type: the top-level content type (lower case)
+    :param list flags: the message's flags
+    :return: True, False or None (unknown)
+    """
+    if flags:
+        if "$HasAttachment" in flags:
+            return True
+        if "$HasNoAttachment" in flags:
+            return False
+    if content_type == "multipart/alternative":
+        return False
+    if content_type.startswith("multipart/"):
+        return None
+    return content_type not in ("text/plain", "text/html")
+
+
+class MessagePart(object):
+    """A part of a message (see ``BodyStructure``).
+
+    Attributes can also be accessed like dictionary keys
+    (``part["encoding"]``, ``part["Content-Type"]``, etc.). Extension
+    data (``disposition``, ``md5``, etc.) is only available if the
+    server sent it.
+    """
+
+    __slots__ = (
+        "pnum", "params", "cid", "description", "encoding", "size",
+        "content_type", "extensions", "fname"
+    )
+
+    keys = {"Content-Type": "content_type"}
+
+    #: Names of the extension data items, by part type (RFC 3501)
+    extension_names = {
+        "text": ("textlines", "md5", "disposition", "language", "location"),
+        "message/rfc822": (
+            "envelopestruct", "bodystruct", "textlines", "md5",
+            "disposition", "language", "location"),
+        None: ("md5", "disposition", "language", "location"),
+    }
+
+    def __init__(self, pnum, definition):
+        """Constructor.
+
+        :param str pnum: the part's number
+        :param list definition: the part's definition (parser output)
+        """
+        self.pnum = pnum
+        (mtype, subtype, self.params, self.cid, self.description,
+         self.encoding, self.size) = definition[:7]
+        # Only a few distinct values are used
+        self.content_type = sys.intern(
+            "{}/{}".format(mtype, subtype).lower())
+        self.extensions = definition[7:]
+
+    def __getattr__(self, name):
+        """Return an extension data item."""
+        if name in self.__slots__:
+            raise AttributeError(name)
+        mtype = self.content_type.split("/")[0]
+        if mtype != "text":
+            mtype = self.content_type
+        names = self.extension_names.get(mtype, self.extension_names[None])
+        try:
+            return self.extensions[names.index(name)]
+        except (ValueError, IndexError):
+            raise AttributeError(name)
+
+    def __getstate__(self):
+        """Return a compact state (parts are cached).
+
+        Only the last attribute (``fname``) can be missing.
+        """
+        return tuple(
+            getattr(self, name) for name in self.__slots__
+            if hasattr(self, name))
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self.keys.get(key, key))
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, self.keys.get(key, key), value)
+
+    def __contains__(self, key):
+        return hasattr(self, self.keys.get(key, key))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
 class BodyStructure(object):
 
     """
     BODYSTRUCTURE response parser.
 
     Just a simple class that tries to distinguish content parts from
-    attachments.
+    attachments. Parts (``MessagePart`` instances) are also indexed by
+    part number and Content-ID.
     """
 
     def __init__(self, definition=None):
@@ -72,6 +287,9 @@ class BodyStructure(object):
         self.contents = {}
         self.attachments = []
         self.inlines = {}
+        self.parts = {}
+        self.cids = {}
+        self._attachment_pnums = set()
 
         if definition is not None:
             self.load_from_definition(definition)
@@ -104,69 +322,213 @@ class BodyStructure(object):
 
         """
         pnum = "1" if pnum is None else pnum
-        params = {
-            "pnum": pnum,
-            "params": definition[2],
-            "cid": definition[3],
-            "description": definition[4],
-            "encoding": definition[5],
-            "size": definition[6]
-        }
-        mtype = definition[0].lower()
-        subtype = definition[1].lower()
-        ftype = "%s/%s" % (definition[0].lower(), subtype)
-        if ftype in ("text/plain", "text/html"):
+        part = MessagePart(pnum, definition)
+        self.parts[pnum] = part
+        if part.cid and part.cid != "NIL":
+            self.cids[part.cid.strip("<>")] = part
+        if part.content_type in ("text/plain", "text/html"):
+            subtype = part.content_type[5:]
             if subtype not in self.contents:
-                self.contents[subtype] = [params]
+                self.contents[subtype] = [part]
             else:
-                self.contents[subtype].append(params)
+                self.contents[subtype].append(part)
             return
         elif multisubtype in ["related"]:
-            self.inlines[params["cid"].strip("<>")] = params
+            self.inlines[part.cid.strip("<>")] = part
             return
-
-        params["Content-Type"] = ftype
-        if len(definition) > 7:
-            extensions = ["md5", "disposition", "language", "location"]
-            if mtype == "text":
-                extensions = ["textlines"] + extensions
-            elif ftype == "message/rfc822":
-                extensions = [
-                    "envelopestruct",
-                    "bodystruct",
-                    "textlines"] + extensions
-            for idx, value in enumerate(definition[7:]):
-                params[extensions[idx]] = value
-
-        self.attachments += [params]
+        self.attachments += [part]
+        self._attachment_pnums.add(pnum)
 
     def load_from_definition(self, definition, multisubtype=None):
-        for mp in definition:
+        """Load a structure returned by the parser.
+
+        The tree is walked iteratively (depth first) so deeply nested
+        messages don't hit the recursion limit.
+        """
+        stack = [(mp, multisubtype) for mp in reversed(definition)]
+        while stack:
+            mp, multisubtype = stack.pop()
             if isinstance(mp, list):
-                if isinstance(mp[0], list):
-                    self.load_from_definition(mp, mp[1])
-                else:
-                    self.load_from_definition(mp)
+                subtype = mp[1] if isinstance(mp[0], list) else None
+                stack.extend((item, subtype) for item in reversed(mp))
             elif isinstance(mp, dict):
-                if isinstance(mp["struct"][0], list):
-                    self.load_from_definition(mp["struct"][0], mp["struct"][1])
+                struct = mp["struct"]
+                if isinstance(struct[0], list):
+                    stack.extend(
+                        (item, struct[1]) for item in reversed(struct[0]))
                     continue
-                self.__store_part(mp["struct"], mp["partnum"], multisubtype)
+                self.__store_part(struct, mp["partnum"], multisubtype)
 
     def has_attachments(self):
         return len(self.attachments)
 
+    def find_part(self, pnum):
+        """Return the part corresponding to a part number (or None)."""
+        return self.parts.get(pnum)
+
     def find_attachment(self, pnum):
-        for att in self.attachments:
-            if pnum == att["pnum"]:
-                return att
-        return None
+        if pnum not in self._attachment_pnums:
+            return None
+        return self.parts[pnum]
+
+
+class PipelinedCommand(object):
+    """A command sent as part of a pipeline.
+
+    Once the pipeline is executed, ``status`` and ``data`` contain the
+    tagged response of the command and ``responses`` the untagged
+    responses received for it (name: list of values).
+    """
+
+    def __init__(self, name, args, responses=(), callback=None):
+        self.name = name
+        self.args = args
+        self.response_names = responses
+        self.callback = callback
+        self.tag = None
+        self.status = None
+        self.data = None
+        self.responses = {}
+
+    @property
+    def ok(self):
+        return self.status == "OK"
+
+    def check(self):
+        """Raise an ``ImapError`` if the command failed."""
+        if not self.ok:
+            raise ImapError(self.data)
+
 
+class Pipeline(object):
+    """Send several IMAP commands without waiting for each response.
 
-@six.add_metaclass(ConnectionsManager)
-class IMAPconnector(object):
+    Commands are queued using ``add`` and written together by
+    ``execute``, which then reads the tagged responses in order. Only
+    independent commands must be pipelined (see RFC 3501, section
+    5.5): untagged responses received before the completion of a
+    command are attributed to it.
 
-    """The IMAPv4 connector."""
+    Commands using literals can't be pipelined: ``imaplib`` waits for
+    the continuation request of the server before sending a literal,
+    which never comes while the command is buffered. Arguments must be
+    atoms or quoted strings.
+
+    A pipeline can also be used as a context manager, it is executed
+    on exit.
+
+    :param connector: an ``IMAPconnector`` instance
+    """
+
+    def __init__(self, connector):
+        self.connector = connector
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def add(self, name, *args, **kwargs):
+        """Queue a command.
+
+        :param name: the command's name
+        :param responses: names of the untagged responses to collect
+        :param callback: a function called with the command once it
+                         is complete
+        :return: a ``PipelinedCommand`` instance
+        """
+        for arg in args:
+            if arg is None:
+                continue
+            if isinstance(arg, str):
+                arg = arg.encode("utf-8")
+            if b"\r" in arg or b"\n" in arg or arg.endswith(b"}"):
+                raise ValueError(
+                    "{}: literals can't be pipelined".format(name))
+        command = PipelinedCommand(
+            name, args, kwargs.get("responses", ()), kwargs.get("callback"))
+        self.commands.append(command)
+        return command
+
+    def _send(self, commands):
+        """Write commands and return their tags.
+
+        Commands are built by ``imaplib`` but its output is buffered so
+        they are all sent using a single write.
+        """
+        m = self.connector.m
+        send = m.send
+        buffer = []
+        m.send = buffer.append
+        try:
+            for command in commands:
+                # A pending literal would make imaplib wait for a
+                # continuation request that can't be received
+                if m.literal is not None:
+                    m.literal = None
+                    raise ImapError(
+                        "{}: literals can't be pipelined".format(
+                            command.name))
+                command.tag = self.connector._send_command(
+                    command.name, *command.args)
+        finally:
+            del m.send
+        if buffer:
+            try:
+                send(b"".join(buffer))
+            except (imaplib.IMAP4.abort, socket.error) as e:
+                self.connector.broken = True
+                raise ImapError(e)
+
+    def execute(self):
+        """Send queued commands and read their responses.
+
+        Errors reported by the server are stored into each command
+        (see ``PipelinedCommand.check``), connection errors raise an
+        ``ImapError``.
+
+        :return: the list of executed commands
+        """
+        commands, self.commands = self.commands, []
+        if not commands:
+            return commands
+        connector = self.connector
+        with connector.lock:
+            connector.last_used = time.time()
+            untagged = connector.m.untagged_responses
+            for command in commands:
+                # Ignore unsolicited responses received before
+                for name in command.response_names:
+                    untagged.pop(name, None)
+            self._send(commands)
+            for command in commands:
+                command.status, command.data = (
+                    connector._read_tagged_response(command.tag))
+                for name in command.response_names:
+                    if name in untagged:
+                        command.responses[name] = untagged.pop(name)
+                if command.callback is not None:
+                    command.callback(command)
+        return commands
+
+
+class BaseIMAPconnector(object):
+
+    """Code shared by the IMAPv4 connectors.
+
+    Nothing here talks to the server: commands are built and responses
+    parsed the same way by the synchronous connector
+    (``IMAPconnector``) and the asynchronous one
+    (``aioimap.AsyncIMAPconnector``), so both return the same
+    structures.
+
+    :param user: the username
+    :param dict conf: the webmail's global parameters (read from the
+                      database if not specified)
+    """
 
     namespaces_pattern = re.compile(r'(\(\(.+?\)\)|NIL)')
     namespace_pattern = re.compile(
@@ -180,18 +542,622 @@ class IMAPconnector(object):
     listextended_response_pattern = \
         re.compile(list_base_pattern + r'\s*(?P<childinfo>.*)')
     unseen_pattern = re.compile(r'[^\(]+\(UNSEEN (\d+)\)')
+    status_pattern = re.compile(r'[^\(]+\(([^\)]*)\)')
 
-    def __init__(self, user=None, password=None):
+    status_response_pattern = re.compile(
+        r'\s*(?:"(?P<quoted>(?:[^"\\]|\\.)*)"|(?P<atom>[^\s\(]+))?'
+        r'\s*\((?P<items>[^\)]*)\)')
+
+    #: Untagged responses announcing changes in the selected mailbox
+    idle_responses = ("EXISTS", "EXPUNGE", "FETCH", "VANISHED")
+    #: Responses to SELECT describing the state of the mailbox
+    mailbox_state_items = (
+        "UIDVALIDITY", "UIDNEXT", "EXISTS", "HIGHESTMODSEQ")
+
+    esearch_count_pattern = re.compile(r'\bCOUNT (\d+)')
+    esearch_partial_pattern = re.compile(r'\bPARTIAL \(\S+ (\S+)\)')
+
+    #: Data items displayed in listings (see ``_make_summary``)
+    summary_query = (
+        "(FLAGS RFC822.SIZE "
+        "BODY.PEEK[HEADER.FIELDS (DATE FROM TO CC SUBJECT CONTENT-TYPE)])"
+    )
+
+    def __init__(self, user=None, conf=None):
+        self.user = user
+        self.last_used = time.time()
+        self.broken = False
         self.__hdelimiter = None
         self.__ns_prefixes = {}
         self.quota_usage = -1
         self.criterions = []
-        self.conf = dict(param_tools.get_global_parameters("modoboa_webmail"))
+        self.mailbox_state = {}
+        if conf is None:
+            conf = dict(param_tools.get_global_parameters("modoboa_webmail"))
+        self.conf = conf
         self.address = self.conf["imap_server"]
         self.port = self.conf["imap_port"]
+
+    def reset_state(self):
+        """Forget data related to the previous request."""
+        self.criterions = []
+        self.messages = []
+        self.messages_offset = 0
+        self.quota_usage = -1
+        self.quota_limit = self.quota_current = None
+
+    @property
+    def hdelimiter(self):
+        """Return the default hierachy delimiter.
+
+        :return: a string
+        """
+        if self.__hdelimiter is None:
+            raise InternalError(
+                _("Failed to retrieve hierarchy delimiter"))
+        return self.__hdelimiter
+
+    def _parse_namespaces(self, data):
+        """Load available namespaces from a NAMESPACE response."""
+        nslist = self.namespaces_pattern.findall(data[0].decode())
+        for pos, item in enumerate(["personal", "others", "public"]):
+            if nslist[pos] == "NIL":
+                continue
+            ns = nslist[pos][1:-1]
+            for m in self.namespace_pattern.finditer(ns):
+                if self.__hdelimiter is None:
+                    self.__hdelimiter = m.group("delimiter")
+                if item not in self.__ns_prefixes:
+                    self.__ns_prefixes[item] = []
+                self.__ns_prefixes[item].append(m.group("prefix"))
+
+    def parse_search_parameters(self, criterion, pattern):
+        """Parse search information and apply them."""
+
+        def or_criterion(old, c):
+            if old == "":
+                return c
+            return "OR (%s) (%s)" % (old, c)
+
+        if criterion == u"both":
+            criterion = u"from_addr, subject"
+        criterions = ""
+        for c in criterion.split(','):
+            if c == "from_addr":
+                key = "FROM"
+            elif c == "subject":
+                key = "SUBJECT"
+            else:
+                continue
+            criterions = or_criterion(
+                criterions, '(%s "%s")' % (key, pattern))
+        if six.PY3:
+            criterions = bytearray(criterions, "utf-8")
+        elif isinstance(criterions, six.text_type):
+            criterions = criterions.encode("utf-8")
+        self.criterions = [criterions]
+
+    def _get_sort_criterion(self, order=None):
+        """Convert a sorting order (``-date``, ``+from``...) to a SORT
+        criterion."""
+        if not order:
+            return "REVERSE DATE"
+        criterion = order[1:].upper()
+        if order[:1] == '-':
+            criterion = "REVERSE %s" % criterion
+        return criterion
+
+    def _load_sort_window(self, data, start):
+        """Load the result of a SORT RETURN (COUNT PARTIAL) command.
+
+        :param data: the ESEARCH response
+        :param int start: index of the first message requested
+        :return: the number of messages
+        """
+        data = data.decode() if isinstance(data, bytes) else data
+        m = self.esearch_count_pattern.search(data)
+        count = int(m.group(1)) if m else 0
+        m = self.esearch_partial_pattern.search(data)
+        self.messages = []
+        if m and m.group(1) != "NIL":
+            # Sequence set is in sort order, don't reorder it
+            for item in m.group(1).split(","):
+                first, sep, last = item.partition(":")
+                if not sep:
+                    self.messages.append(first)
+                    continue
+                step = 1 if int(last) >= int(first) else -1
+                self.messages += [
+                    str(uid)
+                    for uid in range(int(first), int(last) + step, step)]
+        self.messages_offset = start - 1
+        return count
+
+    def _set_mailbox_state(self, responses):
+        """Store the state of the selected mailbox.
+
+        :param dict responses: untagged responses received for SELECT
+                               or EXAMINE
+        """
+        self.mailbox_state = dict(
+            (name, int(responses[name][-1]))
+            for name in self.mailbox_state_items if responses.get(name))
+        self.uidvalidity = self.mailbox_state.get("UIDVALIDITY")
+
+    def _get_mailbox_state_key(self):
+        """Return the state used to validate cached sorting results.
+
+        Deleted messages are excluded from these results: the state
+        is only reliable if the server sends HIGHESTMODSEQ (RFC 7162),
+        otherwise a change of the \\Deleted flag wouldn't modify it.
+
+        :return: a string or None
+        """
+        if "HIGHESTMODSEQ" not in self.mailbox_state:
+            return None
+        return " ".join(
+            "{} {}".format(name, self.mailbox_state.get(name))
+            for name in self.mailbox_state_items)
+
+    def _invalidate_mailboxes(self, *names):
+        """Forget cached data about mailboxes modified locally."""
+        for name in names:
+            cache.sorted_uids.invalidate(self.user, name)
+
+    def _parse_unseen(self, data):
+        """Return the number of unseen messages from STATUS (UNSEEN)
+        responses."""
+        m = self.unseen_pattern.match(data[-1].decode()) if data else None
+        return int(m.group(1)) if m is not None else 0
+
+    def _parse_status_responses(self, responses):
+        """Parse untagged STATUS responses.
+
+        Mailbox names can be quoted strings, atoms or literals (in this
+        case, ``imaplib`` returns the literal and the rest of the
+        response as two items).
+
+        :param responses: the list returned by ``imaplib``
+        :return: a dictionary (mailbox name: {item: integer})
+        """
+        result = {}
+        name = None
+        for response in responses:
+            if isinstance(response, tuple):
+                name = response[1]
+                continue
+            m = self.status_response_pattern.match(response.decode())
+            if m is None:
+                name = None
+                continue
+            if m.group("quoted") is not None:
+                name = re.sub(r'\\(.)', r'\1', m.group("quoted"))
+            elif m.group("atom") is not None:
+                name = m.group("atom")
+            if name is None:
+                continue
+            if not isinstance(name, bytes):
+                name = name.encode("utf-8")
+            values = m.group("items").split()
+            result[name.decode("imap4-utf-7")] = dict(
+                (item.upper(), int(value))
+                for item, value in zip(values[::2], values[1::2]))
+            name = None
+        return result
+
+    def get_sync_state(self):
+        """Return the state of the selected mailbox used to compute
+        changes later (see ``sync_mailbox``).
+
+        :return: a dictionary (MODSEQ and UIDNEXT values) or None if
+                 the server doesn't send HIGHESTMODSEQ
+        """
+        if "HIGHESTMODSEQ" not in self.mailbox_state:
+            return None
+        return {
+            "modseq": self.mailbox_state["HIGHESTMODSEQ"],
+            "uidnext": self.mailbox_state.get("UIDNEXT")
+        }
+
+    def _new_sync_result(self, since, uids):
+        """Start the result of ``sync_mailbox`` (None if not supported).
+
+        ``full`` is True when changes can't be computed: no reference
+        MODSEQ, or too many messages to check.
+        """
+        result = self.get_sync_state()
+        if result is None:
+            return None
+        result.update({
+            "full": (
+                since is None or since > result["modseq"] or
+                len(build_sequence_sets(uids or [])) > 1),
+            "changed": {}, "vanished": []
+        })
+        return result
+
+    def _get_changes_modifiers(self, since):
+        """Return the FETCH modifiers used to retrieve changes."""
+        modifiers = "CHANGEDSINCE {}".format(since)
+        if "QRESYNC" in self.capabilities:
+            modifiers += " VANISHED"
+        return "({})".format(modifiers)
+
+    def _find_vanished(self, responses, uids):
+        """Return the UIDs listed by VANISHED responses.
+
+        :param list responses: raw VANISHED responses
+        :param uids: the UIDs to look for
+        """
+        intervals = []
+        for response in responses:
+            response = response.decode()
+            if response.startswith("(EARLIER)"):
+                response = response[len("(EARLIER)"):]
+            intervals += parse_sequence_set(response)
+        return [
+            uid for uid in uids
+            if any(first <= uid <= last for first, last in intervals)
+        ]
+
+    def _parse_search(self, command):
+        """Return the numbers listed by the SEARCH responses of a
+        command."""
+        command.check()
+        return [
+            int(item)
+            for response in command.responses.get("SEARCH", [])
+            for item in (response or b"").split()
+        ]
+
+    def _load_sync_changes(self, result, uids, unseen, changes=None,
+                           current=None):
+        """Complete the result of ``sync_mailbox``.
+
+        :param unseen: the executed SEARCH UNSEEN command
+        :param changes: the executed UID FETCH (CHANGEDSINCE) command
+        :param current: the executed UID SEARCH command listing the
+                        messages still present (without QRESYNC)
+        """
+        result["unseen"] = len(self._parse_search(unseen))
+        if changes is None:
+            return
+        changes.check()
+        data = FetchResponseParser().parse(
+            changes.responses.get("FETCH") or [])
+        if current is not None:
+            present = set(self._parse_search(current))
+            vanished = [uid for uid in uids if uid not in present]
+        else:
+            vanished = self._find_vanished(
+                changes.responses.get("VANISHED", []), uids)
+        for uid, msg in data.items():
+            if uid not in uids or uid in vanished:
+                continue
+            if r"\Deleted" in msg.get("FLAGS", []):
+                # Hidden from listings
+                vanished.append(uid)
+            else:
+                result["changed"][uid] = msg.get("FLAGS", [])
+        result["vanished"] = vanished
+
+    def _encode_mbox_name(self, folder):
+        """Encode folder name (str) to imap4-utf-7 and quote it."""
+        if not folder:
+            return "INBOX"
+        return b'"' + folder.encode("imap4-utf-7") + b'"'
+
+    def _parse_mailbox_name(self, descr, prefix, delimiter, parts):
+        if not len(parts):
+            return False
+        path = "%s%s%s" % (prefix, delimiter, parts[0])
+        sdescr = None
+        for d in descr:
+            if d["path"] == path:
+                sdescr = d
+                break
+        if sdescr is None:
+            sdescr = {"name": parts[0], "path": path, "sub": []}
+            descr += [sdescr]
+        if self._parse_mailbox_name(sdescr["sub"], path, delimiter, parts[1:]):
+            sdescr["class"] = "subfolders"
+        return True
+
+    def _parse_simple_list_responses(self, responses, mailboxes):
+        """Parse LIST responses (without LIST-EXTENDED).
+
+        The whole tree is returned by the server: it is merged into
+        ``mailboxes``.
+        """
+        newmboxes = []
+        for mb in responses:
+            if not mb:
+                continue
+            flags, delimiter, name = self.list_response_pattern.match(
+                mb.decode()).groups()
+            name = bytearray(name.strip('"'), "utf-8").decode("imap4-utf-7")
+            mdm_found = False
+            for idx, mdm in enumerate(mailboxes):
+                if mdm["name"] == name:
+                    mdm_found = True
+                    descr = mailboxes[idx]
+                    break
+            if not mdm_found:
+                descr = {"name": name}
+                newmboxes += [descr]
+
+            if re.search(r"\%s" % delimiter, name):
+                parts = name.split(delimiter)
+                if "path" not in descr:
+                    descr["path"] = parts[0]
+                    descr["sub"] = []
+                if self._parse_mailbox_name(descr["sub"], parts[0], delimiter,
+                                            parts[1:]):
+                    descr["class"] = "subfolders"
+                continue
+
+        from operator import itemgetter
+        mailboxes += sorted(newmboxes, key=itemgetter("name"))
+
+    def _get_list_pattern(self, topmailbox):
+        """Return the LIST pattern matching the children of a mailbox."""
+        return (
+            '"{0}{1}%"'.format(
+                topmailbox.encode("imap4-utf-7").decode(), self.hdelimiter)
+            if topmailbox else "%"
+        )
+
+    def _get_list_options(self, with_status=False):
+        """Return the LIST return options (RFC 5258)."""
+        if with_status:
+            return "(CHILDREN STATUS (UNSEEN))"
+        return "(CHILDREN)"
+
+    def _parse_list_responses(self, responses, mailboxes):
+        """Parse LIST (RETURN (CHILDREN)) responses.
+
+        New mailboxes are added to ``mailboxes``.
+
+        :return: the list of mailboxes having children (their ``sub``
+                 list is empty)
+        """
+        newmboxes = []
+        parents = []
+        for mb in responses:
+            if not mb:
+                continue
+            if type(mb) in [list, tuple]:
+                flags, delimiter, namelen = (
+                    self.list_response_pattern_literal.match(
+                        mb[0].decode()).groups()
+                )
+                name = mb[1][0:int(namelen)]
+            else:
+                flags, delimiter, name, childinfo = (
+                    self.listextended_response_pattern.match(
+                        mb.decode()).groups())
+            flags = flags.split(" ")
+            if not isinstance(name, bytes):
+                name = name.encode("utf-8")
+            name = name.decode("imap4-utf-7")
+            mdm_found = False
+            for idx, mdm in enumerate(mailboxes):
+                if mdm["name"] == name:
+                    mdm_found = True
+                    descr = mailboxes[idx]
+                    break
+            if not mdm_found:
+                descr = {"name": name}
+                newmboxes += [descr]
+
+            if '\\Marked' in flags or '\\UnMarked' not in flags:
+                descr["send_status"] = True
+            if r'\NonExistent' in flags:
+                descr["removed"] = True
+            if '\\HasChildren' in flags:
+                descr["path"] = name
+                descr["sub"] = []
+                parents.append(descr)
+
+        from operator import itemgetter
+        mailboxes += sorted(newmboxes, key=itemgetter("name"))
+        return parents
+
+    def _get_special_mailboxes(self, user):
+        """Return the mailboxes always displayed at the top of the
+        tree.
+
+        :param user: a ``User`` instance
+        """
+        return [
+            {"name": "INBOX", "class": "fa fa-inbox",
+             "label": _("Inbox")},
+            {"name": user.parameters.get_value("drafts_folder"),
+             "class": "fa fa-file", "label": _("Drafts")},
+            {"name": user.parameters.get_value("junk_folder"),
+             "class": "fa fa-fire", "label": _("Junk")},
+            {"name": user.parameters.get_value("sent_folder"),
+             "class": "fa fa-envelope", "label": _("Sent")},
+            {"name": user.parameters.get_value("trash_folder"),
+             "class": "fa fa-trash", "label": _("Trash")}
+        ]
+
+    def _get_counted_mailboxes(self, mailboxes):
+        """Return the mailboxes whose unseen messages must be counted.
+
+        :param list mailboxes: the result of ``_listmboxes``
+        :return: a list of 2-uple (mailbox, name)
+        """
+        names = []
+        for mb in mailboxes:
+            if "send_status" not in mb:
+                continue
+            del mb["send_status"]
+            key = "path" if "path" in mb else "name"
+            if mb.get("removed", False):
+                continue
+            names.append((mb, mb[key]))
+        return names
+
+    def _parse_quota(self, command):
+        """Parse the result of a GETQUOTAROOT command."""
+        if not command.ok or len(command.responses) != 2:
+            self.quota_limit = self.quota_current = None
+            return
+        quotadef = command.responses["QUOTA"][0].decode()
+        m = re.search(r"\(STORAGE (\d+) (\d+)\)", quotadef)
+        if not m:
+            print("Problem while parsing quota def")
+            return
+        self.quota_limit = int(m.group(2))
+        self.quota_current = int(m.group(1))
+        try:
+            self.quota_usage = (
+                int(float(self.quota_current) / float(self.quota_limit) * 100)
+            )
+        except TypeError:
+            self.quota_usage = -1
+
+    def _get_cached_bodystructure(self, uid):
+        """Look for a message structure in the cache.
+
+        The mailbox containing the message must be selected.
+
+        :param uid: a message UID
+        :return: a ``BodyStructure`` instance or None
+        """
+        return cache.bodystructures.get(
+            self.user, self.current_mailbox, self.uidvalidity, int(uid))
+
+    def _cache_bodystructure(self, uid, definition):
+        """Parse and cache a message structure.
+
+        :param uid: a message UID
+        :param definition: a BODYSTRUCTURE as returned by the parser
+        :return: a ``BodyStructure`` instance
+        """
+        bs = BodyStructure(definition)
+        cache.bodystructures.set(
+            self.user, self.current_mailbox, self.uidvalidity, int(uid), bs)
+        return bs
+
+    def _get_listing_uids(self, start, stop=None):
+        """Return the UIDs of the messages displayed in a listing.
+
+        The list of messages must be loaded (see ``messages_count``).
+        """
+        if start and stop:
+            submessages = self.messages[
+                start - 1 - self.messages_offset:stop - self.messages_offset]
+        else:
+            submessages = [start]
+        return [int(uid) for uid in submessages]
+
+    def _make_summary(self, msg_data):
+        """Build the summary of a message from a FETCH response (see
+        ``summary_query``).
+
+        :return: a dictionary (headers, size and attachments presence)
+        """
+        headers = next(
+            value for key, value in msg_data.items()
+            if key.startswith("BODY[HEADER.FIELDS"))
+        ctype = email.message_from_string(headers).get_content_type()
+        return {
+            "headers": headers,
+            "size": msg_data["RFC822.SIZE"],
+            "attachments": guess_attachments(ctype, msg_data["FLAGS"])
+        }
+
+    def _build_listing(self, uids, summaries, flags):
+        """Build the messages displayed in a listing.
+
+        :param list uids: the UIDs of the messages (in display order)
+        :param dict summaries: the summary of each message
+        :param dict flags: the flags of each message
+        :return: a list of ``email.message.Message``
+        """
+        result = []
+        for uid in uids:
+            msg_flags = flags[uid]
+            summary = summaries[uid]
+            msg = email.message_from_string(summary["headers"])
+            msg["imapid"] = str(uid)
+            msg["size"] = summary["size"]
+            if r"\Seen" not in msg_flags:
+                msg["style"] = "unseen"
+            if r"\Answered" in msg_flags:
+                msg["answered"] = True
+            if r"$Forwarded" in msg_flags:
+                msg["forwarded"] = True
+            if r"\Flagged" in msg_flags:
+                msg["flagged"] = True
+            if summary["attachments"]:
+                msg["attachments"] = True
+            result += [msg]
+        return result
+
+    def _get_fetchmail_query(self, what, readonly=True, cached=False):
+        """Return the data items to retrieve for ``fetchmail``.
+
+        :param bool cached: the structure of the message is known
+        """
+        if what == "bodystructure":
+            return "(BODYSTRUCTURE)"
+        if what == "source":
+            return "(BODY[])"
+        bcmd = "BODY.PEEK" if readonly else "BODY"
+        to_fetch = "{}[HEADER.FIELDS ({})]".format(bcmd, what)
+        if not cached:
+            to_fetch = "BODYSTRUCTURE {}".format(to_fetch)
+        return "({})".format(to_fetch)
+
+    def _get_parts_query(self, pnums, headers=None, readonly=True):
+        """Return the data items to retrieve for ``fetchparts`` (or
+        None if there is nothing to retrieve)."""
+        bcmd = "BODY.PEEK" if readonly else "BODY"
+        items = ["{}[{}]".format(bcmd, pnum) for pnum in pnums]
+        if headers:
+            items.insert(0, "{}[HEADER.FIELDS ({})]".format(bcmd, headers))
+        if not items:
+            return None
+        return "({})".format(" ".join(items))
+
+    def _extract_parts(self, msg, pnums, headers=None):
+        """Extract the result of ``fetchparts`` from a FETCH response.
+
+        :return: a 2uple (headers or None, dict of payloads by part
+                 number)
+        """
+        parts = {}
+        for pnum in pnums:
+            key = "BODY[{}]".format(pnum)
+            if key in msg:
+                parts[pnum] = msg[key]
+        if headers:
+            headers = msg.get("BODY[HEADER.FIELDS ({})]".format(headers))
+            if headers is not None:
+                headers = decode_literal(headers)
+        return headers, parts
+
+
+class IMAPconnector(BaseIMAPconnector):
+
+    """The IMAPv4 connector.
+
+    A connector can be shared by several threads: methods talking to
+    the server are serialized using ``lock``. Use this lock directly
+    when a sequence of calls must not be interleaved (for example
+    selecting a mailbox and fetching messages from it).
+    """
+
+    def __init__(self, user=None, password=None):
+        self.lock = threading.RLock()
+        super(IMAPconnector, self).__init__(user)
         self.login(user, password)
         self.load_namespaces()
 
+    @synchronized
     def _cmd(self, name, *args, **kwargs):
         """IMAP command wrapper
 
@@ -201,24 +1167,34 @@ class IMAPconnector(object):
         exception is raised.
 
         For specific commands commands (FETCH, ...), the result is
-        parsed using the IMAPclient module before being returned.
+        parsed using the IMAPclient module before being returned. Use
+        ``decode_literals=False`` to get FETCH literals as bytes.
 
         :param name: the command's name
         :return: the command's result
         """
-        if name in ['FETCH', 'SORT', 'STORE', 'COPY', 'SEARCH']:
+        self.last_used = time.time()
+        uid_commands = ['FETCH', 'SORT', 'STORE', 'COPY', 'SEARCH', 'MOVE']
+        if name in uid_commands or (name == 'EXPUNGE' and args):
             try:
                 typ, data = self.m.uid(name, *args)
+            except (imaplib.IMAP4.abort, socket.error) as e:
+                self.broken = True
+                raise ImapError(e)
             except imaplib.IMAP4.error as e:
                 raise ImapError(e)
             if typ == "NO":
                 raise ImapError(data)
             if name == 'FETCH':
-                return FetchResponseParser().parse(data)
+                return FetchResponseParser(
+                    kwargs.get("decode_literals", True)).parse(data)
             return data
 
         try:
             typ, data = self.m._simple_command(name, *args)
+        except (imaplib.IMAP4.abort, socket.error) as e:
+            self.broken = True
+            raise ImapError(e)
         except imaplib.IMAP4.error as e:
             raise ImapError(e)
         if typ == "NO":
@@ -234,33 +1210,214 @@ class IMAPconnector(object):
             res.append(self.m.untagged_responses.pop(r))
         return res
 
-    @property
-    def hdelimiter(self):
-        """Return the default hierachy delimiter.
+    def _uid_command(self, name, msgset, *args):
+        """Issue a UID command for a message set.
 
-        :return: a string
+        The set is compacted and, if it is too long, split into
+        several batches (one command per batch).
+
+        :param name: the command's name
+        :param msgset: a sequence set (string) or an iterable of UIDs
+        :return: the result of the last command (results are merged
+                 for FETCH)
         """
-        if self.__hdelimiter is None:
-            raise InternalError(
-                _("Failed to retrieve hierarchy delimiter"))
-        return self.__hdelimiter
+        result = {} if name == "FETCH" else None
+        for seqset in build_sequence_sets(msgset):
+            data = self._cmd(name, seqset, *args)
+            if name == "FETCH":
+                result.update(data)
+            else:
+                result = data
+        return result
+
+    def iterfetch(self, msgset, query, decode_literals=True):
+        """Issue a UID FETCH command and iterate over its result.
 
-    def refresh(self, user, password):
-        """Check if current connection needs a refresh
+        Messages are parsed as soon as they are received from the
+        server so only one message is kept in memory at a time. The
+        connector is locked until the iteration is over.
 
-        Is it really secure?
+        :param msgset: a sequence set (string) or an iterable of UIDs
+        :param str query: the data items to retrieve
+        :param bool decode_literals: return literals as str or bytes
+        :return: a generator of 2-uples (uid, data)
         """
-        if self.m is not None:
-            try:
-                self._cmd("NOOP")
-            except ImapError:
-                if hasattr(self, "current_mailbox"):
-                    del self.current_mailbox
-            else:
-                return
+        with self.lock:
+            self.last_used = time.time()
+            for seqset in build_sequence_sets(msgset):
+                parser = FetchResponseParser(decode_literals)
+                # Ignore unsolicited responses received before
+                self.m.untagged_responses.pop("FETCH", None)
+                tag = self._send_command("UID", "FETCH", seqset, query)
+                try:
+                    while True:
+                        responses = self._read_fetch_responses(tag)
+                        if responses is None:
+                            break
+                        for response in responses:
+                            for message in parser.feed(response):
+                                yield message
+                finally:
+                    if self.m.tagged_commands.get(tag, "") is None:
+                        # Iteration stopped early, read the remaining
+                        # responses to keep the connection usable
+                        while not self.broken and \
+                                self._read_fetch_responses(tag) is not None:
+                            pass
+                    status = self.m.tagged_commands.pop(tag, None)
+                if status[0] != "OK":
+                    raise ImapError(status[1])
+
+    def pipeline(self):
+        """Return a new pipeline to send several commands at once.
+
+        :return: a ``Pipeline`` instance
+        """
+        return Pipeline(self)
 
-        self.login(user, password)
+    def _read_tagged_response(self, tag):
+        """Read responses until the completion of a command.
+
+        Untagged responses are stored as usual by ``imaplib``.
+
+        :param tag: the command's tag
+        :return: the command's status, as a 2-uple (type, data)
+        """
+        try:
+            while self.m.tagged_commands[tag] is None:
+                self.m._get_response()
+        except (imaplib.IMAP4.abort, socket.error) as e:
+            self.broken = True
+            raise ImapError(e)
+        except imaplib.IMAP4.error as e:
+            raise ImapError(e)
+        return self.m.tagged_commands.pop(tag)
 
+    def _send_command(self, name, *args):
+        """Send a command without waiting for its completion.
+
+        :return: the command's tag
+        """
+        try:
+            return self.m._command(name, *args)
+        except (imaplib.IMAP4.abort, socket.error) as e:
+            self.broken = True
+            raise ImapError(e)
+        except imaplib.IMAP4.error as e:
+            raise ImapError(e)
+
+    def _read_fetch_responses(self, tag):
+        """Read the next response of a FETCH command.
+
+        :param tag: the command's tag
+        :return: the list of FETCH responses received or None if the
+                 command is complete
+        """
+        if self.m.tagged_commands[tag] is not None:
+            return None
+        try:
+            self.m._get_response()
+        except (imaplib.IMAP4.abort, socket.error) as e:
+            self.broken = True
+            raise ImapError(e)
+        except imaplib.IMAP4.error as e:
+            raise ImapError(e)
+        return self.m.untagged_responses.pop("FETCH", [])
+
+    def _has_pending_data(self):
+        """Check, without blocking, if a response can be read.
+
+        :raises ImapError: if the server closed the connection
+        """
+        sock = self.m.sock
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            # Data may already be buffered by imaplib or by the SSL layer
+            data = self.m.file.peek(1)
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            sock.settimeout(timeout)
+        if not data:
+            # The socket stays readable: don't wait for it again
+            self.broken = True
+            raise ImapError(_("Connection closed by the IMAP server"))
+        return True
+
+    @synchronized
+    def idle(self, timeout):
+        """Wait for changes in the selected mailbox using IDLE.
+
+        See RFC 2177. The connector is locked while waiting.
+
+        :param timeout: maximum waiting time (in seconds)
+        :return: a dictionary (response name: list of values) containing
+                 the changes announced by the server (see
+                 ``idle_responses``), empty if nothing happened
+        """
+        self.last_used = time.time()
+        untagged = self.m.untagged_responses
+        for name in self.idle_responses:
+            untagged.pop(name, None)
+        tag = self._send_command("IDLE")
+        deadline = time.time() + timeout
+        try:
+            # Wait for the continuation request
+            while self.m._get_response() is not None:
+                if self.m.tagged_commands[tag] is not None:
+                    break
+            status = self.m.tagged_commands[tag]
+            if status is not None:
+                del self.m.tagged_commands[tag]
+                raise ImapError(status[1])
+            with selectors.DefaultSelector() as selector:
+                selector.register(self.m.sock, selectors.EVENT_READ)
+                while not any(
+                        name in untagged for name in self.idle_responses):
+                    if self._has_pending_data():
+                        self.m._get_response()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    selector.select(remaining)
+            self.m.send(b"DONE\r\n")
+        except (imaplib.IMAP4.abort, socket.error) as e:
+            self.broken = True
+            raise ImapError(e)
+        except imaplib.IMAP4.error as e:
+            raise ImapError(e)
+        typ, data = self._read_tagged_response(tag)
+        if typ != "OK":
+            raise ImapError(data)
+        self.last_used = time.time()
+        return dict(
+            (name, untagged.pop(name))
+            for name in self.idle_responses if name in untagged)
+
+    @synchronized
+    def is_alive(self, max_idle=0):
+        """Check if the connection can still be used.
+
+        A NOOP command is only sent to the server if the connection
+        has not been used for more than ``max_idle`` seconds.
+
+        :param int max_idle: age (in seconds) under which the
+                             connection is considered healthy
+        :return: a boolean
+        """
+        if self.m is None or self.broken:
+            return False
+        if time.time() - self.last_used <= max_idle:
+            return True
+        try:
+            self._cmd("NOOP")
+        except ImapError:
+            return False
+        return True
+
+    @synchronized
     def login(self, user, passwd):
         """Custom login method
 
@@ -289,7 +1446,11 @@ class IMAPconnector(object):
         else:
             data = self._cmd("CAPABILITY")
             self.capabilities = data[0].decode().split()
+        if "QRESYNC" in self.capabilities:
+            # Required to receive VANISHED responses (RFC 7162)
+            self._cmd("ENABLE", "QRESYNC")
 
+    @synchronized
     def logout(self):
         """Logout from server."""
         try:
@@ -297,52 +1458,16 @@ class IMAPconnector(object):
         except ImapError:
             pass
         self._cmd("LOGOUT")
-        del self.m
-        self.m = None
-        if hasattr(self, "current_mailbox"):
-            del self.current_mailbox
-
-    def load_namespaces(self):
-        """Load available namespaces."""
-        data = self._cmd("NAMESPACE")
-        nslist = self.namespaces_pattern.findall(data[0].decode())
-        for pos, item in enumerate(["personal", "others", "public"]):
-            if nslist[pos] == "NIL":
-                continue
-            ns = nslist[pos][1:-1]
-            for m in self.namespace_pattern.finditer(ns):
-                if self.__hdelimiter is None:
-                    self.__hdelimiter = m.group("delimiter")
-                if item not in self.__ns_prefixes:
-                    self.__ns_prefixes[item] = []
-                self.__ns_prefixes[item].append(m.group("prefix"))
-
-    def parse_search_parameters(self, criterion, pattern):
-        """Parse search information and apply them."""
-
-        def or_criterion(old, c):
-            if old == "":
-                return c
-            return "OR (%s) (%s)" % (old, c)
+        del self.m
+        self.m = None
+        if hasattr(self, "current_mailbox"):
+            del self.current_mailbox
 
-        if criterion == u"both":
-            criterion = u"from_addr, subject"
-        criterions = ""
-        for c in criterion.split(','):
-            if c == "from_addr":
-                key = "FROM"
-            elif c == "subject":
-                key = "SUBJECT"
-            else:
-                continue
-            criterions = or_criterion(
-                criterions, '(%s "%s")' % (key, pattern))
-        if six.PY3:
-            criterions = bytearray(criterions, "utf-8")
-        elif isinstance(criterions, six.text_type):
-            criterions = criterions.encode("utf-8")
-        self.criterions = [criterions]
+    def load_namespaces(self):
+        """Load available namespaces."""
+        self._parse_namespaces(self._cmd("NAMESPACE"))
 
+    @synchronized
     def messages_count(self, **kwargs):
         """An enhanced version of messages_count
 
@@ -351,31 +1476,146 @@ class IMAPconnector(object):
         multiplications, we sort messages in the same time. This will
         be usefull for other methods.
 
+        If ``start`` and ``stop`` are given, only the UIDs of the
+        messages inside this window are needed (when supported by the
+        server).
+
         :param order: sorting order
         :param folder: mailbox to scan
+        :param start: index of the first message to retrieve
+        :param stop: index of the last message to retrieve
         """
-        if "order" in kwargs and kwargs["order"]:
-            sign = kwargs["order"][:1]
-            criterion = kwargs["order"][1:].upper()
-            if sign == '-':
-                criterion = "REVERSE %s" % criterion
-        else:
-            criterion = "REVERSE DATE"
+        criterion = self._get_sort_criterion(kwargs.get("order"))
         folder = kwargs["folder"] if "folder" in kwargs else None
 
         # FIXME: pourquoi suis je obligé de faire un SELECT ici?  un
         # EXAMINE plante mais je pense que c'est du à une mauvaise
         # lecture des réponses de ma part...
+        start, stop = kwargs.get("start"), kwargs.get("stop")
+        # The sorted list of UIDs is kept until the mailbox changes.
+        # The quota is retrieved at the same time.
+        self._refresh_mailbox_state(
+            folder, lambda pipe: self.getquota(folder, pipeline=pipe))
+        state = self._get_mailbox_state_key()
+        key = (criterion, [bytes(c) for c in self.criterions])
+        cached = None
+        if state is not None:
+            cached = cache.sorted_uids.get(self.user, folder, state, *key)
+            if cached is None and start and stop:
+                cached = cache.sorted_uids.get(
+                    self.user, folder, state, *(key + (start, stop)))
+        if cached is not None:
+            count, self.messages, self.messages_offset = cached
+        else:
+            count = self._sort_messages(criterion, start, stop)
+            if self.messages_offset or len(self.messages) != count:
+                key += (start, stop)
+            if state is not None:
+                cache.sorted_uids.set(
+                    self.user, folder, state,
+                    (count, self.messages, self.messages_offset), *key)
+        return count
+
+    def _refresh_mailbox_state(self, folder, callback=None):
+        """Select a mailbox and make sure ``mailbox_state`` is up to
+        date.
+
+        If the mailbox was already selected, changes are reported by
+        NOOP (STATUS must not be used on the selected mailbox): it is
+        selected again in this case.
+
+        :param folder: the mailbox's name
+        :param callback: a function called with the ``Pipeline`` used
+                         to send NOOP, to queue other commands
+        """
+        selected = getattr(self, "current_mailbox", None) == folder
         self.select_mailbox(folder, readonly=False)
+        with self.pipeline() as pipe:
+            if selected:
+                pipe.add("NOOP")
+            if callback is not None:
+                callback(pipe)
+        if selected and self._pop_mailbox_changes():
+            self.select_mailbox(folder, readonly=False, force=True)
+
+    def _sort_all(self, criterion, start=None, stop=None):
+        """Sort messages and retrieve the complete list of UIDs.
+
+        :return: the number of messages
+        """
         cmdname = "SORT" if six.PY3 else b"SORT"
         data = self._cmd(
             cmdname,
             bytearray("(%s)" % criterion, "utf-8"),
             b"UTF-8", b"(NOT DELETED)", *self.criterions)
         self.messages = data[0].decode().split()
-        self.getquota(folder)
+        self.messages_offset = 0
         return len(self.messages)
 
+    @capability('CONTEXT=SORT', '_sort_all')
+    def _sort_messages(self, criterion, start=None, stop=None):
+        """Sort messages and retrieve a window of UIDs (RFC 5267).
+
+        Only the number of messages and the UIDs between positions
+        ``start`` and ``stop`` are returned by the server.
+
+        :return: the number of messages
+        """
+        if not start or not stop or start < 1:
+            return self._sort_all(criterion)
+        self.m.untagged_responses.pop("ESEARCH", None)
+        self._cmd(
+            "SORT", b"RETURN",
+            bytearray("(COUNT PARTIAL {}:{})".format(start, stop), "utf-8"),
+            bytearray("(%s)" % criterion, "utf-8"),
+            b"UTF-8", b"(NOT DELETED)", *self.criterions)
+        return self._load_sort_window(
+            self.m.untagged_responses.pop("ESEARCH", [b""])[-1], start)
+
+    @synchronized
+    def sync_mailbox(self, mbox, since=None, uids=None):
+        """Return the changes made to a mailbox since a given MODSEQ.
+
+        Changes are only computed for the given messages (the ones
+        displayed by the browser) using UID FETCH (CHANGEDSINCE), and
+        VANISHED (EARLIER) if QRESYNC is enabled. Nothing is sent
+        when the mailbox didn't change. Requires CONDSTORE (RFC 7162).
+
+        :param mbox: the mailbox's name
+        :param since: a MODSEQ value previously returned by this method
+                      or by ``get_sync_state``
+        :param list uids: UIDs of the messages to check
+        :return: None if not supported, otherwise a dictionary
+                 containing the current MODSEQ and UIDNEXT values and
+                 the changes: flags of modified messages (``changed``)
+                 and removed messages (``vanished``). ``full`` is True
+                 when these changes can't be computed. If the mailbox
+                 changed, the number of unseen messages (``unseen``) is
+                 also returned.
+        """
+        if "CONDSTORE" not in self.capabilities:
+            return None
+        self._refresh_mailbox_state(mbox)
+        result = self._new_sync_result(since, uids)
+        if result is None or result["modseq"] == since:
+            return result
+        changes = current = None
+        with self.pipeline() as pipe:
+            unseen = pipe.add("SEARCH", "UNSEEN", responses=("SEARCH",))
+            if not result["full"] and uids:
+                msgset = build_sequence_sets(uids)[0]
+                changes = pipe.add(
+                    "UID", "FETCH", msgset, "(FLAGS)",
+                    self._get_changes_modifiers(since),
+                    responses=("FETCH", "VANISHED"))
+                if "QRESYNC" not in self.capabilities:
+                    current = pipe.add(
+                        "UID", "SEARCH", "UID", msgset,
+                        responses=("SEARCH",))
+        self._load_sync_changes(result, uids, unseen, changes, current)
+        return result
+
+    @synchronized
     def select_mailbox(self, name, readonly=True, force=False):
         """Issue a SELECT/EXAMINE command to the server
 
@@ -388,134 +1628,111 @@ class IMAPconnector(object):
             if self.current_mailbox == name and not force:
                 return
         self.current_mailbox = name
+        self.uidvalidity = None
+        self.mailbox_state = {}
         name = self._encode_mbox_name(name)
+        self._pop_mailbox_changes()
         if readonly:
             self._cmd("EXAMINE", name)
         else:
             self._cmd("SELECT", name)
         self.m.state = "SELECTED"
+        self._set_mailbox_state(self.m.untagged_responses)
+        self._pop_mailbox_changes()
 
+    def _pop_mailbox_changes(self):
+        """Remove the responses describing the selected mailbox.
+
+        :return: True if changes were announced by the server
+        """
+        untagged = self.m.untagged_responses
+        changed = False
+        for name in self.idle_responses + ("RECENT",):
+            if untagged.pop(name, None):
+                changed = True
+        for name in self.mailbox_state_items:
+            untagged.pop(name, None)
+        return changed
+
+    @synchronized
     def unseen_messages(self, mailbox):
         """Return the number of unseen messages
 
         :param mailbox: the mailbox's name
         :return: an integer
         """
-        data = self._cmd(
-            "STATUS", self._encode_mbox_name(mailbox), "(UNSEEN)")
-        m = self.unseen_pattern.match(data[-1].decode())
-        if m is None:
-            return 0
-        return int(m.group(1))
+        return self._parse_unseen(self._cmd(
+            "STATUS", self._encode_mbox_name(mailbox), "(UNSEEN)"))
 
-    def _encode_mbox_name(self, folder):
-        """Encode folder name (str) to imap4-utf-7 and quote it."""
-        if not folder:
-            return "INBOX"
-        return b'"' + folder.encode("imap4-utf-7") + b'"'
+    @synchronized
+    def unseen_counters(self, mailboxes):
+        """Return the number of unseen messages of several mailboxes
 
-    def _parse_mailbox_name(self, descr, prefix, delimiter, parts):
-        if not len(parts):
-            return False
-        path = "%s%s%s" % (prefix, delimiter, parts[0])
-        sdescr = None
-        for d in descr:
-            if d["path"] == path:
-                sdescr = d
-                break
-        if sdescr is None:
-            sdescr = {"name": parts[0], "path": path, "sub": []}
-            descr += [sdescr]
-        if self._parse_mailbox_name(sdescr["sub"], path, delimiter, parts[1:]):
-            sdescr["class"] = "subfolders"
-        return True
+        STATUS commands are pipelined.
+
+        :param mailboxes: a list of mailbox names
+        :return: a dictionary (name: integer)
+        """
+        pipe = self.pipeline()
+        commands = [
+            pipe.add(
+                "STATUS", self._encode_mbox_name(name), "(UNSEEN)",
+                responses=("STATUS",))
+            for name in mailboxes
+        ]
+        pipe.execute()
+        result = {}
+        for name, command in zip(mailboxes, commands):
+            command.check()
+            result[name] = self._parse_unseen(command.responses.get("STATUS"))
+        return result
 
-    def _listmboxes_simple(self, topmailbox='INBOX', mailboxes=None, **kwargs):
-        # data = self._cmd("LIST", "", "*")
+    def _listmboxes_simple(self, topmailbox='INBOX', mailboxes=None,
+                           until_mailbox=None, statuses=None, pipeline=None):
         if not mailboxes:
             mailboxes = []
-        (status, data) = self.m.list()
-        newmboxes = []
-        for mb in data:
-            flags, delimiter, name = self.list_response_pattern.match(
-                mb.decode()).groups()
-            name = bytearray(name.strip('"'), "utf-8").decode("imap4-utf-7")
-            mdm_found = False
-            for idx, mdm in enumerate(mailboxes):
-                if mdm["name"] == name:
-                    mdm_found = True
-                    descr = mailboxes[idx]
-                    break
-            if not mdm_found:
-                descr = {"name": name}
-                newmboxes += [descr]
-
-            if re.search(r"\%s" % delimiter, name):
-                parts = name.split(delimiter)
-                if "path" not in descr:
-                    descr["path"] = parts[0]
-                    descr["sub"] = []
-                if self._parse_mailbox_name(descr["sub"], parts[0], delimiter,
-                                            parts[1:]):
-                    descr["class"] = "subfolders"
-                continue
-
-        from operator import itemgetter
-        mailboxes += sorted(newmboxes, key=itemgetter("name"))
+        pipe = pipeline if pipeline is not None else self.pipeline()
+        command = pipe.add("LIST", '""', "*", responses=("LIST",))
+        pipe.execute()
+        command.check()
+        self._parse_simple_list_responses(
+            command.responses.get("LIST", []), mailboxes)
 
     @capability('LIST-EXTENDED', '_listmboxes_simple')
-    def _listmboxes(self, topmailbox, mailboxes, until_mailbox=None):
-        """Retrieve mailboxes list."""
-        pattern = (
-            '"{0}{1}%"'.format(
-                topmailbox.encode("imap4-utf-7").decode(), self.hdelimiter)
-            if topmailbox else "%"
-        )
-        resp = self._cmd(
-            "LIST", '""', pattern, "RETURN", "(CHILDREN STATUS (MESSAGES))")
-        newmboxes = []
-        for mb in resp:
-            if not mb:
-                continue
-            if type(mb) in [list, tuple]:
-                flags, delimiter, namelen = (
-                    self.list_response_pattern_literal.match(
-                        mb[0].decode()).groups()
-                )
-                name = mb[1][0:int(namelen)]
-            else:
-                flags, delimiter, name, childinfo = (
-                    self.listextended_response_pattern.match(
-                        mb.decode()).groups())
-            flags = flags.split(" ")
-            name = bytearray(name, "utf-8")
-            name = name.decode("imap4-utf-7")
-            mdm_found = False
-            for idx, mdm in enumerate(mailboxes):
-                if mdm["name"] == name:
-                    mdm_found = True
-                    descr = mailboxes[idx]
-                    break
-            if not mdm_found:
-                descr = {"name": name}
-                newmboxes += [descr]
-
-            if '\\Marked' in flags or '\\UnMarked' not in flags:
-                descr["send_status"] = True
-            if r'\NonExistent' in flags:
-                descr["removed"] = True
-            if '\\HasChildren' in flags:
-                descr["path"] = name
-                descr["sub"] = []
-                if until_mailbox and until_mailbox.startswith(name):
-                    self._listmboxes(name, descr["sub"], until_mailbox)
+    def _listmboxes(self, topmailbox, mailboxes, until_mailbox=None,
+                    statuses=None, pipeline=None):
+        """Retrieve mailboxes list.
 
-        from operator import itemgetter
-        mailboxes += sorted(newmboxes, key=itemgetter("name"))
+        If ``statuses`` is a dictionary and the server supports
+        LIST-STATUS (RFC 5819), unseen messages counters are retrieved
+        in the same command and stored into it (name: {item: value}).
 
+        Commands queued in ``pipeline`` (if any) are sent along with
+        the first LIST command.
+        """
+        with_status = (
+            statuses is not None and "LIST-STATUS" in self.capabilities)
+        pipe = pipeline if pipeline is not None else self.pipeline()
+        command = pipe.add(
+            "LIST", '""', self._get_list_pattern(topmailbox), "RETURN",
+            self._get_list_options(with_status),
+            responses=("LIST", "STATUS"))
+        pipe.execute()
+        command.check()
+        if with_status:
+            statuses.update(self._parse_status_responses(
+                command.responses.get("STATUS", [])))
+        parents = self._parse_list_responses(
+            command.responses.get("LIST", []), mailboxes)
+        for descr in parents:
+            if until_mailbox and until_mailbox.startswith(descr["name"]):
+                self._listmboxes(
+                    descr["name"], descr["sub"], until_mailbox, statuses)
+
+    @synchronized
     def getmboxes(
             self, user, topmailbox='', until_mailbox=None,
-            unseen_messages=True):
+            unseen_messages=True, pipeline=None):
         """Returns a list of mailboxes for a particular user
 
         By default, only the first level of mailboxes under
@@ -526,43 +1743,40 @@ class IMAPconnector(object):
         :param topmailbox: the mailbox where to start in the tree
         :param until_mailbox: the deepest needed mailbox
         :param unseen_messages: include unseen messages counters or not
+        :param pipeline: a ``Pipeline`` instance whose commands are sent
+                         with the first LIST command
         :return: a list
         """
-        if topmailbox:
-            md_mailboxes = []
-        else:
-            md_mailboxes = [
-                {"name": "INBOX", "class": "fa fa-inbox",
-                 "label": _("Inbox")},
-                {"name": user.parameters.get_value("drafts_folder"),
-                 "class": "fa fa-file", "label": _("Drafts")},
-                {"name": user.parameters.get_value("junk_folder"),
-                 "class": "fa fa-fire", "label": _("Junk")},
-                {"name": user.parameters.get_value("sent_folder"),
-                 "class": "fa fa-envelope", "label": _("Sent")},
-                {"name": user.parameters.get_value("trash_folder"),
-                 "class": "fa fa-trash", "label": _("Trash")}
-            ]
+        md_mailboxes = [] if topmailbox else self._get_special_mailboxes(user)
         if until_mailbox:
             name, parent = separate_mailbox(until_mailbox, self.hdelimiter)
             if parent:
                 until_mailbox = parent
-        self._listmboxes(topmailbox, md_mailboxes, until_mailbox)
+        # Counters are returned by LIST when LIST-STATUS is supported
+        statuses = (
+            {} if unseen_messages and "LIST-STATUS" in self.capabilities
+            else None
+        )
+        self._listmboxes(
+            topmailbox, md_mailboxes, until_mailbox, statuses=statuses,
+            pipeline=pipeline)
 
         if unseen_messages:
-            for mb in md_mailboxes:
-                if "send_status" not in mb:
-                    continue
-                del mb["send_status"]
-                key = "path" if "path" in mb else "name"
-                if mb.get("removed", False):
-                    continue
-                count = self.unseen_messages(mb[key])
-                if count == 0:
-                    continue
-                mb["unseen"] = count
+            names = self._get_counted_mailboxes(md_mailboxes)
+            if statuses is not None:
+                # Non selectable mailboxes have no status
+                counters = dict(
+                    (name, statuses.get(name, {}).get("UNSEEN", 0))
+                    for mb, name in names)
+            else:
+                counters = self.unseen_counters(
+                    [name for mb, name in names])
+            for mb, name in names:
+                if counters[name]:
+                    mb["unseen"] = counters[name]
         return md_mailboxes
 
+    @synchronized
     def _add_flag(self, mbox, msgset, flag):
         """Add flag to a messages set.
 
@@ -571,8 +1785,9 @@ class IMAPconnector(object):
         :param flag: the flag to add
         """
         self.select_mailbox(mbox, False)
-        self._cmd("STORE", msgset, "+FLAGS", flag)
+        self._uid_command("STORE", msgset, "+FLAGS", flag)
 
+    @synchronized
     def _remove_flag(self, mbox, msgset, flag):
         """Remove flag from a message set.
 
@@ -581,7 +1796,7 @@ class IMAPconnector(object):
         :param flag: the flag to remove
         """
         self.select_mailbox(mbox, False)
-        self._cmd("STORE", msgset, "-FLAGS", flag)
+        self._uid_command("STORE", msgset, "-FLAGS", flag)
 
     def mark_messages_unread(self, mbox, msgset):
         """Mark a set of messages as unread
@@ -622,27 +1837,57 @@ class IMAPconnector(object):
         """Add the \Answered flag to this email"""
         self._add_flag(mailbox, mailid, r'(\Answered)')
 
+    @synchronized
+    @capability('MOVE', '_copy_and_delete')
     def move(self, msgset, oldmailbox, newmailbox):
-        """Move messages between mailboxes."""
-        self.select_mailbox(oldmailbox, False)
-        self._cmd("COPY", msgset, self._encode_mbox_name(newmailbox))
-        self._cmd("STORE", msgset, "+FLAGS", r'(\Deleted \Seen)')
+        """Move messages between mailboxes.
 
+        The UID MOVE command (RFC 6851) is used when supported by the
+        server.
+        """
+        self.select_mailbox(oldmailbox, False)
+        self._uid_command(
+            "MOVE", msgset, self._encode_mbox_name(newmailbox))
+        self.m.untagged_responses.pop("EXPUNGE", None)
+        self.m.untagged_responses.pop("VANISHED", None)
+        self._invalidate_mailboxes(oldmailbox, newmailbox)
+
+    @synchronized
+    def _copy_and_delete(self, msgset, oldmailbox, newmailbox):
+        """Move messages using COPY and STORE.
+
+        If the server supports UIDPLUS (RFC 4315), copied messages
+        are expunged using UID EXPUNGE. Otherwise, they are only
+        marked as deleted.
+        """
+        self.select_mailbox(oldmailbox, False)
+        self._uid_command(
+            "COPY", msgset, self._encode_mbox_name(newmailbox))
+        self._uid_command("STORE", msgset, "+FLAGS", r'(\Deleted \Seen)')
+        if "UIDPLUS" in self.capabilities:
+            self._uid_command("EXPUNGE", msgset)
+        self._invalidate_mailboxes(oldmailbox, newmailbox)
+
+    @synchronized
     def push_mail(self, folder, msg):
         now = imaplib.Time2Internaldate(time.time())
         msg = bytes(msg) if six.PY3 else str(msg)
+        self._invalidate_mailboxes(folder)
         return self.m.append(
             self._encode_mbox_name(folder), r'(\Seen)', now, msg)
 
+    @synchronized
     def empty(self, mbox):
         self.select_mailbox(mbox, False)
         resp = self._cmd("SEARCH", "ALL")
-        seq = b",".join(resp[0].split())
-        if seq == b"":
+        uids = resp[0].split()
+        if not uids:
             return
-        self._cmd("STORE", seq, "+FLAGS", r'(\Deleted)')
+        self._uid_command("STORE", uids, "+FLAGS", r'(\Deleted)')
         self._cmd("EXPUNGE")
+        self._invalidate_mailboxes(mbox)
 
+    @synchronized
     def compact(self, mbox):
         """Compact a specific mailbox
 
@@ -652,7 +1897,9 @@ class IMAPconnector(object):
         """
         self.select_mailbox(mbox, False)
         self._cmd("EXPUNGE")
+        self._invalidate_mailboxes(mbox)
 
+    @synchronized
     def create_folder(self, name, parent=None):
         if parent is not None:
             name = "%s%s%s" % (parent, self.hdelimiter, name)
@@ -661,6 +1908,7 @@ class IMAPconnector(object):
             raise WebmailInternalError(data[0])
         return True
 
+    @synchronized
     def rename_folder(self, oldname, newname):
         typ, data = self.m.rename(self._encode_mbox_name(oldname),
                                   self._encode_mbox_name(newname))
@@ -668,44 +1916,35 @@ class IMAPconnector(object):
             raise WebmailInternalError(data[0], ajax=True)
         return True
 
+    @synchronized
     def delete_folder(self, name):
         typ, data = self.m.delete(self._encode_mbox_name(name))
         if typ == "NO":
             raise WebmailInternalError(data[0])
         return True
 
-    def getquota(self, mailbox):
+    @synchronized
+    def getquota(self, mailbox, pipeline=None):
         """Retrieve quota information from the server.
 
         We also compute the current usage.
+
+        :param mailbox: the mailbox's name
+        :param pipeline: a ``Pipeline`` instance. If specified, the
+                         command is only queued: quota information is
+                         available once the pipeline is executed.
         """
         if "QUOTA" not in self.capabilities:
             self.quota_limit = self.quota_current = None
             return
-        try:
-            data = self._cmd("GETQUOTAROOT", self._encode_mbox_name(mailbox),
-                             responses=["QUOTAROOT", "QUOTA"])
-        except ImapError:
-            data = None
-        finally:
-            if data is None:
-                self.quota_limit = self.quota_current = None
-                return
-
-        quotadef = data[1][0].decode()
-        m = re.search(r"\(STORAGE (\d+) (\d+)\)", quotadef)
-        if not m:
-            print("Problem while parsing quota def")
-            return
-        self.quota_limit = int(m.group(2))
-        self.quota_current = int(m.group(1))
-        try:
-            self.quota_usage = (
-                int(float(self.quota_current) / float(self.quota_limit) * 100)
-            )
-        except TypeError:
-            self.quota_usage = -1
-
+        pipe = pipeline if pipeline is not None else self.pipeline()
+        pipe.add(
+            "GETQUOTAROOT", self._encode_mbox_name(mailbox),
+            responses=("QUOTAROOT", "QUOTA"), callback=self._parse_quota)
+        if pipeline is None:
+            pipe.execute()
+
+    @synchronized
     def fetchpart(self, uid, mbox, partnum):
         """Retrieve a specific message part
 
@@ -718,11 +1957,78 @@ class IMAPconnector(object):
         :return: a 2uple (dict, string)
         """
         self.select_mailbox(mbox, False)
-        data = self._cmd("FETCH", uid, "(BODYSTRUCTURE BODY[%s])" % partnum)
-        bs = BodyStructure(data[int(uid)]["BODYSTRUCTURE"])
+        bs = self._get_cached_bodystructure(uid)
+        if bs is None:
+            data = self._cmd(
+                "FETCH", uid, "(BODYSTRUCTURE BODY[%s])" % partnum)
+            bs = self._cache_bodystructure(
+                uid, data[int(uid)]["BODYSTRUCTURE"])
+        else:
+            data = self._cmd("FETCH", uid, "(BODY[%s])" % partnum)
         attdef = bs.find_attachment(partnum)
         return attdef, data[int(uid)]["BODY[%s]" % partnum]
 
+    @synchronized
+    def fetchpart_range(self, uid, mbox, partnum, offset, length):
+        """Retrieve a slice of a message part (partial FETCH)
+
+        The message is not marked as read.
+
+        :param uid: a message UID
+        :param mbox: the mailbox containing the message
+        :param partnum: the part number
+        :param int offset: position of the first octet to retrieve
+        :param int length: maximum number of octets to retrieve
+        :return: bytes (empty once the end of the part is reached)
+        """
+        self.select_mailbox(mbox, False)
+        data = self._cmd(
+            "FETCH", uid,
+            "(BODY.PEEK[{}]<{}.{}>)".format(partnum, offset, length),
+            decode_literals=False)
+        msg = data.get(int(uid), {})
+        return msg.get("BODY[{}]<{}>".format(partnum, offset)) or b""
+
+    @synchronized
+    def fetchparts(self, mbox, uid, pnums, headers=None, readonly=True):
+        """Retrieve several parts of a message using one FETCH command.
+
+        :param mbox: the mailbox containing the message
+        :param uid: a message UID
+        :param pnums: a list of part numbers
+        :param headers: names of headers to retrieve too (space separated)
+        :param readonly: if False, the message is marked as seen
+        :return: a 2uple (headers or None, dict of payloads by part
+                 number). Payloads are returned as bytes, they must be
+                 decoded using the charset of their part.
+        """
+        self.select_mailbox(mbox, False)
+        query = self._get_parts_query(pnums, headers, readonly)
+        if query is None:
+            return None, {}
+        data = self._cmd("FETCH", uid, query, decode_literals=False)
+        return self._extract_parts(data.get(int(uid), {}), pnums, headers)
+
+    @synchronized
+    def get_bodystructure(self, mbox, uid, fetch=True):
+        """Return the structure of a message.
+
+        The server is only asked if the structure is not cached.
+
+        :param mbox: the mailbox containing the message
+        :param uid: a message UID
+        :param bool fetch: if False, don't ask the server
+        :return: a ``BodyStructure`` instance (or None)
+        """
+        self.select_mailbox(mbox, False)
+        bs = self._get_cached_bodystructure(uid)
+        if bs is None and fetch:
+            data = self._cmd("FETCH", uid, "(BODYSTRUCTURE)")
+            bs = self._cache_bodystructure(
+                uid, data[int(uid)]["BODYSTRUCTURE"])
+        return bs
+
+    @synchronized
     def fetch(self, start, stop=None, mbox=None):
         """Retrieve information about messages from the server
 
@@ -734,40 +2040,64 @@ class IMAPconnector(object):
         :param mbox: the mailbox that contains the messages
         """
         self.select_mailbox(mbox, False)
-        if start and stop:
-            submessages = self.messages[start - 1:stop]
-            mrange = ",".join(submessages)
-        else:
-            submessages = [start]
-            mrange = start
-        headers = "DATE FROM TO CC SUBJECT"
-        query = (
-            "(FLAGS BODYSTRUCTURE RFC822.SIZE BODY.PEEK[HEADER.FIELDS ({})])"
-            .format(headers)
-        )
-        data = self._cmd("FETCH", mrange, query)
-        result = []
-        for uid in submessages:
-            msg_data = data[int(uid)]
-            msg = email.message_from_string(
-                msg_data["BODY[HEADER.FIELDS ({})]".format(headers)]
-            )
-            msg["imapid"] = uid
-            msg["size"] = msg_data["RFC822.SIZE"]
-            if r"\Seen" not in msg_data["FLAGS"]:
-                msg["style"] = "unseen"
-            if r"\Answered" in msg_data["FLAGS"]:
-                msg["answered"] = True
-            if r"$Forwarded" in msg_data["FLAGS"]:
-                msg["forwarded"] = True
-            if r"\Flagged" in msg_data["FLAGS"]:
-                msg["flagged"] = True
-            bstruct = BodyStructure(msg_data["BODYSTRUCTURE"])
-            if bstruct.has_attachments():
-                msg["attachments"] = True
-            result += [msg]
-        return result
-
+        uids = self._get_listing_uids(start, stop)
+        summaries = cache.headers.get_many(
+            self.user, self.current_mailbox, self.uidvalidity, uids)
+        missing = [uid for uid in uids if uid not in summaries]
+        flags = {}
+        if len(missing) != len(uids):
+            # Headers, size and structure never change: only flags
+            # need to be retrieved for cached messages
+            for uid, msg_data in self.iterfetch(
+                    [uid for uid in uids if uid in summaries], "(FLAGS)"):
+                flags[uid] = msg_data["FLAGS"]
+        if missing:
+            flags.update(self._fetch_summaries(missing, summaries))
+        return self._build_listing(uids, summaries, flags)
+
+    def _fetch_summaries(self, uids, summaries):
+        """Retrieve the data displayed in listings for a list of messages.
+
+        The presence of attachments is deduced from the Content-Type
+        header and flags when possible (see ``guess_attachments``):
+        BODYSTRUCTUREs are only retrieved (and cached) for the other
+        messages. Summaries (headers, size and attachments presence)
+        are stored in the cache.
+
+        :param list uids: list of UIDs
+        :param dict summaries: dictionary to update (uid: summary)
+        :return: the flags of each message (dict)
+        """
+        flags = {}
+        new_summaries = {}
+        unknown = []
+        for uid, msg_data in self.iterfetch(uids, self.summary_query):
+            flags[uid] = msg_data["FLAGS"]
+            new_summaries[uid] = self._make_summary(msg_data)
+            if new_summaries[uid]["attachments"] is None:
+                unknown.append(uid)
+        if unknown:
+            bstructs = cache.bodystructures.get_many(
+                self.user, self.current_mailbox, self.uidvalidity, unknown)
+            missing = [uid for uid in unknown if uid not in bstructs]
+            if missing:
+                fetched = dict(
+                    (uid, BodyStructure(msg_data["BODYSTRUCTURE"]))
+                    for uid, msg_data in self.iterfetch(
+                        missing, "(BODYSTRUCTURE)"))
+                cache.bodystructures.set_many(
+                    self.user, self.current_mailbox, self.uidvalidity,
+                    fetched)
+                bstructs.update(fetched)
+            for uid in unknown:
+                new_summaries[uid]["attachments"] = bool(
+                    bstructs[uid].has_attachments())
+        cache.headers.set_many(
+            self.user, self.current_mailbox, self.uidvalidity, new_summaries)
+        summaries.update(new_summaries)
+        return flags
+
+    @synchronized
     def fetchmail(self, mbox, mailid, readonly=True, what="bodystructure"):
         """Retrieve information about a specific message
 
@@ -777,22 +2107,25 @@ class IMAPconnector(object):
         result and to the user's preferences, we retrieve the
         appropriate content (plain, html, etc.).
 
+        When headers are requested, the BODYSTRUCTURE is also
+        retrieved (unless it is already cached) and stored in the
+        cache: use ``get_bodystructure`` to access it.
+
         :param mbox: the mailbox containing the message
         :param mailid: the message's unique id
         :param readonly:
         :param headers:
         """
         self.select_mailbox(mbox, readonly)
-        if what == "bodystructure":
-            to_fetch = "(BODYSTRUCTURE)"
-        elif what == "source":
-            to_fetch = "(BODY[])"
-        else:
-            bcmd = "BODY.PEEK" if readonly else "BODY"
-            to_fetch = "(BODYSTRUCTURE {}[HEADER.FIELDS ({})])".format(
-                bcmd, what)
-        data = self._cmd("FETCH", mailid, to_fetch)
-        return data[int(mailid)]
+        cached = False
+        if what not in ("bodystructure", "source"):
+            cached = self._get_cached_bodystructure(mailid) is not None
+        data = self._cmd(
+            "FETCH", mailid, self._get_fetchmail_query(what, readonly, cached))
+        msg = data[int(mailid)]
+        if "BODYSTRUCTURE" in msg:
+            self._cache_bodystructure(mailid, msg["BODYSTRUCTURE"])
+        return msg
 
 
 def separate_mailbox(fullname, sep="."):
@@ -809,14 +2142,261 @@ def separate_mailbox(fullname, sep="."):
     return fullname, None
 
 
+class IMAPConnectionPool(object):
+
+    """Pool of IMAP connections.
+
+    One pool exists per worker process. Connections are grouped by
+    user and each one is handed to a single request at a time (see
+    ``checkout`` and ``checkin``). The number of connections a user
+    can open is bounded and connections that remain unused for too
+    long are closed.
+    """
+
+    #: Maximum time (in seconds) a request waits for a free connection
+    checkout_timeout = 30
+
+    def __init__(self):
+        self._lock = threading.Condition()
+        self._idle = {}
+        self._sizes = {}
+        self._generations = {}
+
+    def _get_conf(self):
+        return dict(param_tools.get_global_parameters("modoboa_webmail"))
+
+    def _close(self, imapc):
+        """Logout from server, ignoring errors."""
+        if imapc.m is None:
+            return
+        try:
+            imapc.logout()
+        except (ImapError, imaplib.IMAP4.error, socket.error):
+            pass
+
+    def _release_slot(self, user):
+        """Forget about a connection (lock must be held)."""
+        self._sizes[user] -= 1
+        if not self._sizes[user]:
+            del self._sizes[user]
+        self._lock.notify_all()
+
+    def _pop_expired(self, ttl):
+        """Remove idle connections unused for more than ``ttl`` seconds.
+
+        Lock must be held.
+
+        :return: the list of removed connections
+        """
+        limit = time.time() - ttl
+        expired = []
+        for user in list(self._idle.keys()):
+            alive = []
+            for imapc in self._idle[user]:
+                if imapc.last_used < limit:
+                    expired.append(imapc)
+                    self._release_slot(user)
+                else:
+                    alive.append(imapc)
+            if alive:
+                self._idle[user] = alive
+            else:
+                del self._idle[user]
+        return expired
+
+    def evict_idle(self, ttl=None):
+        """Close connections that have been idle for too long.
+
+        :param int ttl: idle timeout in seconds (defaults to the
+                        ``imap_idle_timeout`` parameter)
+        """
+        if ttl is None:
+            ttl = self._get_conf()["imap_idle_timeout"]
+        with self._lock:
+            expired = self._pop_expired(ttl)
+        for imapc in expired:
+            self._close(imapc)
+
+    def checkout(self, user, password, timeout=None, keep_free=0):
+        """Get an exclusive connection for ``user``.
+
+        An idle connection is reused when possible. Its health is only
+        checked (using NOOP) if it has not been used recently, so
+        most requests don't pay an extra round trip. If the user
+        already has too many connections, we wait for one to be given
+        back.
+
+        :param str user: the username
+        :param str password: the password (in clear)
+        :param int timeout: maximum waiting time in seconds (defaults
+                            to ``checkout_timeout``)
+        :param int keep_free: number of connections that must remain
+                              available for other requests
+        :return: an ``IMAPconnector`` instance
+        """
+        conf = self._get_conf()
+        if timeout is None:
+            timeout = self.checkout_timeout
+        deadline = time.time() + timeout
+        imapc = None
+        with self._lock:
+            expired = self._pop_expired(conf["imap_idle_timeout"])
+            while True:
+                idle = self._idle.get(user)
+                busy = self._sizes.get(user, 0) - len(idle or [])
+                if busy < conf["imap_max_connections"] - keep_free:
+                    if idle:
+                        imapc = idle.pop()
+                    else:
+                        self._sizes[user] = self._sizes.get(user, 0) + 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise ImapError(
+                        _("Too many simultaneous IMAP connections"))
+                self._lock.wait(remaining)
+            generation = self._generations.get(user, 0)
+        for oldimapc in expired:
+            self._close(oldimapc)
+        if imapc is not None:
+            if imapc.is_alive(conf["imap_check_interval"]):
+                return imapc
+            # The server probably went away (restart, timeout): other
+            # idle connections of this user are likely dead too, so
+            # we drop them instead of checking them one by one.
+            self._close(imapc)
+            with self._lock:
+                stale = self._idle.pop(user, [])
+                for oldimapc in stale:
+                    self._release_slot(user)
+            for oldimapc in stale:
+                self._close(oldimapc)
+        try:
+            imapc = IMAPconnector(user=user, password=password)
+        except Exception:
+            with self._lock:
+                self._release_slot(user)
+            raise
+        imapc.pool_generation = generation
+        return imapc
+
+    def checkin(self, imapc):
+        """Give a connection back to the pool.
+
+        Broken connections (and the ones opened before the last call
+        to ``clear``) are discarded.
+
+        :param imapc: an ``IMAPconnector`` instance
+        """
+        user = imapc.user
+        with imapc.lock:
+            imapc.reset_state()
+        with self._lock:
+            discard = (
+                imapc.m is None or imapc.broken or
+                getattr(imapc, "pool_generation", 0) !=
+                self._generations.get(user, 0)
+            )
+            if discard:
+                self._release_slot(user)
+            else:
+                self._idle.setdefault(user, []).append(imapc)
+                self._lock.notify_all()
+        if discard:
+            self._close(imapc)
+
+    def clear(self, user=None):
+        """Close connections of a user (or of every user).
+
+        Idle connections are closed immediately, connections in use
+        are closed when given back.
+
+        :param str user: a username
+        """
+        with self._lock:
+            users = [user] if user is not None else list(self._sizes.keys())
+            idle = []
+            for name in users:
+                self._generations[name] = self._generations.get(name, 0) + 1
+                for imapc in self._idle.pop(name, []):
+                    idle.append(imapc)
+                    self._release_slot(name)
+        for imapc in idle:
+            self._close(imapc)
+
+
+connections_pool = IMAPConnectionPool()
+_requests_lock = threading.Lock()
+
+
 def get_imapconnector(request):
-    """Simple shortcut to create a connector
+    """Simple shortcut to get a connector
+
+    The connector is checked out from the pool the first time this
+    function is called for a request. Next calls return the same
+    object until ``release_imapconnector`` is called.
+
+    :param request: a ``Request`` object
+    """
+    imapc = getattr(request, "_imapconnector", None)
+    if imapc is not None:
+        return imapc
+    imapc = connections_pool.checkout(
+        request.user.username, get_password(request))
+    with _requests_lock:
+        # Another thread serving the same request may have been faster
+        current = getattr(request, "_imapconnector", None)
+        if current is None:
+            request._imapconnector = imapc
+            return imapc
+    connections_pool.checkin(imapc)
+    return current
+
+
+def detach_imapconnector(request):
+    """Take the connector of a request away from it.
+
+    The connector won't be released at the end of the request: the
+    caller becomes responsible for giving it back to the pool.
+
+    :param request: a ``Request`` object
+    :return: an ``IMAPconnector`` instance (or None)
+    """
+    with _requests_lock:
+        return request.__dict__.pop("_imapconnector", None)
+
+
+def release_imapconnector(request):
+    """Give the connector used by a request back to the pool.
+
+    :param request: a ``Request`` object
+    """
+    with _requests_lock:
+        imapc = getattr(request, "_imapconnector", None)
+        if imapc is None:
+            return
+        del request._imapconnector
+    connections_pool.checkin(imapc)
+
+
+@contextmanager
+def imapconnector_scope(request):
+    """Release the connector of a request when leaving this block.
+
+    Scopes can be nested (a view calling another view): only the
+    outermost one releases the connector.
 
     :param request: a ``Request`` object
     """
-    imapc = IMAPconnector(user=request.user.username,
-                          password=request.session["password"])
-    return imapc
+    if getattr(request, "_imapconnector_scope", False):
+        yield
+        return
+    request._imapconnector_scope = True
+    try:
+        yield
+    finally:
+        request._imapconnector_scope = False
+        release_imapconnector(request)
 
 
 if __name__ == "__main__":
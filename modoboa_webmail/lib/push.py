@@ -0,0 +1,184 @@
+"""Push notifications using server-sent events.
+
+A stream keeps a dedicated IMAP connection waiting for changes in the
+displayed mailbox using IDLE (RFC 2177). When the server announces
+changes, the new state of the mailbox is sent to the browser, which
+retrieves the changes made to the displayed messages using the
+``sync`` view (see ``IMAPconnector.sync_mailbox``). Unseen messages
+counters of the other visible mailboxes are refreshed regularly using
+the same connection.
+
+Streams are closed after ``STREAM_LIFETIME`` seconds, browsers
+reconnect automatically. The connection used by a stream is taken
+from the pool, so it counts against the ``imap_max_connections``
+limit.
+
+``aiter_events`` is the variant used by the asynchronous ``events``
+view: under ASGI, the content of a synchronous stream is buffered.
+"""
+
+import imaplib
+import json
+import socket
+import time
+
+from ..exceptions import ImapError
+
+#: Lifetime of a stream (in seconds)
+STREAM_LIFETIME = 600
+
+#: Maximum time between two messages sent to the browser (in seconds)
+KEEPALIVE_INTERVAL = 30
+
+#: Time to wait before reconnecting (in milliseconds)
+RETRY_DELAY = 5000
+
+
+def is_supported(imapc):
+    """Check if the IMAP server can notify changes."""
+    return "IDLE" in imapc.capabilities
+
+
+def format_event(name, data):
+    """Return a server-sent event."""
+    return "event: {}\ndata: {}\n\n".format(name, json.dumps(data))
+
+
+def get_mailbox_changes(imapc, mbox, since=None):
+    """Return the state of a mailbox which changed.
+
+    Changes of messages are not computed here: the browser only knows
+    which ones are displayed. Without CONDSTORE, only the number of
+    unseen messages is known (``full`` is True).
+    """
+    result = imapc.sync_mailbox(mbox, since) or {"full": True}
+    if "unseen" not in result:
+        result["unseen"] = imapc.unseen_messages(mbox)
+    result["mbox"] = mbox
+    return result
+
+
+async def aget_mailbox_changes(imapc, mbox, since=None):
+    """Asynchronous version of ``get_mailbox_changes``."""
+    result = await imapc.sync_mailbox(mbox, since) or {"full": True}
+    if "unseen" not in result:
+        result["unseen"] = await imapc.unseen_messages(mbox)
+    result["mbox"] = mbox
+    return result
+
+
+def iter_events(imapc, mbox, since=None, mailboxes=None, interval=300,
+                lifetime=STREAM_LIFETIME, release=None):
+    """Generate the content of a stream.
+
+    Two kinds of events are sent: ``mailbox`` (changes made to
+    ``mbox``, see ``get_mailbox_changes``) and ``counters`` (unseen
+    messages counters which changed).
+
+    The connector is released when the stream ends.
+
+    :param imapc: a dedicated ``IMAPconnector`` instance
+    :param str mbox: the mailbox to watch
+    :param int since: the MODSEQ value known by the browser
+    :param list mailboxes: mailboxes whose counters must be refreshed
+    :param int interval: counters refresh interval (in seconds)
+    :param int lifetime: lifetime of the stream (in seconds)
+    :param release: a function called with the connector when the
+                    stream ends (the connector is closed by default)
+    """
+    try:
+        yield "retry: {}\n\n".format(RETRY_DELAY)
+        imapc.select_mailbox(mbox, readonly=True)
+        now = time.time()
+        deadline = now + lifetime
+        next_check = now + interval
+        counters = {}
+        while now < deadline:
+            if mailboxes and now >= next_check:
+                changed = dict(
+                    (name, count)
+                    for name, count in imapc.unseen_counters(
+                        mailboxes).items()
+                    if counters.get(name) != count
+                )
+                if changed:
+                    counters.update(changed)
+                    yield format_event("counters", changed)
+                next_check = now + interval
+            timeout = min(KEEPALIVE_INTERVAL, deadline - now)
+            if mailboxes:
+                timeout = min(timeout, next_check - now)
+            if imapc.idle(max(timeout, 0)):
+                # Announced changes are consumed: get a fresh state
+                imapc.select_mailbox(mbox, readonly=True, force=True)
+                changes = get_mailbox_changes(imapc, mbox, since)
+                since = changes.get("modseq", since)
+                yield format_event("mailbox", changes)
+            else:
+                yield ": keepalive\n\n"
+            now = time.time()
+    except ImapError:
+        # The browser will reconnect
+        pass
+    finally:
+        if release is not None:
+            release(imapc)
+        else:
+            try:
+                imapc.logout()
+            except (ImapError, imaplib.IMAP4.error, socket.error):
+                pass
+
+
+async def aiter_events(imapc, mbox, since=None, mailboxes=None,
+                       interval=300, lifetime=STREAM_LIFETIME,
+                       release=None):
+    """Asynchronous version of ``iter_events``.
+
+    :param imapc: a dedicated ``AsyncIMAPconnector`` instance
+    :param release: a coroutine function called with the connector
+                    when the stream ends (the connector is closed by
+                    default)
+    """
+    try:
+        yield "retry: {}\n\n".format(RETRY_DELAY)
+        await imapc.select_mailbox(mbox, readonly=True)
+        now = time.time()
+        deadline = now + lifetime
+        next_check = now + interval
+        counters = {}
+        while now < deadline:
+            if mailboxes and now >= next_check:
+                changed = dict(
+                    (name, count)
+                    for name, count in (
+                        await imapc.unseen_counters(mailboxes)).items()
+                    if counters.get(name) != count
+                )
+                if changed:
+                    counters.update(changed)
+                    yield format_event("counters", changed)
+                next_check = now + interval
+            timeout = min(KEEPALIVE_INTERVAL, deadline - now)
+            if mailboxes:
+                timeout = min(timeout, next_check - now)
+            if await imapc.idle(max(timeout, 0)):
+                # Announced changes are consumed: get a fresh state
+                await imapc.select_mailbox(mbox, readonly=True, force=True)
+                changes = await aget_mailbox_changes(imapc, mbox, since)
+                since = changes.get("modseq", since)
+                yield format_event("mailbox", changes)
+            else:
+                yield ": keepalive\n\n"
+            now = time.time()
+    except (ImapError, OSError):
+        # The browser will reconnect
+        pass
+    finally:
+        if release is not None:
+            await release(imapc)
+        else:
+            try:
+                await imapc.logout()
+            except (ImapError, OSError):
+                pass
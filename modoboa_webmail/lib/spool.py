@@ -0,0 +1,244 @@
+"""Local spool for decoded message parts.
+
+Decoded parts (attachments, inline images) are stored on disk so they
+can be served again (or partially, to answer HTTP Range requests)
+without asking the IMAP server. Like the content they hold, files are
+immutable: they are identified by (user, mailbox, UIDVALIDITY, UID,
+part number).
+
+The spool must not be served by the web server: it lives in the
+directory given by the ``WEBMAIL_SPOOL_DIR`` setting (``webmail_spool``
+next to ``MEDIA_ROOT`` by default) and file names are keyed hashes.
+
+The total size of the spool is limited (``spool_max_size`` parameter).
+Reading a part updates its modification time so the least recently
+used parts are removed first (see ``cleanup``).
+"""
+
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.utils.crypto import salted_hmac
+
+from modoboa.parameters import tools as param_tools
+
+#: Size of the chunks read from spooled files (in octets)
+CHUNK_SIZE = 64 * 1024
+
+#: Temporary files older than this (in seconds) are leftovers
+TMPFILE_LIFETIME = 3600
+
+#: When the spool is full, it is reduced to this fraction of its
+#: maximum size so it isn't scanned again on the next store
+LOW_WATER_MARK = 0.9
+
+_lock = threading.Lock()
+#: Estimated size of the spool (in octets), updated by this process
+_usage = None
+
+
+def get_max_size():
+    """Return the maximum size of the spool (in octets)."""
+    conf = dict(param_tools.get_global_parameters("modoboa_webmail"))
+    return conf["spool_max_size"] * 1024 * 1024
+
+
+def get_spool_dir():
+    """Return the directory of the spool."""
+    path = getattr(settings, "WEBMAIL_SPOOL_DIR", None)
+    if path is None:
+        path = os.path.join(
+            os.path.dirname(os.path.normpath(settings.MEDIA_ROOT)),
+            "webmail_spool")
+    return path
+
+
+def get_path(user, mailbox, uidvalidity, uid, pnum):
+    """Return the path of a spooled part.
+
+    File names must not be guessable: they are keyed using the secret
+    key.
+    """
+    key = u"{}\x00{}\x00{}\x00{}\x00{}".format(
+        user, mailbox or "INBOX", uidvalidity, uid, pnum)
+    return os.path.join(
+        get_spool_dir(),
+        salted_hmac(
+            "modoboa_webmail.spool", key, algorithm="sha256").hexdigest())
+
+
+def get(user, mailbox, uidvalidity, uid, pnum):
+    """Return the path of a spooled part if it exists (or None).
+
+    The part is marked as recently used.
+    """
+    if uidvalidity is None:
+        return None
+    path = get_path(user, mailbox, uidvalidity, uid, pnum)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+
+def read(user, mailbox, uidvalidity, uid, pnum):
+    """Return the content of a spooled part (or None)."""
+    path = get(user, mailbox, uidvalidity, uid, pnum)
+    if path is None:
+        return None
+    try:
+        with open(path, "rb") as fp:
+            return fp.read()
+    except FileNotFoundError:
+        # Removed in the meantime
+        return None
+
+
+def store(user, mailbox, uidvalidity, uid, pnum, chunks, max_size=None):
+    """Store a part.
+
+    The file is written under a temporary name and then renamed so
+    readers never see incomplete content. Old parts are removed if
+    the spool becomes too big.
+
+    :param chunks: an iterable returning the decoded content
+    :param int max_size: maximum size of the spool in octets (defaults
+                         to the ``spool_max_size`` parameter). Must be
+                         given when called from another thread than
+                         the request's one.
+    :return: the path of the spooled part
+    """
+    path = get_path(user, mailbox, uidvalidity, uid, pnum)
+    dirname = os.path.dirname(path)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname, mode=0o700, exist_ok=True)
+    fd, tmppath = tempfile.mkstemp(dir=dirname, prefix=".")
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            for chunk in chunks:
+                if not isinstance(chunk, bytes):
+                    chunk = chunk.encode("utf-8")
+                fp.write(chunk)
+                size += len(chunk)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+    _account(path, size, max_size)
+    return path
+
+
+def _account(path, size, max_size=None):
+    """Take a new part into account, clean the spool if needed."""
+    global _usage
+
+    if max_size is None:
+        max_size = get_max_size()
+    with _lock:
+        if _usage is not None and _usage + size <= max_size:
+            _usage += size
+            return
+    cleanup(max_size, keep=path)
+
+
+def _list_entries(dirname):
+    """Return the spooled parts, least recently used first.
+
+    Leftover temporary files are removed.
+
+    :return: a list of 3-uple (modification time, size, path)
+    """
+    result = []
+    try:
+        iterator = os.scandir(dirname)
+    except FileNotFoundError:
+        return result
+    now = time.time()
+    with iterator:
+        for entry in iterator:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if not entry.is_file():
+                continue
+            if entry.name.startswith("."):
+                if stat.st_mtime < now - TMPFILE_LIFETIME:
+                    _remove(entry.path)
+                continue
+            result.append((stat.st_mtime, stat.st_size, entry.path))
+    result.sort()
+    return result
+
+
+def _remove(path):
+    """Remove a file, ignore it if it's already gone."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def cleanup(max_size=None, max_age=None, keep=None):
+    """Remove the least recently used parts.
+
+    If the spool is bigger than ``max_size``, it is reduced to
+    ``LOW_WATER_MARK`` times this size.
+
+    :param int max_size: maximum size of the spool in octets (defaults
+                         to the ``spool_max_size`` parameter)
+    :param int max_age: also remove parts unused for this number of
+                        seconds
+    :param str keep: path of a part that must not be removed
+    :return: a 2-uple (number of removed parts, size of the spool)
+    """
+    global _usage
+
+    if max_size is None:
+        max_size = get_max_size()
+    entries = _list_entries(get_spool_dir())
+    total = sum(size for mtime, size, path in entries)
+    oldest = time.time() - max_age if max_age is not None else None
+    target = max_size
+    if total > max_size:
+        target = int(max_size * LOW_WATER_MARK)
+    removed = 0
+    for mtime, size, path in entries:
+        if total <= target and (oldest is None or mtime >= oldest):
+            break
+        if path == keep:
+            continue
+        if _remove(path):
+            removed += 1
+        total -= size
+    with _lock:
+        _usage = total
+    return removed, total
+
+
+def iter_file(path, start=0, length=None):
+    """Iterate over the content of a spooled part.
+
+    :param int start: position of the first octet to return
+    :param int length: number of octets to return (all by default)
+    """
+    with open(path, "rb") as fp:
+        fp.seek(start)
+        while length is None or length > 0:
+            size = CHUNK_SIZE if length is None else min(CHUNK_SIZE, length)
+            data = fp.read(size)
+            if not data:
+                break
+            if length is not None:
+                length -= len(data)
+            yield data
@@ -1,11 +1,22 @@
 """Misc. utilities."""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import re
 from functools import wraps
 
+from asgiref.sync import async_to_sync, sync_to_async
+
 from django.shortcuts import redirect
 
 from modoboa.lib.web_utils import NavigationParameters
 from modoboa.lib.cryptutils import get_password
 
+from . import aioimap
+from .imaputils import connections_pool, imapconnector_scope
+
+#: Maximum number of threads used by ``parallel_map``
+MAX_WORKERS = 8
+
 
 def decode_payload(encoding, payload):
     """Decode the payload according to the given encoding
@@ -26,6 +37,255 @@ def decode_payload(encoding, payload):
     return payload
 
 
+def parallel_map(func, items, max_workers=MAX_WORKERS):
+    """Apply a function to several items using threads.
+
+    Useful for I/O bound operations such as storage accesses, which
+    can involve network round trips (remote storage backends).
+
+    :param func: the function to call (with one item)
+    :param list items: the items
+    :return: the list of results (in the same order)
+    """
+    if len(items) < 2:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(
+            max_workers=min(len(items), max_workers)) as executor:
+        return list(executor.map(func, items))
+
+
+async def async_iterator(iterable):
+    """Iterate over a blocking iterable from a coroutine.
+
+    Items are retrieved in a thread (for example, chunks of a file
+    served by an asynchronous view).
+
+    :param iterable: a synchronous iterable
+    """
+    iterator = iter(iterable)
+    sentinel = object()
+    get_next = sync_to_async(next, thread_sensitive=False)
+    try:
+        while True:
+            item = await get_next(iterator, sentinel)
+            if item is sentinel:
+                return
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
+
+
+def sync_iterator(aiterable):
+    """Iterate over an asynchronous iterable from a thread.
+
+    Must be consumed by a function called using ``sync_to_async``:
+    items are retrieved by the event loop of the caller.
+
+    :param aiterable: an asynchronous iterable
+    """
+    iterator = aiterable.__aiter__()
+    get_next = async_to_sync(iterator.__anext__)
+    try:
+        while True:
+            try:
+                yield get_next()
+            except StopAsyncIteration:
+                return
+    finally:
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            async_to_sync(aclose)()
+
+
+def parse_range_header(value, size):
+    """Parse the value of a Range header (RFC 7233).
+
+    Only single byte ranges are supported.
+
+    :param str value: the header's value
+    :param int size: the size of the selected representation
+    :return: a 2-uple (first, last) or None if the header must be ignored
+    :raises ValueError: if the range can't be satisfied
+    """
+    m = re.match(r"^bytes=(\d*)-(\d*)$", value.strip())
+    if m is None or m.groups() == ("", ""):
+        return None
+    first, last = m.groups()
+    if not first:
+        length = int(last)
+        if not length or not size:
+            raise ValueError("Range not satisfiable")
+        return max(size - length, 0), size - 1
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        raise ValueError("Range not satisfiable")
+    last = int(last) if last else size - 1
+    return first, min(last, size - 1)
+
+
+class PayloadDecoder(object):
+    """Incremental version of ``decode_payload``.
+
+    Data can be given by chunks of any size: incomplete sequences are
+    kept until the next call. Chunks can be str or bytes (but all of
+    the same type).
+    """
+
+    def __init__(self, encoding):
+        self.encoding = encoding.lower()
+        self.pending = None
+
+    def _split_qp(self, data):
+        """Find where quoted-printable data can be cut."""
+        end = data.rfind(b"\n" if isinstance(data, bytes) else "\n") + 1
+        if end:
+            return end
+        # No line break, just don't cut an escape sequence
+        end = len(data)
+        if data[-1:] in ("=", b"="):
+            end -= 1
+        elif data[-2:-1] in ("=", b"="):
+            end -= 2
+        return end
+
+    def decode(self, chunk):
+        """Decode a chunk of data.
+
+        :param chunk: data to decode
+        :return: decoded data
+        """
+        if self.encoding == "base64":
+            chunk = chunk[:0].join(chunk.split())
+        elif self.encoding != "quoted-printable":
+            return chunk
+        data = chunk if self.pending is None else self.pending + chunk
+        if self.encoding == "base64":
+            end = len(data) - len(data) % 4
+        else:
+            end = self._split_qp(data)
+        self.pending = data[end:]
+        return decode_payload(self.encoding, data[:end])
+
+    def flush(self):
+        """Decode remaining data."""
+        data, self.pending = self.pending, None
+        if not data:
+            return b""
+        return decode_payload(self.encoding, data)
+
+
+class MessagePartStream(object):
+    """Iterate over the decoded content of a message part.
+
+    The part is retrieved by chunks (partial FETCH) so memory usage
+    doesn't depend on its size. The given connector is reserved for
+    this stream and given back to the pool once it is closed.
+    """
+
+    #: Size of the chunks retrieved from the server (in octets)
+    chunk_size = 256 * 1024
+
+    def __init__(self, imapc, mbox, uid, partdef, offset=0, length=None):
+        """Constructor.
+
+        ``offset`` and ``length`` select a slice of the raw (encoded)
+        content, they only make sense for parts that are not encoded.
+        """
+        self.imapc = imapc
+        self.mbox = mbox
+        self.uid = uid
+        self.partdef = partdef
+        self.offset = offset
+        self.length = length
+
+    def __iter__(self):
+        decoder = PayloadDecoder(self.partdef["encoding"])
+        size = int(self.partdef["size"])
+        offset = self.offset
+        end = offset + self.length if self.length is not None else None
+        while end is None or offset < end:
+            length = self.chunk_size
+            if end is not None:
+                length = min(length, end - offset)
+            data = self.imapc.fetchpart_range(
+                self.uid, self.mbox, self.partdef["pnum"], offset, length)
+            if not data:
+                break
+            content = decoder.decode(data)
+            if content:
+                yield content
+            offset += length
+            if offset >= size and len(data) < length:
+                break
+        content = decoder.flush()
+        if content:
+            yield content
+
+    def close(self):
+        """Give the connector back to the pool."""
+        if self.imapc is not None:
+            connections_pool.checkin(self.imapc)
+            self.imapc = None
+
+
+class AsyncMessagePartStream(MessagePartStream):
+    """Asynchronous version of ``MessagePartStream``.
+
+    The connector is an ``AsyncIMAPconnector``, given back to the pool
+    of its event loop once the stream is exhausted or closed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncMessagePartStream, self).__init__(*args, **kwargs)
+        self.loop = asyncio.get_running_loop()
+
+    def __iter__(self):
+        raise TypeError("Use async for")
+
+    async def __aiter__(self):
+        try:
+            decoder = PayloadDecoder(self.partdef["encoding"])
+            size = int(self.partdef["size"])
+            offset = self.offset
+            end = offset + self.length if self.length is not None else None
+            while end is None or offset < end:
+                length = self.chunk_size
+                if end is not None:
+                    length = min(length, end - offset)
+                data = await self.imapc.fetchpart_range(
+                    self.uid, self.mbox, self.partdef["pnum"], offset,
+                    length)
+                if not data:
+                    break
+                content = decoder.decode(data)
+                if content:
+                    yield content
+                offset += length
+                if offset >= size and len(data) < length:
+                    break
+            content = decoder.flush()
+            if content:
+                yield content
+        finally:
+            await self.aclose()
+
+    async def aclose(self):
+        """Give the connector back to the pool."""
+        if self.imapc is not None:
+            imapc, self.imapc = self.imapc, None
+            await aioimap.get_connections_pool().checkin(imapc)
+
+    def close(self):
+        """Give the connector back to the pool (from any thread)."""
+        if self.imapc is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(
+                asyncio.ensure_future, self.aclose())
+
+
 class WebmailNavigationParameters(NavigationParameters):
     """Specific NavigationParameters subclass for the webmail."""
 
@@ -48,13 +308,17 @@ class WebmailNavigationParameters(NavigationParameters):
 
 def need_password(*args, **kwargs):
     """Check if the session holds the user password for the IMAP connection.
+
+    The IMAP connection used by the view (if any) is given back to the
+    pool once the view has returned.
     """
     def decorator(f):
         @wraps(f)
         def wrapped_f(request, *args, **kwargs):
             if get_password(request) is None:
                 return redirect("modoboa_webmail:get_plain_password")
-            return f(request, *args, **kwargs)
+            with imapconnector_scope(request):
+                return f(request, *args, **kwargs)
         return wrapped_f
     return decorator
 
@@ -0,0 +1,34 @@
+"""Management command to clean the spool of decoded message parts."""
+
+from django.core.management.base import BaseCommand
+
+from modoboa_webmail.lib import spool
+
+
+class Command(BaseCommand):
+    """Command class."""
+
+    help = "Remove least recently used parts from the webmail spool"
+
+    def add_arguments(self, parser):
+        """Add extra arguments to command line."""
+        parser.add_argument(
+            "--max-size", type=int, default=None,
+            help="Maximum size of the spool in MB (defaults to the "
+                 "value of the 'Part cache size' parameter)")
+        parser.add_argument(
+            "--max-age", type=int, default=None,
+            help="Also remove parts unused for this number of days")
+
+    def handle(self, *args, **options):
+        max_size = options["max_size"]
+        if max_size is not None:
+            max_size *= 1024 * 1024
+        max_age = options["max_age"]
+        if max_age is not None:
+            max_age *= 24 * 3600
+        removed, size = spool.cleanup(max_size, max_age)
+        if options["verbosity"] > 1:
+            self.stdout.write(
+                "{} part(s) removed, spool size: {} bytes".format(
+                    removed, size))
@@ -18,6 +18,8 @@ Webmail.prototype = {
     defaults: {
         poller_interval: 300, /* in seconds */
         poller_url: "",
+        sync_url: "",
+        events_url: "",
         move_url: "",
         submboxes_url: "",
         delattachment_url: "",
@@ -31,6 +33,8 @@ Webmail.prototype = {
         this.options = $.extend({}, this.defaults, options);
         this.rtimer = null;
         this.editorid = "id_body";
+        this.events = null;
+        this.push_active = false;
 
         this.navobject = new History({
             deflocation: "?action=listmailbox&reset_page=true",
@@ -456,6 +460,186 @@ Webmail.prototype = {
         for (var mb in data) {
             this.set_unseen_messages(mb, parseInt(data[mb]));
         }
+        this.sync_listing();
+    },
+
+    /**
+     * Resume the poller, unless changes are pushed by the server.
+     *
+     * @this Webmail
+     */
+    resume_poller: function() {
+        if (!this.push_active) {
+            this.poller.resume();
+        }
+    },
+
+    /**
+     * Listen to the changes pushed by the server for the displayed
+     * mailbox (server-sent events). The poller is paused while the
+     * stream is open.
+     *
+     * Browsers reconnect automatically when the stream is closed. If
+     * the server doesn't support push notifications, it returns an
+     * empty response and polling is used.
+     *
+     * @this Webmail
+     */
+    listen_events: function() {
+        var mbox = this.get_current_mailbox();
+        var params = {mbox: mbox};
+
+        if (!this.options.events_url || window.EventSource === undefined) {
+            return;
+        }
+        if (this.events && this.events_mbox === mbox) {
+            return;
+        }
+        this.close_events();
+        if (this.sync_state) {
+            params.since = this.sync_state.modseq;
+        }
+        this.events_mbox = mbox;
+        this.events = new EventSource(
+            this.options.events_url + "?" + $.param(params) + "&" +
+            this.get_visible_mailboxes());
+        this.events.addEventListener("open", $.proxy(function() {
+            this.push_active = true;
+            this.poller.pause();
+        }, this));
+        this.events.addEventListener("error", $.proxy(function() {
+            if (this.events.readyState === EventSource.CLOSED) {
+                this.options.events_url = "";
+                this.close_events();
+            }
+        }, this));
+        this.events.addEventListener(
+            "mailbox", $.proxy(this.mailbox_event_cb, this));
+        this.events.addEventListener(
+            "counters", $.proxy(this.counters_event_cb, this));
+    },
+
+    /**
+     * Close the server-sent events stream and go back to polling.
+     *
+     * @this Webmail
+     */
+    close_events: function() {
+        if (this.events) {
+            this.events.close();
+            this.events = null;
+        }
+        if (this.push_active) {
+            this.push_active = false;
+            this.poller.resume();
+        }
+    },
+
+    /**
+     * Server-sent event callback: a mailbox has changed.
+     *
+     * @this Webmail
+     * @param {Object} e - the event (data: see the sync view)
+     */
+    mailbox_event_cb: function(e) {
+        var data = JSON.parse(e.data);
+        var state = this.sync_state;
+
+        if (this.navobject.getparam("action") !== "listmailbox" ||
+            this.get_current_mailbox() !== data.mbox) {
+            this.set_unseen_messages(data.mbox, data.unseen);
+            return;
+        }
+        if (state && state.mbox === data.mbox && data.modseq !== undefined) {
+            this.set_unseen_messages(data.mbox, data.unseen);
+            if (data.full || data.uidnext !== state.uidnext) {
+                this.navobject.update(true);
+            } else if (data.modseq !== state.modseq) {
+                this.sync_listing();
+            }
+            return;
+        }
+        if (this.unseen_counters[data.mbox] === data.unseen) {
+            this.navobject.setparam("reset_page", "true").update(true);
+        } else {
+            this.set_unseen_messages(data.mbox, data.unseen);
+        }
+    },
+
+    /**
+     * Server-sent event callback: unseen messages counters.
+     *
+     * @this Webmail
+     * @param {Object} e - the event (data: mailbox name -> counter)
+     */
+    counters_event_cb: function(e) {
+        var data = JSON.parse(e.data);
+
+        for (var mb in data) {
+            this.set_unseen_messages(mb, parseInt(data[mb]));
+        }
+    },
+
+    /**
+     * Ask the server for the changes made to the displayed messages
+     * since the last listing (or synchronization) and apply them.
+     *
+     * Only available if the server supports CONDSTORE.
+     *
+     * @this Webmail
+     */
+    sync_listing: function() {
+        var state = this.sync_state;
+
+        if (!state || this.navobject.getparam("action") !== "listmailbox" ||
+            state.mbox !== this.get_current_mailbox()) {
+            return;
+        }
+        $.ajax({
+            url: this.options.sync_url,
+            data: {
+                mbox: state.mbox,
+                since: state.modseq,
+                uids: $("#emails").children("div.email").map(function() {
+                    return this.id;
+                }).get().join(",")
+            },
+            global: false
+        }).done($.proxy(function(data) {
+            if (!data.supported || this.sync_state !== state) {
+                return;
+            }
+            this.apply_changes(state, data);
+        }, this));
+    },
+
+    /**
+     * Apply the changes made to the displayed mailbox.
+     *
+     * @this Webmail
+     * @param {Object} state - the synchronization state of the listing
+     * @param {Object} data - changes (see the sync view)
+     */
+    apply_changes: function(state, data) {
+        if (data.full || data.uidnext !== state.uidnext) {
+            this.navobject.update(true);
+            return;
+        }
+        $.each(data.changed, function(uid, flags) {
+            var $row = $("#emails").children("div.email[id=" + uid + "]");
+
+            $row.toggleClass("unseen", flags.indexOf("\\Seen") === -1);
+            $row.find(".flag")
+                .toggleClass("fa-star", flags.indexOf("\\Flagged") !== -1)
+                .toggleClass("fa-star-o", flags.indexOf("\\Flagged") === -1);
+        });
+        $.each(data.vanished, function(idx, uid) {
+            $("#emails").children("div.email[id=" + uid + "]").remove();
+        });
+        state.modseq = data.modseq;
+        if (data.unseen !== undefined) {
+            this.set_unseen_messages(state.mbox, data.unseen);
+        }
     },
 
     /**
@@ -721,7 +905,7 @@ Webmail.prototype = {
             dataType: 'json'
         }).done($.proxy(function(data) {
             this.remove_mbox_from_tree(this.navobject.getparam("mbox"));
-            this.poller.resume();
+            this.resume_poller();
             $("body").notify("success", gettext("Folder removed"), 2000);
         }, this));
     },
@@ -1103,6 +1287,12 @@ Webmail.prototype = {
      */
     listmailbox_callback: function(resp) {
         this.store_nav_params();
+        this.sync_state = (resp.modseq === undefined) ? null : {
+            mbox: this.get_current_mailbox(),
+            modseq: resp.modseq,
+            uidnext: resp.uidnext
+        };
+        this.listen_events();
         this.page_update(resp);
         $("#emails").htmltable({
             row_selector: "div.email",
@@ -1285,7 +1475,7 @@ Webmail.prototype = {
         } else if (data.newmb) {
             this.rename_mailbox(data.oldmb, data.newmb, data.oldparent, data.newparent);
         }
-        this.poller.resume();
+        this.resume_poller();
     },
 
     /*
@@ -1294,7 +1484,7 @@ Webmail.prototype = {
      */
     mboxform_close: function() {
         if (this.poller.paused) {
-            this.poller.resume();
+            this.resume_poller();
         }
     },
 
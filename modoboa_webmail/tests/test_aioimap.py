@@ -0,0 +1,262 @@
+"""Asynchronous IMAP engine tests."""
+
+import asyncio
+import re
+
+from modoboa.lib.tests import ModoTestCase
+
+from ..exceptions import ImapError
+from ..lib import aioimap
+
+CAPABILITIES = (
+    b"IMAP4rev1 IDLE QUOTA LIST-EXTENDED LIST-STATUS CONTEXT=SORT")
+
+HEADERS = (
+    b"From: user@test.com\r\nSubject: Hello\r\n"
+    b"Content-Type: text/plain\r\n\r\n"
+)
+
+
+class FakeIMAPServer(object):
+    """A scripted IMAP server.
+
+    ``responses`` maps commands (without tag) to the untagged
+    responses sent before their completion. Commands whose name is in
+    ``hold`` are only answered once that many of them have been
+    received (if the client waited for each response, it would
+    block).
+    """
+
+    def __init__(self, responses=None, hold=None):
+        self.responses = {
+            b'LOGIN user@test.com "toto"': [],
+            b"NAMESPACE": [b'* NAMESPACE (("" "/")) NIL NIL'],
+            b"LOGOUT": [b"* BYE"],
+        }
+        self.responses.update(responses or {})
+        self.hold = hold or {}
+        self.received = []
+        self.idle_events = []
+        self.writers = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        for writer in self.writers:
+            writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.writers.append(writer)
+        writer.write(b"* OK [CAPABILITY IMAP4rev1 STARTTLS] ready\r\n")
+        held = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            tag, command = line.rstrip(b"\r\n").split(b" ", 1)
+            m = re.search(br"\{(\d+)\}$", command)
+            if m:
+                writer.write(b"+ go ahead\r\n")
+                await writer.drain()
+                literal = await reader.readexactly(int(m.group(1)) + 2)
+                command += b"\r\n" + literal[:-2]
+            self.received.append(command)
+            if command == b"IDLE":
+                writer.write(b"+ idling\r\n")
+                for event in self.idle_events:
+                    writer.write(event + b"\r\n")
+                await writer.drain()
+                await reader.readline()
+            name = command.split(b" ")[0]
+            held.append((tag, command))
+            if len(held) < self.hold.get(name, 1):
+                continue
+            for tag, command in held:
+                for response in self.responses.get(command, []):
+                    writer.write(response + b"\r\n")
+                name = command.split(b" ")[0]
+                if command not in self.responses and \
+                        name not in (b"IDLE", b"APPEND"):
+                    writer.write(tag + b" NO unknown command\r\n")
+                elif name == b"LOGIN":
+                    writer.write(
+                        tag + b" OK [CAPABILITY " + CAPABILITIES +
+                        b"] Logged in\r\n")
+                else:
+                    writer.write(tag + b" OK done\r\n")
+            held = []
+            await writer.drain()
+        writer.close()
+
+
+class AsyncIMAPconnectorTestCase(ModoTestCase):
+    """Check the asynchronous connector."""
+
+    def setUp(self):
+        super(AsyncIMAPconnectorTestCase, self).setUp()
+        self.conf = aioimap.get_parameters()
+
+    async def _connect(self, server):
+        self.conf["imap_port"] = await server.start()
+        self.conf["imap_server"] = "127.0.0.1"
+        imapc = await aioimap.AsyncIMAPconnector.connect(
+            "user@test.com", "toto", self.conf)
+        return imapc
+
+    async def test_login(self):
+        """Capabilities are read from the LOGIN response."""
+        server = FakeIMAPServer()
+        imapc = await self._connect(server)
+        self.assertIn("LIST-STATUS", imapc.capabilities)
+        self.assertNotIn("STARTTLS", imapc.capabilities)
+        self.assertEqual(imapc.hdelimiter, "/")
+        await imapc.logout()
+        self.assertEqual(server.received[-1], b"LOGOUT")
+        await server.stop()
+
+        server = FakeIMAPServer()
+        del server.responses[b'LOGIN user@test.com "toto"']
+        with self.assertRaises(ImapError):
+            await self._connect(server)
+        await server.stop()
+
+    async def test_fetchmail(self):
+        """FETCH responses are parsed as with the synchronous connector."""
+        fetch = (
+            b'* 1 FETCH (UID 12 BODYSTRUCTURE ("text" "plain" '
+            b'("charset" "utf-8") NIL NIL "7bit" 5 1 NIL NIL NIL NIL) '
+            b'BODY[HEADER.FIELDS (FROM SUBJECT)] {%d}\r\n%s)'
+            % (len(HEADERS), HEADERS))
+        server = FakeIMAPServer({
+            b'EXAMINE "INBOX"': [b"* OK [UIDVALIDITY 3] UIDs valid"],
+            (b"UID FETCH 12 (BODYSTRUCTURE "
+             b"BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)])"): [fetch],
+            b"UID FETCH 12 (BODY.PEEK[1] BODY.PEEK[2])": [
+                b"* 1 FETCH (UID 12 BODY[1] {5}\r\nHello"
+                b" BODY[2] {6}\r\nWorld!)"],
+        })
+        imapc = await self._connect(server)
+        msg = await imapc.fetchmail("INBOX", "12", what="FROM SUBJECT")
+        self.assertEqual(imapc.uidvalidity, 3)
+        self.assertEqual(
+            msg["BODY[HEADER.FIELDS (FROM SUBJECT)]"], HEADERS.decode())
+        bs = await imapc.get_bodystructure("INBOX", "12", fetch=False)
+        self.assertEqual(bs.contents["plain"][0].pnum, "1")
+        headers, parts = await imapc.fetchparts("INBOX", "12", ["1", "2"])
+        self.assertEqual(parts, {"1": b"Hello", "2": b"World!"})
+        await server.stop()
+
+    async def test_listing(self):
+        """Sort and retrieve the messages displayed in a listing."""
+        summary = b"* %d FETCH (UID %d FLAGS (%s) RFC822.SIZE 100 " \
+            b"BODY[HEADER.FIELDS (DATE FROM TO CC SUBJECT CONTENT-TYPE)] " \
+            b"{%d}\r\n%s)"
+        server = FakeIMAPServer({
+            b'SELECT "INBOX"': [b"* OK [UIDVALIDITY 3] UIDs valid"],
+            b'GETQUOTAROOT "INBOX"': [
+                b'* QUOTAROOT "INBOX" ""',
+                b'* QUOTA "" (STORAGE 10 40)'],
+            (b"UID SORT RETURN (COUNT PARTIAL 1:40) (REVERSE DATE) "
+             b"UTF-8 (NOT DELETED)"): [
+                 b"* ESEARCH (TAG \"x\") UID COUNT 2 PARTIAL (1:40 11:10)"],
+            (b"UID FETCH 10:11 (FLAGS RFC822.SIZE BODY.PEEK[HEADER.FIELDS "
+             b"(DATE FROM TO CC SUBJECT CONTENT-TYPE)])"): [
+                 summary % (2, 11, b"", len(HEADERS), HEADERS),
+                 summary % (1, 10, b"\\Seen", len(HEADERS), HEADERS)],
+        })
+        imapc = await self._connect(server)
+        count = await imapc.messages_count(folder="INBOX", start=1, stop=40)
+        self.assertEqual(count, 2)
+        self.assertEqual(imapc.quota_usage, 25)
+        messages = await imapc.fetch(1, 40, "INBOX")
+        self.assertEqual(
+            [msg["imapid"] for msg in messages], ["11", "10"])
+        self.assertEqual(messages[0]["style"], "unseen")
+        self.assertEqual(messages[1]["subject"], "Hello")
+        self.assertFalse(messages[1]["attachments"])
+        await server.stop()
+
+    async def test_sync_mailbox(self):
+        """Changes are only computed for the given messages."""
+        server = FakeIMAPServer({
+            b'SELECT "INBOX"': [
+                b"* 2 EXISTS", b"* OK [UIDVALIDITY 3] UIDs valid",
+                b"* OK [UIDNEXT 12] Predicted next UID",
+                b"* OK [HIGHESTMODSEQ 10] Highest"],
+            b"NOOP": [],
+            b"SEARCH UNSEEN": [b"* SEARCH 2"],
+        })
+        imapc = await self._connect(server)
+        imapc.capabilities.append("CONDSTORE")
+        result = await imapc.sync_mailbox("INBOX")
+        self.assertTrue(result["full"])
+        self.assertEqual(result["modseq"], 10)
+        self.assertEqual(result["uidnext"], 12)
+        self.assertEqual(result["unseen"], 1)
+
+        # Nothing changed: only NOOP is sent
+        del server.received[:]
+        result = await imapc.sync_mailbox("INBOX", 10, [10, 11])
+        self.assertEqual(server.received, [b"NOOP"])
+        self.assertFalse(result["full"])
+        self.assertNotIn("unseen", result)
+
+        server.responses.update({
+            b"NOOP": [b"* 1 EXPUNGE"],
+            b'SELECT "INBOX"': [
+                b"* 1 EXISTS", b"* OK [UIDVALIDITY 3] UIDs valid",
+                b"* OK [UIDNEXT 12] Predicted next UID",
+                b"* OK [HIGHESTMODSEQ 12] Highest"],
+            b"SEARCH UNSEEN": [b"* SEARCH"],
+            b"UID FETCH 10:11 (FLAGS) (CHANGEDSINCE 10)": [
+                b"* 1 FETCH (UID 11 FLAGS (\\Seen) MODSEQ (12))"],
+            b"UID SEARCH UID 10:11": [b"* SEARCH 11"],
+        })
+        result = await imapc.sync_mailbox("INBOX", 10, [10, 11])
+        self.assertFalse(result["full"])
+        self.assertEqual(result["modseq"], 12)
+        self.assertEqual(result["changed"], {11: ["\\Seen"]})
+        self.assertEqual(result["vanished"], [10])
+        self.assertEqual(result["unseen"], 0)
+        await server.stop()
+
+    async def test_pipelining(self):
+        """Independent commands are sent without waiting for responses."""
+        server = FakeIMAPServer(dict(
+            (b'STATUS "%s" (UNSEEN)' % name,
+             [b'* STATUS "%s" (UNSEEN %d)' % (name, count)])
+            for name, count in [(b"INBOX", 2), (b"Sent", 0), (b"Junk", 5)]
+        ), hold={b"STATUS": 3})
+        imapc = await self._connect(server)
+        counters = await asyncio.wait_for(
+            imapc.unseen_counters(["INBOX", "Sent", "Junk"]), 5)
+        self.assertEqual(counters, {"INBOX": 2, "Sent": 0, "Junk": 5})
+        server.hold = {}
+        with self.assertRaises(ImapError):
+            await imapc.unseen_messages("Unknown")
+        await server.stop()
+
+    async def test_append(self):
+        """Messages are sent as literals."""
+        server = FakeIMAPServer()
+        imapc = await self._connect(server)
+        typ, data = await imapc.push_mail("Sent", HEADERS + b"Hi!")
+        self.assertEqual(typ, "OK")
+        command = server.received[-1]
+        self.assertTrue(command.startswith(b'APPEND "Sent" (\\Seen) "'))
+        self.assertTrue(command.endswith(b"\r\n" + HEADERS + b"Hi!"))
+        await server.stop()
+
+    async def test_idle(self):
+        """Wait for changes using IDLE."""
+        server = FakeIMAPServer()
+        imapc = await self._connect(server)
+        self.assertEqual(await imapc.idle(0.05), {})
+        server.idle_events = [b"* 1 RECENT", b"* 3 EXISTS"]
+        self.assertEqual(await imapc.idle(5), {"EXISTS": [b"3"]})
+        await server.stop()
@@ -0,0 +1,244 @@
+"""Asynchronous views tests."""
+
+import base64
+import json
+import shutil
+import tempfile
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+
+from django.core.cache import cache
+from django.test import AsyncRequestFactory
+from django.urls import reverse
+
+from modoboa.admin import factories as admin_factories
+from modoboa.core import models as core_models
+from modoboa.lib import signals
+from modoboa.lib.tests import ModoTestCase
+
+from .. import async_views, views
+from ..lib import aioimap
+from .test_aioimap import FakeIMAPServer
+
+HEADERS = (
+    b"From: sender@test.com\r\nSubject: Hello\r\n"
+    b"Content-Type: text/plain\r\n\r\n"
+)
+
+BODYSTRUCTURE = (
+    b'(("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 6 1 NIL NIL '
+    b'NIL NIL)("application" "octet-stream" ("name" "file.bin") NIL NIL '
+    b'"base64" 12 NIL ("attachment" ("filename" "file.bin")) NIL NIL) '
+    b'"mixed" ("boundary" "XXX") NIL NIL NIL)'
+)
+
+
+class AsyncViewsTestCase(ModoTestCase):
+    """Check the asynchronous views."""
+
+    @classmethod
+    def setUpTestData(cls):  # noqa
+        """Create some users."""
+        super(AsyncViewsTestCase, cls).setUpTestData()
+        admin_factories.populate_database()
+        cls.user = core_models.User.objects.get(username="user@test.com")
+
+    def setUp(self):
+        super(AsyncViewsTestCase, self).setUp()
+        cache.clear()
+        self.set_global_parameter("imap_server", "127.0.0.1")
+        self.client.post(
+            reverse("core:login"),
+            {"username": self.user.username, "password": "toto"})
+        self.client.post(
+            reverse("modoboa_webmail:get_plain_password"),
+            {"password": "toto"})
+        self.factory = AsyncRequestFactory()
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        override = self.settings(WEBMAIL_SPOOL_DIR=workdir)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.addCleanup(signals.set_current_request, None)
+        # Loaded now: it can't be read from the database by coroutines
+        self.session = self.client.session
+        self.session.items()
+
+    async def _get_request(self, path, ajax=True, **params):
+        """Build a request the way middlewares would."""
+        request = self.factory.get(path, params)
+        if ajax:
+            request.META["HTTP_X_REQUESTED_WITH"] = "XMLHttpRequest"
+        request.user = self.user
+        request.localconfig = self.localconfig
+        request.session = self.session
+        await sync_to_async(signals.set_current_request)(request)
+        return request
+
+    async def _start(self, server):
+        port = await server.start()
+        await sync_to_async(self.set_global_parameter)(
+            "imap_port", port, app="modoboa_webmail")
+
+    async def test_check_unseen_messages(self):
+        """Counters are retrieved using pipelined STATUS commands."""
+        server = FakeIMAPServer({
+            b'STATUS "INBOX" (UNSEEN)': [b'* STATUS "INBOX" (UNSEEN 2)'],
+            b'STATUS "Junk" (UNSEEN)': [b'* STATUS "Junk" (UNSEEN 0)'],
+        })
+        await self._start(server)
+        request = await self._get_request(
+            "/webmail/unseenmsgs", mboxes="INBOX,Junk")
+        response = await async_views.check_unseen_messages(request)
+        self.assertEqual(
+            json.loads(response.content), {"INBOX": 2, "Junk": 0})
+
+        # The connection is reused
+        response = await async_views.check_unseen_messages(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            len([cmd for cmd in server.received
+                 if cmd.startswith(b"LOGIN")]), 1)
+        await server.stop()
+
+    async def test_need_password(self):
+        """Users are redirected when the password is unknown."""
+        request = await self._get_request(
+            "/webmail/unseenmsgs", mboxes="INBOX")
+        del request.session["password"]
+        response = await async_views.check_unseen_messages(request)
+        self.assertEqual(response.status_code, 302)
+
+    async def test_getmailcontent(self):
+        """The body is retrieved asynchronously and rendered."""
+        server = FakeIMAPServer({
+            b'SELECT "INBOX"': [b"* OK [UIDVALIDITY 3] UIDs valid"],
+            b"UID FETCH 12 (BODYSTRUCTURE)": [
+                b"* 1 FETCH (UID 12 BODYSTRUCTURE " + BODYSTRUCTURE + b")"],
+            b"UID FETCH 12 (BODY.PEEK[1])": [
+                b"* 1 FETCH (UID 12 BODY[1] {6}\r\nHello!)"],
+        })
+        await self._start(server)
+        request = await self._get_request(
+            "/webmail/getmailcontent", mbox="INBOX", mailid="12")
+        response = await async_views.getmailcontent(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Hello!", response.content.decode())
+
+        # The structure is cached: only headers are requested
+        server.responses[
+            b"UID FETCH 12 (BODY[HEADER.FIELDS (FROM TO CC DATE SUBJECT)])"
+        ] = [b"* 1 FETCH (UID 12 BODY[HEADER.FIELDS (FROM TO CC DATE "
+             b"SUBJECT)] {%d}\r\n%s)" % (len(HEADERS), HEADERS)]
+        self.session["lastaction"] = "viewmail"
+        request = await self._get_request(
+            "/webmail/", action="viewmail", mbox="INBOX", mailid="12")
+        response = await async_views.index(request)
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)
+        self.assertIn("sender@test.com", content["listing"])
+        self.assertIn("file.bin", content["listing"])
+        await server.stop()
+
+    async def test_getattachment(self):
+        """Attachments are decoded and streamed."""
+        content = base64.b64encode(b"Hi there")
+        server = FakeIMAPServer({
+            b'SELECT "INBOX"': [b"* OK [UIDVALIDITY 3] UIDs valid"],
+            b"UID FETCH 12 (BODYSTRUCTURE)": [
+                b"* 1 FETCH (UID 12 BODYSTRUCTURE " + BODYSTRUCTURE + b")"],
+            b"UID FETCH 12 (BODY.PEEK[2]<0.262144>)": [
+                b"* 1 FETCH (UID 12 BODY[2]<0> {%d}\r\n%s)" % (
+                    len(content), content)],
+        })
+        await self._start(server)
+        request = await self._get_request(
+            "/webmail/getattachment/", mbox="INBOX", mailid="12",
+            partnumber="2", fname="file.bin")
+        response = await async_views.getattachment(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        self.assertEqual(response["ETag"], '"3-12-2"')
+        chunks = [chunk async for chunk in response.streaming_content]
+        self.assertEqual(b"".join(chunks), b"Hi there")
+
+        # The connection has been given back to the pool
+        pool = aioimap.get_connections_pool()
+        self.assertEqual(len(pool._idle["user@test.com"]), 1)
+        await server.stop()
+
+    async def test_events(self):
+        """Changes are streamed as soon as they happen."""
+        server = FakeIMAPServer({
+            b'EXAMINE "INBOX"': [b"* OK [UIDVALIDITY 3] UIDs valid"],
+            b'STATUS "INBOX" (UNSEEN)': [b'* STATUS "INBOX" (UNSEEN 2)'],
+        })
+        server.idle_events = [b"* 2 EXISTS"]
+        await self._start(server)
+        await sync_to_async(self.set_global_parameter)(
+            "push_enabled", True, app="modoboa_webmail")
+        request = await self._get_request("/webmail/events", mbox="INBOX")
+        # Synchronous streams are buffered under ASGI
+        response = await sync_to_async(views.events)(request)
+        self.assertEqual(response.status_code, 204)
+
+        with mock.patch.object(async_views, "close_old_connections") as close:
+            response = await async_views.events(request)
+        # The database connection is not kept during the stream
+        close.assert_called_once_with()
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertTrue(response.is_async)
+        content = response.streaming_content
+        self.assertTrue((await content.__anext__()).startswith(b"retry: "))
+        self.assertEqual(
+            await content.__anext__(),
+            b'event: mailbox\ndata: {"full": true, "unseen": 2, '
+            b'"mbox": "INBOX"}\n\n')
+        pool = aioimap.get_connections_pool()
+        self.assertEqual(pool._sizes["user@test.com"], 1)
+
+        # The stream ends when the connection is lost, browsers
+        # reconnect
+        server.idle_events = []
+        await server.stop()
+        self.assertEqual([chunk async for chunk in content], [])
+        self.assertNotIn("user@test.com", pool._sizes)
+
+    async def test_index(self):
+        """Display the webmail and the content of a mailbox."""
+        summary = b"* %d FETCH (UID %d FLAGS (%s) RFC822.SIZE 100 " \
+            b"BODY[HEADER.FIELDS (DATE FROM TO CC SUBJECT CONTENT-TYPE)] " \
+            b"{%d}\r\n%s)"
+        server = FakeIMAPServer({
+            b'LIST "" % RETURN (CHILDREN STATUS (UNSEEN))': [
+                b'* LIST (\\HasNoChildren) "/" INBOX',
+                b'* STATUS INBOX (UNSEEN 3)'],
+            b'SELECT "INBOX"': [b"* OK [UIDVALIDITY 3] UIDs valid"],
+            b'STATUS "INBOX" (UIDNEXT UIDVALIDITY MESSAGES)': [
+                b'* STATUS "INBOX" (UIDNEXT 12 UIDVALIDITY 3 MESSAGES 1)'],
+            b'GETQUOTAROOT "INBOX"': [
+                b'* QUOTAROOT "INBOX" ""',
+                b'* QUOTA "" (STORAGE 10 40)'],
+            (b"UID SORT RETURN (COUNT PARTIAL 1:40) (REVERSE DATE) "
+             b'UTF-8 (NOT DELETED) (FROM "")'): [
+                 b"* ESEARCH (TAG \"x\") UID COUNT 1 PARTIAL (1:40 11)"],
+            (b"UID FETCH 11 (FLAGS RFC822.SIZE BODY.PEEK[HEADER.FIELDS "
+             b"(DATE FROM TO CC SUBJECT CONTENT-TYPE)])"): [
+                 summary % (1, 11, b"", len(HEADERS), HEADERS)],
+        })
+        await self._start(server)
+        request = await self._get_request("/webmail/", ajax=False)
+        response = await async_views.index(request)
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        self.assertIn("25%", content)
+        self.assertIn('data-toggle="3"', content)
+
+        request = await self._get_request("/webmail/", action="listmailbox")
+        response = await async_views.index(request)
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)
+        self.assertEqual(content["callback"], "listmailbox")
+        self.assertIn("sender@test.com", content["listing"])
+        await server.stop()
@@ -104,3 +104,58 @@ class FetchParserTestCase(unittest.TestCase):
 """)
         self._test_bodystructure_output(
             data.BODYSTRUCTURE_SAMPLE_8, "text/html\n")
+
+    def test_parse_several_sections(self):
+        """Test the parsing of a response containing several sections."""
+        response = [
+            (b'1 (UID 12 BODY[HEADER.FIELDS (FROM SUBJECT)] {42}',
+             b'From: user@test.com\r\nSubject: test\r\n\r\n'),
+            (b' BODY[1] {5}', b'Hello'),
+            (b' BODY[2] {6}', b'World!'),
+            b')'
+        ]
+        r = self.parser.parse(response)
+        self.assertEqual(
+            r[12]["BODY[HEADER.FIELDS (FROM SUBJECT)]"],
+            "From: user@test.com\r\nSubject: test\r\n\r\n")
+        self.assertEqual(r[12]["BODY[1]"], "Hello")
+        self.assertEqual(r[12]["BODY[2]"], "World!")
+
+    def test_parse_modseq(self):
+        """Test the parsing of a response containing MODSEQ."""
+        response = [
+            b'1 (UID 12 FLAGS (\\Seen $Forwarded) MODSEQ (624140003))',
+            b'2 (UID 14 MODSEQ (624140007) FLAGS ())'
+        ]
+        r = self.parser.parse(response)
+        self.assertEqual(r[12]["MODSEQ"], 624140003)
+        self.assertEqual(r[12]["FLAGS"], ["\\Seen", "$Forwarded"])
+        self.assertEqual(r[14]["MODSEQ"], 624140007)
+        self.assertEqual(r[14]["FLAGS"], [])
+
+    def test_parse_raw_literals(self):
+        """Literals can be returned without being decoded."""
+        payload = b"caf\xe9 \x00\xff"
+        response = [(b'1 (UID 12 BODY[2]<0> {8}', payload), b')']
+        r = FetchResponseParser(decode_literals=False).parse(response)
+        self.assertIs(r[12]["BODY[2]<0>"], payload)
+
+    def test_parse_empty_literal(self):
+        """Test the parsing of an empty literal."""
+        r = self.parser.parse(data.EMPTY_BODY)
+        self.assertEqual(r[33]["BODY[1]"], "")
+
+    def test_parse_keywords(self):
+        """Keywords looking like data items are accepted."""
+        r = self.parser.parse([b'1 (UID 3 FLAGS (\\Seen NONJUNK $Label1))'])
+        self.assertEqual(r[3]["FLAGS"], ["\\Seen", "NONJUNK", "$Label1"])
+
+    def test_feed(self):
+        """Messages are returned as soon as they are complete."""
+        self.assertEqual(
+            self.parser.feed((b'1 (UID 12 BODY[1] {5}', b'Hello')), [])
+        self.assertEqual(
+            self.parser.feed(b' FLAGS (\\Seen))'),
+            [(12, {"BODY[1]": "Hello", "FLAGS": ["\\Seen"]})])
+        messages = self.parser.iterparse(data.BODYSTRUCTURE_SAMPLE_9)
+        self.assertEqual(next(messages)[0], 46932)
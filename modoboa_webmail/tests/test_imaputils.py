@@ -0,0 +1,653 @@
+# coding: utf-8
+
+"""IMAP utilities tests."""
+
+from __future__ import unicode_literals
+
+import imaplib
+import pickle
+import socket
+import sys
+import threading
+import time
+import unittest
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+from modoboa.lib.exceptions import BadRequest
+from modoboa.lib.tests import ModoTestCase
+
+from ..exceptions import ImapError
+from ..lib import imaputils
+from ..lib.fetch_parser import FetchResponseParser
+from . import data
+from .test_views import IMAP4Mock
+
+# imaplib.IMAP4 is mocked by most tests
+REAL_IMAP4 = imaplib.IMAP4
+
+
+class SlowIMAP4Mock(IMAP4Mock):
+    """Fake IMAP4 client that checks which mailbox is selected."""
+
+    def __init__(self, *args, **kwargs):
+        super(SlowIMAP4Mock, self).__init__(*args, **kwargs)
+        self.selected = None
+        self.errors = []
+
+    def _simple_command(self, name, *args, **kwargs):
+        if name == "SELECT":
+            self.selected = args[0]
+            time.sleep(0.01)
+        return super(SlowIMAP4Mock, self)._simple_command(
+            name, *args, **kwargs)
+
+    def uid(self, command, *args):
+        if command == "SORT":
+            expected = threading.current_thread().name
+            if self.selected != expected.encode():
+                self.errors.append((expected, self.selected))
+        return super(SlowIMAP4Mock, self).uid(command, *args)
+
+
+class SequenceSetTestCase(unittest.TestCase):
+    """Check sequence set builder."""
+
+    def test_compaction(self):
+        """Contiguous UIDs are collapsed into ranges."""
+        self.assertEqual(
+            imaputils.build_sequence_sets("4,1,2,3,10,12:11,20"),
+            ["1:4,10:12,20"])
+        self.assertEqual(
+            imaputils.build_sequence_sets([b"5", b"6", b"7"]), ["5:7"])
+        self.assertEqual(imaputils.build_sequence_sets([]), [])
+
+    def test_batches(self):
+        """Oversized sets are split."""
+        uids = range(1, 20000, 2)
+        sets = imaputils.build_sequence_sets(uids)
+        self.assertGreater(len(sets), 1)
+        for seqset in sets:
+            self.assertLessEqual(
+                len(seqset), imaputils.MAX_SEQUENCE_SET_LENGTH)
+        self.assertEqual(
+            ",".join(sets), ",".join(str(uid) for uid in uids))
+
+    def test_invalid_set(self):
+        """Invalid sets are rejected."""
+        with self.assertRaises(BadRequest):
+            imaputils.build_sequence_sets("1,*")
+
+
+class AttachmentsGuessTestCase(unittest.TestCase):
+    """Check attachments detection without BODYSTRUCTURE."""
+
+    def _get_content_type(self, definition):
+        """Return the top-level content type of a BODYSTRUCTURE."""
+        top = definition[0]
+        if isinstance(top, dict):
+            return "{}/{}".format(*top["struct"][:2]).lower()
+        return "multipart/{}".format(top[1]).lower()
+
+    def test_samples(self):
+        """Guesses match the structure of every sample."""
+        samples = [
+            value for name, value in vars(data).items()
+            if name.startswith("BODYSTRUCTURE_") and isinstance(value, list)
+        ]
+        checked = set()
+        for sample in samples:
+            for uid, msg in FetchResponseParser().parse(sample).items():
+                if "BODYSTRUCTURE" not in msg:
+                    continue
+                ctype = self._get_content_type(msg["BODYSTRUCTURE"])
+                guess = imaputils.guess_attachments(ctype, msg.get("FLAGS"))
+                checked.add(ctype)
+                if guess is None:
+                    continue
+                self.assertEqual(
+                    guess,
+                    bool(imaputils.BodyStructure(
+                        msg["BODYSTRUCTURE"]).has_attachments()),
+                    "UID {} ({})".format(uid, ctype))
+        self.assertIn("multipart/alternative", checked)
+        self.assertIn("text/html", checked)
+
+    def test_guess(self):
+        """Only unambiguous cases are decided."""
+        self.assertIsNone(imaputils.guess_attachments("multipart/mixed"))
+        self.assertFalse(
+            imaputils.guess_attachments("multipart/alternative"))
+        self.assertTrue(imaputils.guess_attachments("application/pdf"))
+        self.assertTrue(imaputils.guess_attachments(
+            "multipart/mixed", ["\\Seen", "$HasAttachment"]))
+        self.assertFalse(imaputils.guess_attachments(
+            "application/pdf", ["$HasNoAttachment"]))
+
+
+class BodyStructureTestCase(unittest.TestCase):
+    """Check BODYSTRUCTURE loading."""
+
+    def _load(self, sample, uid):
+        msg = FetchResponseParser().parse(sample)[uid]
+        return imaputils.BodyStructure(msg["BODYSTRUCTURE"])
+
+    def test_indexes(self):
+        """Parts can be found by number or Content-ID."""
+        bs = self._load(data.BODYSTRUCTURE_SAMPLE_6, 3)
+        self.assertEqual(
+            sorted(bs.parts.keys()),
+            ["1.1.1", "1.1.2", "1.2", "1.3", "2", "3.1", "3.2"])
+        part = bs.find_part("1.2")
+        self.assertIs(bs.cids["image005.png@01CC6CAA.4FADC490"], part)
+        self.assertIs(bs.inlines["image005.png@01CC6CAA.4FADC490"], part)
+        self.assertEqual(part["Content-Type"], "image/png")
+        self.assertEqual(part.encoding, "base64")
+        self.assertIsNone(bs.find_part("4"))
+        self.assertEqual(bs.find_attachment("2")["size"], 459532)
+        self.assertIsNone(bs.find_attachment("1.2"))
+        self.assertIsNone(bs.find_attachment("4"))
+
+    def test_part_access(self):
+        """Parts behave like the dictionaries they replace."""
+        part = self._load(data.BODYSTRUCTURE_SAMPLE_6, 3).find_part("2")
+        self.assertIn("disposition", part)
+        self.assertNotIn("fname", part)
+        self.assertIsNone(part.get("fname"))
+        with self.assertRaises(KeyError):
+            part["fname"]
+        part["fname"] = "bilan.pdf"
+        self.assertEqual(part.fname, "bilan.pdf")
+        with self.assertRaises(AttributeError):
+            part["unknown"] = True
+
+    def test_pickle(self):
+        """Structures can be stored in the cache."""
+        bs = self._load(data.BODYSTRUCTURE_SAMPLE_6, 3)
+        copy = pickle.loads(pickle.dumps(bs))
+        self.assertEqual(
+            copy.find_attachment("2")["params"],
+            bs.find_attachment("2")["params"])
+        self.assertIs(copy.find_part("1.2"), copy.inlines[
+            "image005.png@01CC6CAA.4FADC490"])
+
+    def test_deep_nesting(self):
+        """Deeply nested structures don't hit the recursion limit."""
+        depth = sys.getrecursionlimit() + 100
+        leaf = b'("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 10 1)'
+        definition = (
+            b"(" * depth + leaf +
+            b' "mixed" ("boundary" "b") NIL NIL NIL)' * depth)
+        bs = self._load([b"1 (UID 1 BODYSTRUCTURE " + definition + b")"], 1)
+        pnum = ".".join(["1"] * depth)
+        self.assertIs(bs.find_part(pnum), bs.contents["plain"][0])
+
+
+class IMAPConnectionPoolTestCase(ModoTestCase):
+    """Check the connection pool."""
+
+    def setUp(self):
+        """Mock IMAP server."""
+        super(IMAPConnectionPoolTestCase, self).setUp()
+        patcher = mock.patch("imaplib.IMAP4")
+        self.mock_imap4 = patcher.start()
+        self.mock_imap4.side_effect = lambda *args: IMAP4Mock()
+        self.addCleanup(patcher.stop)
+        self.pool = imaputils.IMAPConnectionPool()
+        self.pool.checkout_timeout = 0
+
+    def test_checkout_reuse(self):
+        """A connection given back is reused."""
+        imapc = self.pool.checkout("user@test.com", "toto")
+        self.pool.checkin(imapc)
+        self.assertIs(self.pool.checkout("user@test.com", "toto"), imapc)
+        self.assertEqual(self.mock_imap4.call_count, 1)
+
+    def test_checkout_is_exclusive(self):
+        """A connection in use is never shared."""
+        imapc1 = self.pool.checkout("user@test.com", "toto")
+        imapc2 = self.pool.checkout("user@test.com", "toto")
+        self.assertIsNot(imapc1, imapc2)
+
+    def test_max_connections(self):
+        """Users can't open more connections than allowed."""
+        self.set_global_parameter("imap_max_connections", 1)
+        imapc = self.pool.checkout("user@test.com", "toto")
+        with self.assertRaises(ImapError):
+            self.pool.checkout("user@test.com", "toto")
+        # Other users are not affected
+        self.pool.checkout("admin@test.com", "toto")
+        self.pool.checkin(imapc)
+        self.assertIs(self.pool.checkout("user@test.com", "toto"), imapc)
+
+    def test_keep_free(self):
+        """Long-lived requests can leave connections to others."""
+        self.set_global_parameter("imap_max_connections", 2)
+        imapc = self.pool.checkout("user@test.com", "toto")
+        with self.assertRaises(ImapError):
+            self.pool.checkout("user@test.com", "toto", keep_free=1)
+        self.pool.checkin(imapc)
+        # An idle connection is reused
+        self.assertIs(
+            self.pool.checkout("user@test.com", "toto", keep_free=1), imapc)
+
+    def test_health_check(self):
+        """NOOP is only sent to connections unused for a while."""
+        imapc = self.pool.checkout("user@test.com", "toto")
+        self.pool.checkin(imapc)
+        with mock.patch.object(imapc.m, "_simple_command") as cmd:
+            self.pool.checkout("user@test.com", "toto")
+        cmd.assert_not_called()
+        self.pool.checkin(imapc)
+
+        imapc.last_used = time.time() - 120
+        with mock.patch.object(
+                imapc.m, "_simple_command", return_value=("OK", None)) as cmd:
+            self.pool.checkout("user@test.com", "toto")
+        cmd.assert_called_once_with("NOOP")
+
+    def test_broken_connection(self):
+        """Broken connections are replaced."""
+        imapc = self.pool.checkout("user@test.com", "toto")
+        imapc.broken = True
+        self.pool.checkin(imapc)
+        self.assertIsNot(self.pool.checkout("user@test.com", "toto"), imapc)
+
+    def test_idle_eviction(self):
+        """Connections idle for too long are closed."""
+        imapc = self.pool.checkout("user@test.com", "toto")
+        self.pool.checkin(imapc)
+        imapc.last_used = time.time() - 3600
+        self.pool.evict_idle(ttl=60)
+        self.assertIsNone(imapc.m)
+        self.assertIsNot(self.pool.checkout("user@test.com", "toto"), imapc)
+
+    def test_clear(self):
+        """Connections are closed on logout."""
+        imapc1 = self.pool.checkout("user@test.com", "toto")
+        imapc2 = self.pool.checkout("user@test.com", "toto")
+        self.pool.checkin(imapc1)
+        self.pool.clear("user@test.com")
+        self.assertIsNone(imapc1.m)
+        self.pool.checkin(imapc2)
+        self.assertIsNone(imapc2.m)
+
+
+class IMAPconnectorTestCase(ModoTestCase):
+    """Check connector."""
+
+    def setUp(self):
+        """Mock IMAP server."""
+        super(IMAPconnectorTestCase, self).setUp()
+        patcher = mock.patch("imaplib.IMAP4")
+        self.mock_imap4 = patcher.start()
+        self.mock_imap4.side_effect = lambda *args: SlowIMAP4Mock()
+        self.addCleanup(patcher.stop)
+        self.pool = imaputils.IMAPConnectionPool()
+
+    def test_concurrent_access(self):
+        """Commands sent by several threads are not interleaved."""
+        imapc = self.pool.checkout("user@test.com", "toto")
+
+        def count(folder):
+            for i in range(5):
+                imapc.messages_count(folder=folder)
+                imapc.select_mailbox(None)
+
+        threads = [
+            threading.Thread(
+                target=count, args=(folder, ), name='"{}"'.format(folder))
+            for folder in ["Folder1", "Folder2", "Folder3"]
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(imapc.m.errors, [])
+
+    def test_idle_connection_closed(self):
+        """A connection closed during IDLE is reported at once."""
+        server = socket.create_server(("127.0.0.1", 0))
+        self.addCleanup(server.close)
+
+        def serve():
+            conn, addr = server.accept()
+            conn.settimeout(5)
+            with conn, conn.makefile("rb") as rfile:
+                conn.sendall(b"* OK ready\r\n")
+                tag = rfile.readline().split(b" ")[0]
+                conn.sendall(
+                    b"* CAPABILITY IMAP4rev1 IDLE\r\n" + tag + b" OK done\r\n")
+                rfile.readline()
+                conn.sendall(b"+ idling\r\n")
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        imapc = self.pool.checkout("user@test.com", "toto")
+        with mock.patch("imaplib.IMAP4", REAL_IMAP4):
+            imapc.m = imaplib.IMAP4("127.0.0.1", server.getsockname()[1])
+            self.addCleanup(imapc.m.shutdown)
+            # Pretend to be logged in with a mailbox selected
+            imapc.m.state = "SELECTED"
+            start = time.time()
+            with self.assertRaises(ImapError):
+                imapc.idle(5)
+        thread.join()
+        self.assertLess(time.time() - start, 2)
+        self.assertTrue(imapc.broken)
+
+    def test_state_reset(self):
+        """Request related state is not kept by the pool."""
+        imapc = self.pool.checkout("user@test.com", "toto")
+        imapc.parse_search_parameters("subject", "test")
+        imapc.messages_count(folder="INBOX")
+        self.pool.checkin(imapc)
+        imapc = self.pool.checkout("user@test.com", "toto")
+        self.assertEqual(imapc.criterions, [])
+        self.assertEqual(imapc.messages, [])
+
+    def test_fetchparts(self):
+        """Several parts are retrieved using one command."""
+        imapc = self.pool.checkout("user@test.com", "toto")
+        response = [
+            (b'1 (UID 12 BODY[HEADER.FIELDS (FROM)] {21}',
+             b'From: user@test.com\r\n'),
+            (b' BODY[1] {5}', b'Hello'),
+            (b' BODY[2] {6}', b'World!'),
+            b')'
+        ]
+        with mock.patch.object(
+                imapc.m, "uid", return_value=("OK", response)) as uid:
+            headers, parts = imapc.fetchparts(
+                "INBOX", "12", ["1", "2"], headers="FROM")
+        uid.assert_called_once_with(
+            "FETCH", "12",
+            "(BODY.PEEK[HEADER.FIELDS (FROM)] BODY.PEEK[1] BODY.PEEK[2])")
+        self.assertEqual(headers, "From: user@test.com\r\n")
+        self.assertEqual(parts, {"1": b"Hello", "2": b"World!"})
+
+    def test_move(self):
+        """Check MOVE and UIDPLUS support."""
+        imapc = self.pool.checkout("user@test.com", "toto")
+        with mock.patch.object(
+                imapc.m, "uid", return_value=("OK", [None])) as uid:
+            imapc.move("1:3", "INBOX", "Trash")
+            self.assertEqual(
+                [call[0] for call in uid.call_args_list], [
+                    ("COPY", "1:3", b'"Trash"'),
+                    ("STORE", "1:3", "+FLAGS", r"(\Deleted \Seen)")
+                ])
+
+            uid.reset_mock()
+            imapc.capabilities = ["IMAP4rev1", "UIDPLUS"]
+            imapc.move("1:3", "INBOX", "Trash")
+            self.assertEqual(uid.call_args_list[-1][0], ("EXPUNGE", "1:3"))
+
+            uid.reset_mock()
+            imapc.capabilities = ["IMAP4rev1", "UIDPLUS", "MOVE"]
+            imapc.move("1:3", "INBOX", "Trash")
+            uid.assert_called_once_with("MOVE", "1:3", b'"Trash"')
+
+    def test_mailbox_state(self):
+        """Sorting results are only cached when HIGHESTMODSEQ is sent."""
+        imapc = self.pool.checkout("user@test.com", "toto")
+        imapc.select_mailbox("INBOX", False)
+        self.assertEqual(imapc.uidvalidity, 1234)
+        self.assertEqual(
+            imapc._get_mailbox_state_key(),
+            "UIDVALIDITY 1234 UIDNEXT 20 EXISTS 1 HIGHESTMODSEQ 10")
+        self.assertNotIn("EXISTS", imapc.m.untagged_responses)
+
+        imapc._set_mailbox_state({"UIDVALIDITY": [b"1234"]})
+        self.assertIsNone(imapc._get_mailbox_state_key())
+
+    def test_sync_mailbox(self):
+        """Check incremental synchronization (CONDSTORE/QRESYNC)."""
+        imapc = self.pool.checkout("user@test.com", "toto")
+        self.assertIsNone(imapc.sync_mailbox("INBOX"))
+
+        imapc.capabilities = ["IMAP4rev1", "CONDSTORE", "QRESYNC"]
+        imapc.select_mailbox("INBOX", False)
+        self.assertEqual(
+            imapc.get_sync_state(), {"modseq": 10, "uidnext": 20})
+        responses = {
+            "NOOP": {},
+            "SELECT": {
+                "EXISTS": [b"2"], "UIDVALIDITY": [b"1234"],
+                "UIDNEXT": [b"20"], "HIGHESTMODSEQ": [b"12"]},
+            "SEARCH UNSEEN": {"SEARCH": [b"7"]},
+            "UID FETCH 5:6 (FLAGS) (CHANGEDSINCE 10 VANISHED)": {
+                "FETCH": [b"1 (UID 5 FLAGS (\\Seen \\Flagged) MODSEQ (12))"],
+                "VANISHED": [b"(EARLIER) 6"]},
+        }
+        sent = []
+        pending = []
+
+        def respond(name, args):
+            line = " ".join([name] + [
+                arg.decode() if isinstance(arg, bytes) else arg
+                for arg in args])
+            sent.append(line)
+            for key, values in responses.items():
+                if line.startswith(key):
+                    imapc.m.untagged_responses.update(values)
+
+        def command(name, *args):
+            tag = "A{}".format(len(sent))
+            respond(name, args)
+            pending.append(tag)
+            imapc.m.tagged_commands[tag] = None
+            return tag
+
+        def get_response():
+            imapc.m.tagged_commands[pending.pop(0)] = ("OK", [b"Completed"])
+
+        def simple_command(name, *args):
+            respond(name, args)
+            return "OK", None
+
+        with mock.patch.object(imapc.m, "_command", side_effect=command), \
+                mock.patch.object(
+                    imapc.m, "_get_response", side_effect=get_response), \
+                mock.patch.object(
+                    imapc.m, "_simple_command", side_effect=simple_command):
+            # Nothing changed
+            result = imapc.sync_mailbox("INBOX", 10, [5, 6])
+            self.assertEqual(sent, ["NOOP"])
+            self.assertFalse(result["full"])
+            self.assertNotIn("unseen", result)
+
+            responses["NOOP"] = {"EXPUNGE": [b"2"]}
+            del sent[:]
+            result = imapc.sync_mailbox("INBOX", 10, [5, 6])
+        self.assertEqual(sent, [
+            "NOOP", 'SELECT "INBOX"', "SEARCH UNSEEN",
+            "UID FETCH 5:6 (FLAGS) (CHANGEDSINCE 10 VANISHED)"])
+        self.assertFalse(result["full"])
+        self.assertEqual(result["modseq"], 12)
+        self.assertEqual(result["changed"], {5: ["\\Seen", "\\Flagged"]})
+        self.assertEqual(result["vanished"], [6])
+        self.assertEqual(result["unseen"], 1)
+
+    def test_iterfetch(self):
+        """Messages are parsed as they are received."""
+        imapc = self.pool.checkout("user@test.com", "toto")
+        responses = [
+            [b"1 (UID 5 FLAGS (\\Seen))"],
+            [b"2 (UID 6 FLAGS ())"],
+            [b"3 (UID 7 FLAGS ())"],
+        ]
+        received = []
+
+        def command(name, *args):
+            imapc.m.tagged_commands["A1"] = None
+            received[:] = []
+            return "A1"
+
+        def get_response():
+            received.append(responses[len(received)])
+            imapc.m.untagged_responses["FETCH"] = received[-1]
+            if len(received) == len(responses):
+                imapc.m.tagged_commands["A1"] = ("OK", [b"Completed"])
+
+        with mock.patch.object(imapc.m, "_command", side_effect=command), \
+                mock.patch.object(
+                    imapc.m, "_get_response", side_effect=get_response):
+            messages = imapc.iterfetch("5:7", "(FLAGS)")
+            self.assertEqual(next(messages), (5, {"FLAGS": ["\\Seen"]}))
+            self.assertEqual(len(received), 1)
+            self.assertEqual(
+                [uid for uid, msg in messages], [6, 7])
+
+            # Stopping early must not leave responses on the wire
+            messages = imapc.iterfetch("5:7", "(FLAGS)")
+            next(messages)
+            messages.close()
+            self.assertEqual(len(received), 3)
+            self.assertNotIn("A1", imapc.m.tagged_commands)
+
+    def test_unseen_counters(self):
+        """STATUS commands are pipelined."""
+        imapc = self.pool.checkout("user@test.com", "toto")
+        calls = []
+
+        def command(name, *args):
+            calls.append(name)
+            return IMAP4Mock._command(imapc.m, name, *args)
+
+        def get_response():
+            calls.append("response")
+            return IMAP4Mock._get_response(imapc.m)
+
+        with mock.patch.object(imapc.m, "_command", side_effect=command), \
+                mock.patch.object(
+                    imapc.m, "_get_response", side_effect=get_response):
+            counters = imapc.unseen_counters(["INBOX", "Sent"])
+        self.assertEqual(calls, ["STATUS", "STATUS", "response", "response"])
+        self.assertEqual(counters, {"INBOX": 2, "Sent": 2})
+        self.assertEqual(imapc.m.tagged_commands, {})
+
+    def test_pipeline(self):
+        """Check responses dispatching and error reporting."""
+        imapc = self.pool.checkout("user@test.com", "toto")
+        imapc.capabilities = ["IMAP4rev1", "QUOTA"]
+
+        def command(name, *args):
+            if name == "GETQUOTAROOT":
+                imapc.m.untagged_responses.update({
+                    "QUOTAROOT": [b'INBOX ""'],
+                    "QUOTA": [b'"" (STORAGE 10 40)']})
+                return "OK", None
+            if args[0] == b'"Unknown"':
+                return "NO", None
+            return IMAP4Mock._simple_command(imapc.m, name, *args)
+
+        with mock.patch.object(
+                imapc.m, "_simple_command", side_effect=command):
+            with imapc.pipeline() as pipe:
+                inbox = pipe.add(
+                    "STATUS", b'"INBOX"', "(UNSEEN)", responses=("STATUS",))
+                imapc.getquota("INBOX", pipeline=pipe)
+                unknown = pipe.add(
+                    "STATUS", b'"Unknown"', "(UNSEEN)",
+                    responses=("STATUS",))
+                self.assertEqual(imapc.quota_usage, -1)
+        self.assertEqual(imapc.quota_usage, 25)
+        self.assertEqual(inbox.responses, {"STATUS": [b'"INBOX" (UNSEEN 2)']})
+        self.assertTrue(inbox.ok)
+        self.assertFalse(unknown.ok)
+        self.assertEqual(unknown.responses, {})
+        with self.assertRaises(ImapError):
+            unknown.check()
+        self.assertEqual(imapc.m.tagged_commands, {})
+
+        # Literals would block the pipeline
+        pipe = imapc.pipeline()
+        with self.assertRaises(ValueError):
+            pipe.add("STATUS", b"{5}", b"INBOX (UNSEEN)")
+        pipe.add("STATUS", b'"INBOX"', "(UNSEEN)")
+        imapc.m.literal = b"INBOX"
+        with self.assertRaises(ImapError):
+            pipe.execute()
+        self.assertIsNone(imapc.m.literal)
+
+    def test_getmboxes_list_status(self):
+        """Counters are retrieved using LIST-STATUS when possible."""
+        imapc = self.pool.checkout("user@test.com", "toto")
+        imapc.capabilities = ["IMAP4rev1", "LIST-EXTENDED", "LIST-STATUS"]
+        user = mock.Mock()
+        user.parameters.get_value.side_effect = lambda name: {
+            "drafts_folder": "Drafts", "junk_folder": "Junk",
+            "sent_folder": "Sent", "trash_folder": "Trash"}[name]
+
+        def command(name, *args):
+            self.assertEqual(
+                args, ('""', "%", "RETURN", "(CHILDREN STATUS (UNSEEN))"))
+            imapc.m.untagged_responses["LIST"] = [
+                b'(\\HasNoChildren) "." INBOX',
+                b'(\\HasNoChildren) "." "Sent"',
+                (b'(\\HasNoChildren) "." {12}', b"Caf&AOk- bar"),
+                b"",
+            ]
+            imapc.m.untagged_responses["STATUS"] = [
+                b"INBOX (UNSEEN 3)",
+                b'"Sent" (UNSEEN 0)',
+                (b"{12}", b"Caf&AOk- bar"),
+                b" (UNSEEN 1)",
+            ]
+            return "OK", None
+
+        with mock.patch.object(
+                imapc.m, "_simple_command", side_effect=command), \
+                mock.patch.object(imapc, "unseen_counters") as counters:
+            mboxes = imapc.getmboxes(user)
+        counters.assert_not_called()
+        mboxes = dict((mb["name"], mb) for mb in mboxes)
+        self.assertEqual(mboxes["INBOX"]["unseen"], 3)
+        self.assertNotIn("unseen", mboxes["Sent"])
+        self.assertEqual(mboxes["Caf\xe9 bar"]["unseen"], 1)
+
+        # Without LIST-STATUS, counters are requested separately
+        imapc.capabilities = ["IMAP4rev1", "LIST-EXTENDED"]
+
+        def command(name, *args):
+            if name == "LIST":
+                imapc.m.untagged_responses["LIST"] = [b'() "." INBOX']
+                return "OK", None
+            return IMAP4Mock._simple_command(imapc.m, name, *args)
+
+        with mock.patch.object(
+                imapc.m, "_simple_command", side_effect=command) as cmd:
+            mboxes = imapc.getmboxes(user)
+        self.assertEqual(
+            [call[0] for call in cmd.call_args_list], [
+                ("LIST", '""', "%", "RETURN", "(CHILDREN)"),
+                ("STATUS", b'"INBOX"', "(UNSEEN)")
+            ])
+        self.assertEqual(mboxes[0]["unseen"], 2)
+
+    def test_sort_partial(self):
+        """Only a window of UIDs is requested when possible."""
+        imapc = self.pool.checkout("user@test.com", "toto")
+        imapc.capabilities = ["IMAP4rev1", "ESORT", "CONTEXT=SORT"]
+
+        def sort(command, *args):
+            imapc.m.untagged_responses["ESEARCH"] = [
+                b'(TAG "A5") UID COUNT 120 PARTIAL (41:45 90,87:85,3)']
+            return "OK", [None]
+
+        with mock.patch.object(imapc.m, "uid", side_effect=sort) as uid:
+            count = imapc.messages_count(folder="INBOX", start=41, stop=45)
+        self.assertEqual(count, 120)
+        self.assertEqual(
+            uid.call_args[0][:3],
+            ("SORT", b"RETURN", bytearray(b"(COUNT PARTIAL 41:45)")))
+        self.assertEqual(imapc.messages, ["90", "87", "86", "85", "3"])
+        with mock.patch.object(
+                imapc, "iterfetch", side_effect=ImapError("")) as cmd:
+            with self.assertRaises(ImapError):
+                imapc.fetch(42, 43, "INBOX")
+        self.assertEqual(cmd.call_args[0][0], [87, 86])
@@ -0,0 +1,103 @@
+"""Part spool tests."""
+
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from django.core.management import call_command
+
+from modoboa.lib.tests import ModoTestCase
+
+from ..lib import spool
+
+
+class SpoolTestCase(ModoTestCase):
+    """Check the spool of decoded parts."""
+
+    def setUp(self):
+        """Use a temporary directory."""
+        super(SpoolTestCase, self).setUp()
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        override = self.settings(WEBMAIL_SPOOL_DIR=self.workdir)
+        override.enable()
+        self.addCleanup(override.disable)
+        spool._usage = None
+
+    def _store(self, uid, size, age=0):
+        """Store a part and make it look unused for ``age`` seconds."""
+        path = spool.store(
+            "user@test.com", "INBOX", 1234, uid, "2", [b"x" * size])
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_store_and_get(self):
+        """Parts are identified by mailbox, UIDVALIDITY and UID."""
+        self._store(1, 10)
+        self.assertEqual(
+            spool.read("user@test.com", "INBOX", 1234, 1, "2"), b"x" * 10)
+        self.assertIsNone(spool.get("user@test.com", "Sent", 1234, 1, "2"))
+        self.assertIsNone(spool.get("user@test.com", "INBOX", 1235, 1, "2"))
+        self.assertIsNone(spool.get("user@test.com", "INBOX", None, 1, "2"))
+        self.assertIsNone(spool.get("admin@test.com", "INBOX", 1234, 1, "2"))
+
+    def test_location(self):
+        """The spool is kept out of MEDIA_ROOT, names are keyed."""
+        path = spool.get_path("user@test.com", "INBOX", 1234, 1, "2")
+        self.assertEqual(os.path.dirname(path), self.workdir)
+        with self.settings(SECRET_KEY="other"):
+            self.assertNotEqual(
+                spool.get_path("user@test.com", "INBOX", 1234, 1, "2"),
+                path)
+        with self.settings(
+                WEBMAIL_SPOOL_DIR=None, MEDIA_ROOT="/srv/modoboa/media/"):
+            self.assertEqual(
+                os.path.dirname(spool.get_path(
+                    "user@test.com", "INBOX", 1234, 1, "2")),
+                "/srv/modoboa/webmail_spool")
+
+    def test_lru_eviction(self):
+        """Least recently used parts are removed first."""
+        self.set_global_parameter("spool_max_size", 1)
+        oldest = self._store(1, 400 * 1024, age=300)
+        used = self._store(2, 400 * 1024, age=200)
+        recent = self._store(3, 100 * 1024, age=100)
+        # Reading a part marks it as recently used
+        spool.get("user@test.com", "INBOX", 1234, 2, "2")
+        latest = self._store(4, 500 * 1024)
+        self.assertFalse(os.path.exists(oldest))
+        self.assertFalse(os.path.exists(recent))
+        self.assertTrue(os.path.exists(used))
+        self.assertTrue(os.path.exists(latest))
+        # Room is left for the next parts
+        self.assertLessEqual(
+            spool._usage, 1024 * 1024 * spool.LOW_WATER_MARK)
+        with mock.patch.object(spool, "cleanup") as cleanup:
+            self._store(5, 20 * 1024)
+        cleanup.assert_not_called()
+
+    def test_oversized_part(self):
+        """A part bigger than the spool is kept until it is served."""
+        self.set_global_parameter("spool_max_size", 0)
+        path = self._store(1, 10)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(spool.cleanup(), (1, 0))
+
+    def test_cleanup_command(self):
+        """Check the management command."""
+        old = self._store(1, 10, age=3 * 24 * 3600)
+        recent = self._store(2, 10)
+        leftover = os.path.join(os.path.dirname(recent), ".tmpfile")
+        with open(leftover, "wb") as fp:
+            fp.write(b"x")
+        mtime = time.time() - 2 * spool.TMPFILE_LIFETIME
+        os.utime(leftover, (mtime, mtime))
+        call_command("cleanwebmailspool", "--max-age", "2")
+        self.assertFalse(os.path.exists(old))
+        self.assertFalse(os.path.exists(leftover))
+        self.assertTrue(os.path.exists(recent))
+        call_command("cleanwebmailspool", "--max-size", "0")
+        self.assertFalse(os.path.exists(recent))
@@ -4,7 +4,10 @@
 
 from __future__ import unicode_literals
 
+import base64
 import os
+import quopri
+import re
 import shutil
 import tempfile
 
@@ -15,20 +18,23 @@ except ImportError:
 from six import BytesIO
 
 from django.core import mail
+from django.core.cache import cache
 from django.urls import reverse
 
 from modoboa.admin import factories as admin_factories
 from modoboa.core import models as core_models
 from modoboa.lib.tests import ModoTestCase
 
+from ..lib import IMAPconnector, imaputils, push, spool
+from ..lib.utils import MessagePartStream
 from . import data as tests_data
 
 
 BODYSTRUCTURE_SAMPLE_WITH_FLAGS = [
     (b'19 (UID 19 FLAGS (\\Seen) RFC822.SIZE 100000 BODYSTRUCTURE (("text" "plain" ("charset" "ISO-8859-1" "format" "flowed") NIL NIL "7bit" 2 1 NIL NIL NIL NIL)("message" "rfc822" ("name*" "ISO-8859-1\'\'%5B%49%4E%53%43%52%49%50%54%49%4F%4E%5D%20%52%E9%63%E9%70%74%69%6F%6E%20%64%65%20%76%6F%74%72%65%20%64%6F%73%73%69%65%72%20%64%27%69%6E%73%63%72%69%70%74%69%6F%6E%20%46%72%65%65%20%48%61%75%74%20%44%E9%62%69%74") NIL NIL "8bit" 3632 ("Wed, 13 Dec 2006 20:30:02 +0100" {70}',  # noqa
      b"[INSCRIPTION] R\xe9c\xe9ption de votre dossier d'inscription Free Haut D\xe9bit"),  # noqa
-    (b' (("Free Haut Debit" NIL "inscription" "freetelecom.fr")) (("Free Haut Debit" NIL "inscription" "freetelecom.fr")) ((NIL NIL "hautdebit" "freetelecom.fr")) ((NIL NIL "nguyen.antoine" "wanadoo.fr")) NIL NIL NIL "<20061213193125.9DA0919AC@dgroup2-2.proxad.net>") ("text" "plain" ("charset" "iso-8859-1") NIL NIL "8bit" 1428 38 NIL ("inline" NIL) NIL NIL) 76 NIL ("inline" ("filename*" "ISO-8859-1\'\'%5B%49%4E%53%43%52%49%50%54%49%4F%4E%5D%20%52%E9%63%E9%70%74%69%6F%6E%20%64%65%20%76%6F%74%72%65%20%64%6F%73%73%69%65%72%20%64%27%69%6E%73%63%72%69%70%74%69%6F%6E%20%46%72%65%65%20%48%61%75%74%20%44%E9%62%69%74")) NIL NIL) "mixed" ("boundary" "------------040706080908000209030901") NIL NIL NIL) BODY[HEADER.FIELDS (DATE FROM TO CC SUBJECT)] {266}',  # noqa
-     b'Date: Tue, 19 Dec 2006 19:50:13 +0100\r\nFrom: Antoine Nguyen <nguyen.antoine@wanadoo.fr>\r\nTo: Antoine Nguyen <tonio@koalabs.org>\r\nSubject: [Fwd: [INSCRIPTION] =?ISO-8859-1?Q?R=E9c=E9ption_de_votre_?=\r\n =?ISO-8859-1?Q?dossier_d=27inscription_Free_Haut_D=E9bit=5D?=\r\n\r\n'
+    (b' (("Free Haut Debit" NIL "inscription" "freetelecom.fr")) (("Free Haut Debit" NIL "inscription" "freetelecom.fr")) ((NIL NIL "hautdebit" "freetelecom.fr")) ((NIL NIL "nguyen.antoine" "wanadoo.fr")) NIL NIL NIL "<20061213193125.9DA0919AC@dgroup2-2.proxad.net>") ("text" "plain" ("charset" "iso-8859-1") NIL NIL "8bit" 1428 38 NIL ("inline" NIL) NIL NIL) 76 NIL ("inline" ("filename*" "ISO-8859-1\'\'%5B%49%4E%53%43%52%49%50%54%49%4F%4E%5D%20%52%E9%63%E9%70%74%69%6F%6E%20%64%65%20%76%6F%74%72%65%20%64%6F%73%73%69%65%72%20%64%27%69%6E%73%63%72%69%70%74%69%6F%6E%20%46%72%65%65%20%48%61%75%74%20%44%E9%62%69%74")) NIL NIL) "mixed" ("boundary" "------------040706080908000209030901") NIL NIL NIL) BODY[HEADER.FIELDS (DATE FROM TO CC SUBJECT CONTENT-TYPE)] {348}',  # noqa
+     b'Date: Tue, 19 Dec 2006 19:50:13 +0100\r\nFrom: Antoine Nguyen <nguyen.antoine@wanadoo.fr>\r\nTo: Antoine Nguyen <tonio@koalabs.org>\r\nSubject: [Fwd: [INSCRIPTION] =?ISO-8859-1?Q?R=E9c=E9ption_de_votre_?=\r\n =?ISO-8859-1?Q?dossier_d=27inscription_Free_Haut_D=E9bit=5D?=\r\nContent-Type: multipart/mixed;\r\n boundary="------------040706080908000209030901"\r\n\r\n'  # noqa
     ),
     b')'
 ]
@@ -48,10 +54,34 @@ class IMAP4Mock(object):
 
     def __init__(self, *args, **kwargs):
         self.untagged_responses = {}
+        self.tagged_commands = {}
+        self.literal = None
+        self.pending = []
+        self.counter = 0
 
     def _quote(self, data):
         return data
 
+    def send(self, data):
+        pass
+
+    def _command(self, name, *args):
+        """Send a command, its response is read by _get_response."""
+        tag = "A{}".format(self.counter)
+        self.counter += 1
+        self.tagged_commands[tag] = None
+        self.pending.append((tag, name, args))
+        return tag
+
+    def _get_response(self):
+        tag, name, args = self.pending.pop(0)
+        if name == "UID":
+            typ, data = self.uid(*args)
+            self.untagged_responses["FETCH"] = data
+        else:
+            typ, data = self._simple_command(name, *args)
+        self.tagged_commands[tag] = (typ, [b"Completed"])
+
     def _simple_command(self, name, *args, **kwargs):
         if name == "CAPABILITY":
             self.untagged_responses["CAPABILITY"] = [b""]
@@ -59,6 +89,20 @@ class IMAP4Mock(object):
             self.untagged_responses["LIST"] = [b"() \".\" \"INBOX\""]
         elif name == "NAMESPACE":
             self.untagged_responses["NAMESPACE"] = [b'(("" "/")) NIL NIL']
+        elif name in ("SELECT", "EXAMINE"):
+            self.untagged_responses.update({
+                "EXISTS": [b"1"], "UIDVALIDITY": [b"1234"],
+                "UIDNEXT": [b"20"], "HIGHESTMODSEQ": [b"10"]})
+        elif name == "STATUS":
+            name = args[0]
+            if not isinstance(name, bytes):
+                name = name.encode()
+            if args[1] == "(UNSEEN)":
+                response = name + b" (UNSEEN 2)"
+            else:
+                response = name + b" (UIDNEXT 20 UIDVALIDITY 1234 MESSAGES 1)"
+            self.untagged_responses.setdefault("STATUS", []).append(
+                response)
         return "OK", None
 
     def append(self, *args, **kwargs):
@@ -104,7 +148,7 @@ class IMAP4Mock(object):
             elif uid == 133872:
                 data = tests_data.COMPLETE_MAIL
             return "OK", data
-        elif command == "STORE":
+        elif command in ("COPY", "STORE"):
             return "OK", []
 
 
@@ -124,9 +168,15 @@ class WebmailTestCase(ModoTestCase):
         self.mock_imap4 = patcher.start()
         self.mock_imap4.return_value = IMAP4Mock()
         self.addCleanup(patcher.stop)
+        self.addCleanup(imaputils.connections_pool.clear)
+        cache.clear()
         self.set_global_parameter("imap_port", 1435)
         self.workdir = tempfile.mkdtemp()
         os.mkdir("{}/webmail".format(self.workdir))
+        override = self.settings(
+            WEBMAIL_SPOOL_DIR=os.path.join(self.workdir, "spool"))
+        override.enable()
+        self.addCleanup(override.disable)
         self.set_global_parameter("update_scheme", False, app="core")
         url = reverse("core:login")
         data = {
@@ -164,6 +214,71 @@ class WebmailTestCase(ModoTestCase):
         self.assertIn(
             "nguyen.antoine@wanadoo.fr", response.json()["listing"])
 
+    def test_check_unseen_messages(self):
+        """Check unseen messages counters."""
+        url = reverse("modoboa_webmail:unseen_messages_check")
+        response = self.client.get("{}?mboxes=INBOX,Sent".format(url))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"INBOX": 2, "Sent": 2})
+
+    def test_sync(self):
+        """Check the synchronization of displayed messages."""
+        url = reverse("modoboa_webmail:mailbox_sync")
+        self.ajax_get(
+            "{}?mbox=INBOX&since=10&uids=19,x".format(url), status=400)
+        # CONDSTORE is not supported by the fake server
+        response = self.ajax_get(
+            "{}?mbox=INBOX&since=10&uids=19,20".format(url))
+        self.assertEqual(response, {"supported": False})
+
+        with mock.patch.object(
+                IMAPconnector, "sync_mailbox",
+                return_value={"modseq": 10}) as sync_mailbox:
+            self.client.get("{}?mbox=INBOX&since=10&uids=19,20".format(url))
+        sync_mailbox.assert_called_once_with("INBOX", 10, [19, 20])
+
+    def test_events(self):
+        """Check the server-sent events stream."""
+        url = "{}?mbox=INBOX".format(reverse("modoboa_webmail:events"))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 204)
+
+        self.set_global_parameter("push_enabled", True)
+        # IDLE is not supported by the fake server
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 204)
+
+        with mock.patch.object(push, "is_supported", return_value=True), \
+                mock.patch.object(
+                    IMAPconnector, "idle",
+                    side_effect=[{"EXISTS": [b"2"]}, {}]), \
+                mock.patch.object(
+                    imaputils.connections_pool, "checkin",
+                    wraps=imaputils.connections_pool.checkin) as checkin, \
+                mock.patch(
+                    "modoboa_webmail.views.close_old_connections") as close:
+            response = self.client.get(url + "&mboxes=INBOX,Sent")
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            # The database connection is not kept during the stream
+            close.assert_called_once_with()
+            checkin.reset_mock()
+            content = iter(response.streaming_content)
+            self.assertTrue(next(content).startswith(b"retry: "))
+            self.assertEqual(
+                next(content),
+                b'event: mailbox\ndata: {"full": true, "unseen": 2, '
+                b'"mbox": "INBOX"}\n\n')
+            self.assertEqual(next(content), b": keepalive\n\n")
+            checkin.assert_not_called()
+            response.close()
+            # The connection is given back to the pool
+            self.assertEqual(checkin.call_count, 1)
+
+            # The stream can't use the last free connection
+            self.set_global_parameter("imap_max_connections", 1)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 204)
+
     def test_attachments(self):
         """Check attachments."""
         url = reverse("modoboa_webmail:index")
@@ -372,3 +487,345 @@ class WebmailTestCase(ModoTestCase):
             reverse("modoboa_webmail:mailsource_get"))
         response = self.client.get(url)
         self.assertContains(response, "Message-ID")
+
+    def test_bodystructure_cache(self):
+        """Check that BODYSTRUCTURE is only fetched once per message."""
+        session = self.client.session
+        session["lastaction"] = "viewmail"
+        session.save()
+        with mock.patch.object(
+                IMAP4Mock, "uid", autospec=True,
+                side_effect=IMAP4Mock.uid) as uid_mock:
+            url = "{}?action=viewmail&mbox=INBOX&mailid=46932".format(
+                reverse("modoboa_webmail:index"))
+            response = self.ajax_get(url)
+            self.assertIn("Notre contact", response["listing"])
+            url = "{}?mbox=INBOX&mailid=46932".format(
+                reverse("modoboa_webmail:mailcontent_get"))
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            url = "{}?mbox=INBOX&mailid=46932&partnumber=2&fname=test".format(
+                reverse("modoboa_webmail:attachment_get"))
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+        fetches = [
+            call for call in uid_mock.call_args_list
+            if call[0][1] == "FETCH" and "BODYSTRUCTURE" in call[0][3]
+        ]
+        self.assertEqual(len(fetches), 1)
+
+    def _partial_fetch_mock(self, payload):
+        """Return a fake uid() method serving part 2 by chunks."""
+        uid = IMAP4Mock.uid
+
+        def fetch(imap, command, *args):
+            m = re.match(r"\(BODY\.PEEK\[2\]<(\d+)\.(\d+)>\)", args[1])
+            if command != "FETCH" or m is None:
+                return uid(imap, command, *args)
+            offset, length = int(m.group(1)), int(m.group(2))
+            chunk = payload[offset:offset + length]
+            header = "1 (UID 46932 BODY[2]<{}>".format(offset).encode()
+            if not chunk:
+                return "OK", [header + b' "")']
+            return "OK", [
+                (header + " {{{}}}".format(len(chunk)).encode(), chunk),
+                b")"
+            ]
+
+        return fetch
+
+    def test_getattachment_stream(self):
+        """Check that attachments are retrieved by chunks."""
+        content = os.urandom(1000)
+        fetch = self._partial_fetch_mock(base64.encodebytes(content))
+        url = "{}?mbox=INBOX&mailid=46932&partnumber=2&fname=test".format(
+            reverse("modoboa_webmail:attachment_get"))
+        with mock.patch.object(
+                IMAP4Mock, "uid", autospec=True,
+                side_effect=fetch) as uid_mock, \
+                mock.patch.object(MessagePartStream, "chunk_size", 300):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b"".join(response.streaming_content), content)
+            response.close()
+        fetches = [
+            call for call in uid_mock.call_args_list
+            if call[0][1] == "FETCH" and "BODY.PEEK[2]<" in call[0][3]
+        ]
+        # The size announced by BODYSTRUCTURE is bigger than the
+        # payload so an empty response marks the end of the part
+        self.assertEqual(len(fetches), 6)
+        # The connection is given back to the pool
+        self.assertEqual(
+            len(imaputils.connections_pool._idle["user@test.com"]), 1)
+
+    def test_getattachment_conditional_and_range(self):
+        """Check ETag and Range support."""
+        content = os.urandom(1000)
+        fetch = self._partial_fetch_mock(base64.encodebytes(content))
+        url = "{}?mbox=INBOX&mailid=46932&partnumber=2&fname=test".format(
+            reverse("modoboa_webmail:attachment_get"))
+        with mock.patch.object(
+                IMAP4Mock, "uid", autospec=True,
+                side_effect=fetch) as uid_mock, \
+                self.settings(MEDIA_ROOT=self.workdir):
+            response = self.client.get(url)
+            self.assertEqual(response["Accept-Ranges"], "bytes")
+            etag = response["ETag"]
+            self.assertEqual(etag, '"1234-46932-2"')
+            response.close()
+
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+
+            uid_mock.reset_mock()
+            response = self.client.get(url, HTTP_RANGE="bytes=10-19")
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response["Content-Range"], "bytes 10-19/1000")
+            self.assertEqual(
+                b"".join(response.streaming_content), content[10:20])
+            response.close()
+            self.assertTrue(uid_mock.called)
+
+            # Decoded part is now spooled
+            uid_mock.reset_mock()
+            response = self.client.get(
+                url, HTTP_RANGE="bytes=-5", HTTP_IF_RANGE=etag)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(
+                b"".join(response.streaming_content), content[-5:])
+            self.assertFalse(uid_mock.called)
+
+            response = self.client.get(url, HTTP_RANGE="bytes=2000-")
+            self.assertEqual(response.status_code, 416)
+            self.assertEqual(response["Content-Range"], "bytes */1000")
+
+            # Range is ignored if the validator doesn't match
+            response = self.client.get(
+                url, HTTP_RANGE="bytes=10-19", HTTP_IF_RANGE='"other"')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b"".join(response.streaming_content), content)
+
+    def test_compression_policy(self):
+        """Check which responses are compressed."""
+        url = "{}?action=viewmail&mbox=INBOX&mailid=46932".format(
+            reverse("modoboa_webmail:index"))
+        session = self.client.session
+        session["lastaction"] = "viewmail"
+        session.save()
+        response = self.client.get(
+            url, HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+            HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+
+        self.set_global_parameter("compression_min_size", 1024 * 1024)
+        response = self.client.get(
+            url, HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+            HTTP_ACCEPT_ENCODING="gzip")
+        self.assertFalse(response.has_header("Content-Encoding"))
+
+        # Already compressed content types are sent as is
+        fetch = self._partial_fetch_mock(base64.encodebytes(b"\0" * 1000))
+        url = "{}?mbox=INBOX&mailid=46932&partnumber=2&fname=test".format(
+            reverse("modoboa_webmail:attachment_get"))
+        self.set_global_parameter("compression_min_size", 0)
+        with mock.patch.object(
+                IMAP4Mock, "uid", autospec=True, side_effect=fetch):
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+            self.assertFalse(response.has_header("Content-Encoding"))
+            response.close()
+            self.set_global_parameter(
+                "compression_types", "application/octet-stream")
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+            self.assertEqual(response["Content-Encoding"], "gzip")
+            self.assertFalse(response.has_header("Accept-Ranges"))
+            response.close()
+
+    def test_header_cache(self):
+        """Check that only flags are fetched for known messages."""
+        cache.clear()
+        session = self.client.session
+        session["lastaction"] = "listmailbox"
+        session.save()
+        url = "{}?action=listmailbox&mbox=INBOX".format(
+            reverse("modoboa_webmail:index"))
+        with mock.patch.object(
+                IMAP4Mock, "uid", autospec=True,
+                side_effect=IMAP4Mock.uid) as uid_mock:
+            response = self.ajax_get(url)
+            self.assertIn("Antoine Nguyen", response["listing"])
+            response = self.ajax_get(url)
+            self.assertIn("Antoine Nguyen", response["listing"])
+            fetches = [
+                call[0][3] for call in uid_mock.call_args_list
+                if call[0][1] == "FETCH"
+            ]
+        self.assertIn("HEADER.FIELDS", fetches[0])
+        self.assertNotIn("BODYSTRUCTURE", fetches[0])
+        # multipart/mixed: the structure is needed
+        self.assertEqual(fetches[1:], ["(BODYSTRUCTURE)", "(FLAGS)"])
+        self.assertIn("fa-paperclip", response["listing"])
+
+    def test_sort_cache(self):
+        """Check that sorted UIDs are cached until the mailbox changes."""
+        session = self.client.session
+        session["lastaction"] = "listmailbox"
+        session.save()
+        url = "{}?action=listmailbox&mbox=INBOX".format(
+            reverse("modoboa_webmail:index"))
+        with mock.patch.object(
+                IMAP4Mock, "uid", autospec=True,
+                side_effect=IMAP4Mock.uid) as uid_mock:
+            self.ajax_get(url)
+            self.ajax_get(url)
+            sorts = [
+                call for call in uid_mock.call_args_list
+                if call[0][1] == "SORT"
+            ]
+            self.assertEqual(len(sorts), 1)
+
+            url2 = "{}?mbox=INBOX&selection[]=19".format(
+                reverse("modoboa_webmail:mail_delete"))
+            self.ajax_get(url2)
+            self.ajax_get(url)
+            sorts = [
+                call for call in uid_mock.call_args_list
+                if call[0][1] == "SORT"
+            ]
+            self.assertEqual(len(sorts), 2)
+
+    def test_sort_cache_state(self):
+        """Check that changes reported by the server invalidate sorted
+        UIDs."""
+        session = self.client.session
+        session["lastaction"] = "listmailbox"
+        session.save()
+        url = "{}?action=listmailbox&mbox=INBOX".format(
+            reverse("modoboa_webmail:index"))
+        simple_command = IMAP4Mock._simple_command
+
+        def new_message(imap, name, *args, **kwargs):
+            result = simple_command(imap, name, *args, **kwargs)
+            if name in ("NOOP", "SELECT"):
+                imap.untagged_responses["EXISTS"] = [b"2"]
+            return result
+
+        with mock.patch.object(
+                IMAP4Mock, "uid", autospec=True,
+                side_effect=IMAP4Mock.uid) as uid_mock:
+            self.ajax_get(url)
+            with mock.patch.object(
+                    IMAP4Mock, "_simple_command", autospec=True,
+                    side_effect=new_message) as command_mock:
+                self.ajax_get(url)
+            commands = [call[0][1] for call in command_mock.call_args_list]
+            self.assertIn("NOOP", commands)
+            self.assertIn("SELECT", commands)
+            self.assertNotIn("STATUS", commands)
+            sorts = [
+                call for call in uid_mock.call_args_list
+                if call[0][1] == "SORT"
+            ]
+            self.assertEqual(len(sorts), 2)
+
+    def _inline_fetch_mock(self):
+        """Return a fake uid() method serving message 3 (related parts)."""
+        uid = IMAP4Mock.uid
+        payloads = {
+            "1.1.2": quopri.encodestring(
+                b'<p><img src="cid:image005.png@01CC6CAA.4FADC490">'
+                b'<img src="cid:image006.jpg@01CC6CAA.4FADC490"></p>'),
+            "1.2": base64.encodebytes(b"png data"),
+            "1.3": base64.encodebytes(b"jpeg data"),
+        }
+
+        def fetch(imap, command, *args):
+            if command != "FETCH" or args[0] != "3":
+                return uid(imap, command, *args)
+            if args[1] == "(BODYSTRUCTURE)":
+                return "OK", tests_data.BODYSTRUCTURE_SAMPLE_6
+            response = []
+            header = b"1 (UID 3"
+            for pnum in re.findall(r"BODY\.PEEK\[([\d\.]+)\]", args[1]):
+                payload = payloads.get(pnum, b"")
+                response.append((
+                    header + " BODY[{}] {{{}}}".format(
+                        pnum, len(payload)).encode(),
+                    payload))
+                header = b""
+            return "OK", response + [b")"]
+
+        return fetch
+
+    def test_inline_images(self):
+        """Check that inline images are stored or served on demand."""
+        self.user.parameters.set_value("displaymode", "html")
+        self.user.save()
+        self.set_global_parameter("inline_images_max", 1)
+        url = "{}?mbox=INBOX&mailid=3&links=1".format(
+            reverse("modoboa_webmail:mailcontent_get"))
+        with mock.patch.object(
+                IMAP4Mock, "uid", autospec=True,
+                side_effect=self._inline_fetch_mock()) as uid_mock, \
+                self.settings(MEDIA_ROOT=self.workdir):
+            with mock.patch.object(
+                    spool, "store", wraps=spool.store) as store_mock:
+                response = self.client.get(url)
+            # Images are stored by worker threads that don't query the
+            # database
+            self.assertEqual(
+                store_mock.call_args[1]["max_size"], 1024 * 1024 * 1024)
+            fetches = [
+                call[0][3] for call in uid_mock.call_args_list
+                if call[0][1] == "FETCH"
+            ]
+            # Body and stored images are retrieved at once
+            self.assertEqual(
+                fetches[-1],
+                "(BODY.PEEK[1.1.2] BODY.PEEK[3.2] BODY.PEEK[1.2])")
+            stored_url = "{}?mbox=INBOX&mailid=3&partnumber=1.2".format(
+                reverse("modoboa_webmail:inline_get"))
+            inline_url = "{}?mbox=INBOX&mailid=3&partnumber=1.3".format(
+                reverse("modoboa_webmail:inline_get"))
+            self.assertContains(response, stored_url.replace("&", "&amp;"))
+            self.assertContains(response, inline_url.replace("&", "&amp;"))
+
+            uid_mock.reset_mock()
+            response = self.client.get(stored_url)
+            self.assertEqual(
+                b"".join(response.streaming_content), b"png data")
+            self.assertEqual(response["Content-Type"], "image/png")
+            self.assertFalse(uid_mock.called)
+            # Spooled images are not retrieved again
+            response = self.client.get(url)
+            self.assertEqual(
+                uid_mock.call_args[0][3],
+                "(BODY.PEEK[1.1.2] BODY.PEEK[3.2])")
+
+            response = self.client.get(inline_url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, b"jpeg data")
+            self.assertEqual(response["Content-Type"], "image/jpeg")
+            response = self.client.get(
+                inline_url, HTTP_IF_NONE_MATCH=response["ETag"])
+            self.assertEqual(response.status_code, 304)
+            # Decoded image is now spooled
+            uid_mock.reset_mock()
+            response = self.client.get(inline_url)
+            self.assertEqual(
+                b"".join(response.streaming_content), b"jpeg data")
+            self.assertFalse(uid_mock.called)
+
+            # Attachments and unknown parts are not served
+            response = self.client.get(
+                "{}?mbox=INBOX&mailid=3&partnumber=2".format(
+                    reverse("modoboa_webmail:inline_get")))
+            self.assertContains(response, "Image not found")
+
+            self.set_global_parameter("inline_images_lazy", True)
+            uid_mock.reset_mock()
+            response = self.client.get(url)
+            self.assertContains(response, "partnumber=1.2")
+            self.assertEqual(
+                uid_mock.call_args[0][3],
+                "(BODY.PEEK[1.1.2] BODY.PEEK[3.2])")
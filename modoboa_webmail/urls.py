@@ -1,17 +1,26 @@
 # coding: utf-8
+from django.conf import settings
 from django.urls import path
 
 from . import views
 
+if getattr(settings, "WEBMAIL_ASYNC_VIEWS", False):
+    # Requires an ASGI server (see async_views)
+    from . import async_views as hot_views
+else:
+    hot_views = views
+
 app_name = 'modoboa_webmail'
 
 urlpatterns = [
-    path('', views.index, name="index"),
+    path('', hot_views.index, name="index"),
     path('submailboxes', views.submailboxes, name="submailboxes_get"),
-    path('getmailcontent', views.getmailcontent, name="mailcontent_get"),
+    path('getmailcontent', hot_views.getmailcontent, name="mailcontent_get"),
     path('getmailsource', views.getmailsource, name="mailsource_get"),
-    path('unseenmsgs', views.check_unseen_messages,
+    path('unseenmsgs', hot_views.check_unseen_messages,
          name="unseen_messages_check"),
+    path('sync', views.sync, name="mailbox_sync"),
+    path('events', hot_views.events, name="events"),
 
     path('delete/', views.delete, name="mail_delete"),
     path('move/', views.move, name="mail_move"),
@@ -28,6 +37,8 @@ urlpatterns = [
 
     path('attachments/', views.attachments, name="attachment_list"),
     path('delattachment/', views.delattachment, name="attachment_delete"),
-    path('getattachment/', views.getattachment, name="attachment_get"),
+    path('getattachment/', hot_views.getattachment,
+         name="attachment_get"),
+    path('getinline/', views.getinline, name="inline_get"),
     path('password/', views.get_plain_password, name="get_plain_password")
 ]
@@ -6,14 +6,17 @@ import base64
 import os
 
 from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
 from django.urls import reverse
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.utils.encoding import force_str
+from django.utils.http import quote_etag
 from django.utils.translation import gettext as _, ngettext
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.gzip import gzip_page
 from django.shortcuts import redirect
 
 from django.contrib.auth.decorators import login_required
@@ -22,26 +25,30 @@ from modoboa.admin.lib import needs_mailbox
 from modoboa.core.extensions import exts_pool
 from django.contrib.auth.hashers import check_password
 from modoboa.lib.cryptutils import encrypt, get_password
-from modoboa.lib.exceptions import ModoboaException, BadRequest
+from modoboa.lib.exceptions import ModoboaException, BadRequest, NotFound
 from modoboa.lib.paginator import Paginator
 from modoboa.lib.web_utils import (
     ajax_response, render_to_json_response
 )
 from modoboa.parameters import tools as param_tools
 
-from .exceptions import UnknownAction
+from .exceptions import ImapError, UnknownAction
 from .forms import (
     FolderForm, AttachmentForm, ComposeMailForm, ForwardMailForm,
     AskPassword
 )
 from .lib import (
-    decode_payload, AttachmentUploadHandler,
-    save_attachment, EmailSignature,
+    AttachmentUploadHandler, push, spool,
+    save_attachment, EmailSignature, decode_payload,
     clean_attachments, set_compose_session, send_mail,
     ImapEmail, WebmailNavigationParameters, ReplyModifier, ForwardModifier,
-    get_imapconnector, IMAPconnector, separate_mailbox, rfc6266
+    get_imapconnector, separate_mailbox, rfc6266
+)
+from .lib.compression import compress_page
+from .lib.imaputils import connections_pool, detach_imapconnector
+from .lib.utils import (
+    MessagePartStream, need_password, parse_range_header
 )
-from .lib.utils import need_password
 from .templatetags import webmail_tags
 
 
@@ -51,13 +58,19 @@ def is_ajax(request):
 
 @login_required
 @needs_mailbox()
-@gzip_page
+@compress_page
 @need_password()
 def getattachment(request):
     """Fetch a message attachment
 
-    FIXME: par manque de caching, le bodystructure du message est
-    redemandé pour accéder aux headers de cette pièce jointe.
+    The attachment is streamed: it is retrieved from the server and
+    decoded by chunks.
+
+    Since the content of a message never changes, a strong ETag is
+    built using UIDVALIDITY, UID and part number. Conditional and
+    Range requests are supported: ranges are mapped onto partial
+    FETCH commands when the part is not encoded, otherwise the decoded
+    part is spooled locally first.
 
     :param request: a ``Request`` object
     """
@@ -69,18 +82,127 @@ def getattachment(request):
         raise BadRequest(_("Invalid request"))
 
     imapc = get_imapconnector(request)
-    partdef, payload = imapc.fetchpart(mailid, mbox, pnum)
-    resp = HttpResponse(decode_payload(partdef["encoding"], payload))
+    partdef = imapc.get_bodystructure(mbox, mailid).find_attachment(pnum)
+    if partdef is None:
+        raise NotFound(_("Attachment not found"))
+    etag = None
+    if imapc.uidvalidity is not None:
+        etag = quote_etag(
+            "{}-{}-{}".format(imapc.uidvalidity, mailid, pnum))
+        resp = get_conditional_response(request, etag=etag)
+        if resp is not None:
+            return resp
+    spool_key = (imapc.user, mbox, imapc.uidvalidity, mailid, pnum)
+    path = spool.get(*spool_key)
+    encoded = partdef["encoding"].lower() not in ["7bit", "8bit", "binary"]
+    if path is not None:
+        size = os.path.getsize(path)
+    elif not encoded:
+        size = int(partdef["size"])
+    else:
+        size = None
+
+    prange = None
+    range_header = request.META.get("HTTP_RANGE")
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if etag and range_header and (not if_range or if_range == etag):
+        if size is None:
+            path = spool.store(*spool_key, chunks=MessagePartStream(
+                detach_imapconnector(request), mbox, mailid, partdef))
+            size = os.path.getsize(path)
+        try:
+            prange = parse_range_header(range_header, size)
+        except ValueError:
+            resp = HttpResponse(status=416)
+            resp["Content-Range"] = "bytes */{}".format(size)
+            return resp
+
+    if prange is not None:
+        offset, length = prange[0], prange[1] - prange[0] + 1
+    else:
+        offset, length = 0, size
+    if path is not None:
+        content = spool.iter_file(path, offset, length)
+    elif prange is not None:
+        content = MessagePartStream(
+            detach_imapconnector(request), mbox, mailid, partdef,
+            offset, length)
+    else:
+        content = MessagePartStream(
+            detach_imapconnector(request), mbox, mailid, partdef)
+    resp = StreamingHttpResponse(content)
+    if prange is not None:
+        resp.status_code = 206
+        resp["Content-Range"] = "bytes {}-{}/{}".format(
+            prange[0], prange[1], size)
+    if length is not None:
+        resp["Content-Length"] = length
+    if etag:
+        resp["ETag"] = etag
+        resp["Accept-Ranges"] = "bytes"
+    patch_cache_control(resp, private=True)
     resp["Content-Type"] = partdef["Content-Type"]
     resp["Content-Transfer-Encoding"] = partdef["encoding"]
     resp["Content-Disposition"] = rfc6266.build_header(fname)
-    if int(partdef["size"]) < 200:
-        resp["Content-Length"] = partdef["size"]
     return resp
 
 
 @login_required
 @needs_mailbox()
+@compress_page
+@need_password()
+def getinline(request):
+    """Fetch an inline image
+
+    Images are served from the spool. Those that are not retrieved
+    along with the body of their message (see the
+    ``inline_images_lazy`` and ``inline_images_max`` parameters) are
+    retrieved from the server and spooled on first request.
+
+    :param request: a ``Request`` object
+    """
+    mbox = request.GET.get("mbox", None)
+    mailid = request.GET.get("mailid", None)
+    pnum = request.GET.get("partnumber", None)
+    if not mbox or not mailid or not pnum:
+        raise BadRequest(_("Invalid request"))
+
+    imapc = get_imapconnector(request)
+    bs = imapc.get_bodystructure(mbox, mailid)
+    partdef = bs.find_part(pnum)
+    if partdef is None or \
+            bs.inlines.get(partdef["cid"].strip("<>")) is not partdef:
+        raise NotFound(_("Image not found"))
+    etag = None
+    if imapc.uidvalidity is not None:
+        etag = quote_etag(
+            "{}-{}-{}".format(imapc.uidvalidity, mailid, pnum))
+        resp = get_conditional_response(request, etag=etag)
+        if resp is not None:
+            return resp
+    spool_key = (imapc.user, mbox, imapc.uidvalidity, mailid, pnum)
+    path = spool.get(*spool_key)
+    if path is None:
+        headers, parts = imapc.fetchparts(mbox, mailid, [pnum])
+        if pnum not in parts:
+            raise NotFound(_("Image not found"))
+        content = decode_payload(partdef["encoding"], parts[pnum])
+        if etag:
+            spool.store(*spool_key, chunks=[content])
+        resp = HttpResponse(content)
+    else:
+        resp = StreamingHttpResponse(spool.iter_file(path))
+        resp["Content-Length"] = os.path.getsize(path)
+    if etag:
+        resp["ETag"] = etag
+    patch_cache_control(resp, private=True)
+    resp["Content-Type"] = partdef["Content-Type"]
+    return resp
+
+
+@login_required
+@needs_mailbox()
+@compress_page
 @need_password()
 def move(request):
     for arg in ["msgset", "to"]:
@@ -95,6 +217,7 @@ def move(request):
 
 @login_required
 @needs_mailbox()
+@compress_page
 @need_password()
 def delete(request):
     mbox = request.GET.get("mbox", None)
@@ -103,7 +226,7 @@ def delete(request):
         raise BadRequest(_("Invalid request"))
     selection = [item for item in selection if item.isdigit()]
     mbc = get_imapconnector(request)
-    mbc.move(",".join(selection), mbox,
+    mbc.move(selection, mbox,
              request.user.parameters.get_value("trash_folder"))
     count = len(selection)
     message = ngettext("%(count)d message deleted",
@@ -140,7 +263,7 @@ def _move_selection_to_folder(request, folder):
         raise BadRequest(_("Invalid request"))
     selection = [item for item in selection if item.isdigit()]
     mbc = get_imapconnector(request)
-    mbc.move(",".join(selection), mbox, folder)
+    mbc.move(selection, mbox, folder)
     return len(selection)
 
 
@@ -201,8 +324,7 @@ def folder_compress(request):
 @needs_mailbox()
 @need_password()
 def newfolder(request, tplname="modoboa_webmail/folder.html"):
-    mbc = IMAPconnector(user=request.user.username,
-                        password=request.session["password"])
+    mbc = get_imapconnector(request)
 
     if request.method == "POST":
         form = FolderForm(request.POST)
@@ -235,8 +357,7 @@ def newfolder(request, tplname="modoboa_webmail/folder.html"):
 @needs_mailbox()
 @need_password()
 def editfolder(request, tplname="modoboa_webmail/folder.html"):
-    mbc = IMAPconnector(user=request.user.username,
-                        password=request.session["password"])
+    mbc = get_imapconnector(request)
     ctx = {"title": _("Edit folder"),
            "formid": "mboxform",
            "action": reverse("modoboa_webmail:folder_change"),
@@ -296,8 +417,7 @@ def delfolder(request):
     name = request.GET.get("name", None)
     if name is None:
         raise BadRequest(_("Invalid request"))
-    mbc = IMAPconnector(user=request.user.username,
-                        password=request.session["password"])
+    mbc = get_imapconnector(request)
     mbc.delete_folder(name)
     WebmailNavigationParameters(request).remove('mbox')
     return ajax_response(request)
@@ -377,17 +497,18 @@ def delattachment(request):
     return ajax_response(request, "ko", respmsg=error)
 
 
-def render_mboxes_list(request, imapc):
+def render_mboxes_list(request, imapc, pipeline=None):
     """Return the HTML representation of a mailboxes list
 
     :param request: a ``Request`` object
     :param imapc: an ``IMAPconnector` object
+    :param pipeline: a ``Pipeline`` object to send with the LIST command
     :return: a string
     """
     curmbox = WebmailNavigationParameters(request).get("mbox", "INBOX")
     return render_to_string("modoboa_webmail/folders.html", {
         "selected": curmbox,
-        "mboxes": imapc.getmboxes(request.user),
+        "mboxes": imapc.getmboxes(request.user, pipeline=pipeline),
         "withunseen": True
     }, request)
 
@@ -414,9 +535,13 @@ def listmailbox(request, defmailbox="INBOX", update_session=True):
     mbc.parse_search_parameters(
         navparams.get("criteria"), navparams.get("pattern"))
     sort_order = navparams.get("order")
+    messages_per_page = request.user.parameters.get_value("messages_per_page")
+    start = (page_id - 1) * messages_per_page + 1
     paginator = Paginator(
-        mbc.messages_count(folder=mbox, order=sort_order),
-        request.user.parameters.get_value("messages_per_page")
+        mbc.messages_count(
+            folder=mbox, order=sort_order,
+            start=start, stop=start + messages_per_page - 1),
+        messages_per_page
     )
     page = paginator.getpage(page_id)
     content = ""
@@ -438,10 +563,14 @@ def listmailbox(request, defmailbox="INBOX", update_session=True):
         length = 0
         if previous_page_id is not None:
             navparams["page"] = previous_page_id
-    return {
+    result = {
         "listing": content, "length": length, "pages": [page_id],
         "menuargs": {"sort_order": sort_order}
     }
+    state = mbc.get_sync_state()
+    if state is not None:
+        result.update(state)
+    return result
 
 
 def render_compose(request, form, posturl, email=None, **kwargs):
@@ -558,6 +687,7 @@ def forward(request):
 
 @login_required
 @needs_mailbox()
+@compress_page
 @need_password()
 def getmailcontent(request):
     mbox = request.GET.get("mbox", None)
@@ -576,6 +706,7 @@ def getmailcontent(request):
 
 @login_required
 @needs_mailbox()
+@compress_page
 @need_password()
 def getmailsource(request):
     """Retrieve message source."""
@@ -641,16 +772,107 @@ def check_unseen_messages(request):
     if not mboxes:
         raise BadRequest(_("Invalid request"))
     mboxes = mboxes.split(",")
-    counters = {}
-    imapc = get_imapconnector(request)
-    for mb in mboxes:
-        counters[mb] = imapc.unseen_messages(mb)
+    counters = get_imapconnector(request).unseen_counters(mboxes)
     return render_to_json_response(counters)
 
 
 @login_required
 @needs_mailbox()
 @need_password()
+def sync(request):
+    """Return the changes made to a mailbox since a given MODSEQ.
+
+    Only the messages displayed by the browser (``uids``) are
+    checked. Requires CONDSTORE support on the server side
+    (``supported`` is False otherwise).
+    """
+    mbox = request.GET.get("mbox", None)
+    if not mbox:
+        raise BadRequest(_("Invalid request"))
+    since = request.GET.get("since", None)
+    try:
+        if since is not None:
+            since = int(since)
+        uids = [
+            int(uid) for uid in request.GET.get("uids", "").split(",")
+            if uid]
+    except ValueError:
+        raise BadRequest(_("Invalid request"))
+    result = get_imapconnector(request).sync_mailbox(mbox, since, uids)
+    if result is None:
+        return render_to_json_response({"supported": False})
+    result["supported"] = True
+    return render_to_json_response(result)
+
+
+def get_events_parameters(request):
+    """Read the arguments of the ``events`` view.
+
+    :return: a 3-uple (mailbox, MODSEQ known by the browser, list of
+             mailboxes whose counters must be refreshed)
+    """
+    mbox = request.GET.get("mbox", None)
+    if not mbox:
+        raise BadRequest(_("Invalid request"))
+    since = request.GET.get("since", None)
+    if since:
+        try:
+            since = int(since)
+        except ValueError:
+            raise BadRequest(_("Invalid request"))
+    else:
+        since = None
+    mailboxes = [
+        name for name in request.GET.get("mboxes", "").split(",") if name]
+    return mbox, since, mailboxes
+
+
+@login_required
+@needs_mailbox()
+@need_password()
+def events(request):
+    """Stream the changes made to a mailbox (server-sent events).
+
+    A connection is taken from the pool for the whole stream (see
+    ``lib.push``), the last free one is left to other requests. An
+    empty response is returned when push notifications are disabled,
+    not supported by the server or when no connection is available:
+    browsers keep polling in this case.
+
+    Under ASGI, the content of this stream would be buffered until
+    its end: ``async_views.events`` must be used instead.
+    """
+    mbox, since, mailboxes = get_events_parameters(request)
+    conf = dict(param_tools.get_global_parameters("modoboa_webmail"))
+    if not conf["push_enabled"] or isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    try:
+        imapc = connections_pool.checkout(
+            request.user.username, get_password(request), timeout=0,
+            keep_free=1)
+    except ImapError:
+        return HttpResponse(status=204)
+    if not push.is_supported(imapc):
+        connections_pool.checkin(imapc)
+        return HttpResponse(status=204)
+    response = StreamingHttpResponse(
+        push.iter_events(
+            imapc, mbox, since, mailboxes,
+            request.user.parameters.get_value("refresh_interval"),
+            release=connections_pool.checkin),
+        content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Disable buffering when a nginx reverse proxy is used
+    response["X-Accel-Buffering"] = "no"
+    # The stream doesn't need the database
+    close_old_connections()
+    return response
+
+
+@login_required
+@needs_mailbox()
+@compress_page
+@need_password()
 def index(request):
     """Webmail actions handler
 
@@ -687,11 +909,16 @@ def index(request):
     if not is_ajax(request):
         request.session["lastaction"] = None
         imapc = get_imapconnector(request)
-        imapc.getquota(curmbox)
+        # Quota and mailboxes are retrieved using a single round trip
+        pipe = imapc.pipeline()
+        imapc.getquota(curmbox, pipeline=pipe)
+        mboxes = render_mboxes_list(request, imapc, pipe)
         trash = request.user.parameters.get_value("trash_folder")
+        conf = dict(param_tools.get_global_parameters("modoboa_webmail"))
         response.update({
             "hdelimiter": imapc.hdelimiter,
-            "mboxes": render_mboxes_list(request, imapc),
+            "mboxes": mboxes,
+            "push_enabled": conf["push_enabled"],
             "refreshrate": request.user.parameters.get_value(
                 "refresh_interval"),
             "quota": imapc.quota_usage,
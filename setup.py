@@ -71,7 +71,8 @@ if __name__ == "__main__":
             "Topic :: Internet :: WWW/HTTP",
         ],
         keywords="email webmail",
-        packages=find_packages(exclude=["docs", "test_project"]),
+        packages=find_packages(
+            exclude=["benchmarks", "benchmarks.*", "docs", "test_project"]),
         include_package_data=True,
         zip_safe=False,
         install_requires=INSTALL_REQUIRES,